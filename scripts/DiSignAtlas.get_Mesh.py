@@ -11,12 +11,16 @@ Structure:
 # imports
 import pandas as pd, numpy as np, os, sys, re, json, pickle, time, datetime, random
 import requests
-import xml.etree.ElementTree as ET
 import logging
 import json
 from fuzzywuzzy import fuzz
 from tqdm import tqdm
 import spacy
+from mesh_embedding import MeshEmbeddingIndex
+from fuzzy_matcher import FuzzyMatcher
+import mesh_parser
+import instrumentation
+from instrumentation import stage
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -27,11 +31,22 @@ mesh_file_path = "../data/MeSH/desc2023.xml"
 output_path = os.path.join("..","results","files", 
                                        "DiSignAtlas",'disease_mapping.nlp.csv'
                                        )
+mesh_release = os.path.splitext(os.path.basename(mesh_file_path))[0]
+mesh_cache_path = os.path.join("..", "data", "MeSH", "cache")
+embedding_cache_path = mesh_cache_path
+fuzzy_output_path = os.path.join(
+    "..", "results", "files", "DiSignAtlas", "disease_mapping.fuzzy.csv"
+)
+mapping_method = "nlp"  # "nlp", "fuzzy" or "both"
+top_k = 5
+n_jobs = 4
 # functions
 
 def build_mesh_term_tree_number_mapping(mesh_xml_file_path: str) -> dict:
     """
     Build a mapping of MeSH terms to their tree numbers from the MeSH XML file.
+    The XML is streamed once and the result cached under `mesh_cache_path`
+    (see mesh_parser).
 
     Parameters:
     - mesh_xml_file_path (str): The file path to the MeSH XML file.
@@ -39,22 +54,9 @@ def build_mesh_term_tree_number_mapping(mesh_xml_file_path: str) -> dict:
     Returns:
     - dict: A dictionary where keys are MeSH terms and values are lists of associated tree numbers.
     """
-    tree = ET.parse(mesh_xml_file_path)
-    root = tree.getroot()
-
-    mesh_term_2_symbol = dict()
-    mesh_symbol_2_term = dict()
-    for descriptor in root.findall("DescriptorRecord"):
-        term = descriptor.find("DescriptorName/String").text
-        tree_numbers = [
-            tree_number.text
-            for tree_number in descriptor.findall("TreeNumberList/TreeNumber")
-        ]
-        for tree_number in tree_numbers:
-            mesh_symbol_2_term[tree_number] = term
-        mesh_term_2_symbol[term] = tree_numbers
-
-    return mesh_term_2_symbol, mesh_symbol_2_term
+    return mesh_parser.build_mesh_term_tree_number_mapping(
+        mesh_xml_file_path, cache_dir=mesh_cache_path
+    )
 
 def find_best_fuzzy_match(query, choices):
     """Find Best Fuzzy Match
@@ -88,66 +90,78 @@ def cosine_similarity(vector1, vector2):
     """
     return vector1.similarity(vector2)
 
-# 2. Load Data
-# load disease info
-df_disease_info = pd.read_csv(data_path)
-
-diseases = df_disease_info['disease'].unique().tolist()
-
-logging.info(f"Total of {len(diseases)} unique diseases in DiSignAtlas.")
-
-# load disease mapping
-mesh_term_2_symbol, mesh_symbol_2_term = build_mesh_term_tree_number_mapping(
-    mesh_file_path
-)
-disease_mesh_terms = list()
-
-for term, symbols in mesh_term_2_symbol.items():
-    for symbol in symbols:
-        if symbol.startswith("C"):
-            disease_mesh_terms.append(term)
-            break
-
-logging.info(f"Found {len(disease_mesh_terms)} disease MeSH terms from a total of {len(mesh_term_2_symbol.keys())} terms.")
-
-
-# 3. Disease Mapping
-# map diseases to MeSH terms
-
-# Discarded because it takes too long to run ! ! !
-# disease_mapping = list() 
-
-# for disease in tqdm(diseases):
-#     best_match, best_score = find_best_fuzzy_match(disease, disease_mesh_terms)
-#     disease_mapping.append([disease, best_match, best_score])
-
-
-# Load the 'en_core_web_md' model
-nlp = spacy.load("en_core_web_md")
-
-# Perform disease mapping
-disease_mapping = list()
-
-for query_disease in tqdm(diseases):
-    query_vector = nlp(query_disease)
-    most_similar_disease = None
-    highest_similarity = -1  # Initialize with a low value
-
-    for reference_disease in disease_mesh_terms:
-        reference_vector = nlp(reference_disease)
-        similarity_score = cosine_similarity(query_vector, reference_vector)
-
-        if similarity_score > highest_similarity:
-            highest_similarity = similarity_score
-            most_similar_disease = reference_disease
-
-    disease_mapping.append([query_disease, most_similar_disease, highest_similarity])
-
-
-output_path = os.path.join("..", "results", "files", "DiSignAtlas", "disease_mapping.nlp.pkl")
-
-# save disease mapping
-df_disease_mapping = pd.DataFrame(disease_mapping, columns=['disease', 'mesh_term', 'score'])
-df_disease_mapping.to_csv(output_path, index=False)
-
-logging.info(f"Saved disease mapping to {output_path}.")
\ No newline at end of file
+# sections 2-3 only run as a script: FuzzyMatcher.match_many starts worker
+# processes, which re-import this module under the spawn start method
+if __name__ == "__main__":
+    # 2. Load Data
+    # load disease info
+    with stage("mapping.load_diseases"):
+        df_disease_info = pd.read_csv(data_path)
+
+    diseases = df_disease_info['disease'].unique().tolist()
+
+    logging.info(f"Total of {len(diseases)} unique diseases in DiSignAtlas.")
+
+    # load disease mapping
+    with stage("mapping.load_mesh"):
+        mesh_term_2_symbol, mesh_symbol_2_term = build_mesh_term_tree_number_mapping(
+            mesh_file_path
+        )
+    disease_mesh_terms = list()
+
+    for term, symbols in mesh_term_2_symbol.items():
+        for symbol in symbols:
+            if symbol.startswith("C"):
+                disease_mesh_terms.append(term)
+                break
+
+    logging.info(f"Found {len(disease_mesh_terms)} disease MeSH terms from a total of {len(mesh_term_2_symbol.keys())} terms.")
+
+
+    # 3. Disease Mapping
+    # map diseases to MeSH terms
+
+    # lexical mapping: n-gram index prunes each disease to a few candidates
+    # before scoring with fuzz.ratio (replaces find_best_fuzzy_match)
+    if mapping_method in ("fuzzy", "both"):
+        with stage("mapping.fuzzy_index"):
+            mesh_lookup = mesh_parser.load_mesh_lookup(mesh_file_path, cache_dir=mesh_cache_path)
+            fuzzy_matcher = FuzzyMatcher(
+                terms=disease_mesh_terms, synonyms=mesh_lookup["term_2_synonyms"]
+            )
+        with stage("mapping.fuzzy_match", items=len(diseases)):
+            df_fuzzy_mapping = fuzzy_matcher.match_many(diseases, k=top_k, n_jobs=n_jobs)
+        df_fuzzy_mapping.to_csv(fuzzy_output_path, index=False)
+        logging.info(f"Saved fuzzy disease mapping to {fuzzy_output_path}.")
+
+    if mapping_method not in ("nlp", "both"):
+        instrumentation.finish("DiSignAtlas.get_Mesh")
+        sys.exit(0)
+
+    # Load the 'en_core_web_md' model
+    with stage("mapping.load_spacy"):
+        nlp = spacy.load("en_core_web_md")
+
+    # Perform disease mapping
+    # MeSH terms are embedded once (cached per release) and all diseases are
+    # scored in a single batched matrix product
+    with stage("mapping.embed_mesh", items=len(disease_mesh_terms)):
+        mesh_index = MeshEmbeddingIndex.build(
+            nlp=nlp,
+            terms=disease_mesh_terms,
+            release=mesh_release,
+            cache_dir=embedding_cache_path,
+        )
+    with stage("mapping.nlp_match", items=len(diseases)):
+        df_disease_mapping = mesh_index.map_diseases(nlp=nlp, diseases=diseases, k=top_k)
+
+
+    output_path = os.path.join("..", "results", "files", "DiSignAtlas", "disease_mapping.nlp.pkl")
+
+    # save disease mapping
+    df_disease_mapping.to_csv(output_path, index=False)
+
+    logging.info(f"Saved disease mapping to {output_path}.")
+
+    # per-stage time, memory and I/O summary + JSON trace in ../results/traces
+    instrumentation.finish("DiSignAtlas.get_Mesh")
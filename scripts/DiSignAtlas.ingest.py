@@ -0,0 +1,67 @@
+"""
+DiSignAtlas ingest script
+
+Builds (or incrementally updates) the DiSignAtlas signature store: Log2FC,
+PValue and AdjPValue of every processed diff file as memory-mapped
+gene x signature matrices aligned to the human protein-coding genes, plus a
+manifest with the dataset metadata.
+
+Notebooks open it with:
+    store = signature_store.load_signature_matrix(STORE_PATH)
+    manifest = signature_ingest.load_manifest(STORE_PATH)
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Ingest Signatures
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import logging
+
+import instrumentation
+from instrumentation import stage
+from gene_registry import load_registry
+from signature_ingest import (
+    DATA_INFO_PATH,
+    DATA_PATH,
+    STORE_PATH,
+    ingest_signatures,
+    load_manifest,
+)
+
+# Reconfigure logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logging.info("DiSignAtlas Ingest")
+
+# variables
+N_JOBS = 8
+
+
+# 2. Ingest Signatures
+if __name__ == "__main__":
+    with stage("ingest.load_registry"):
+        registry = load_registry()
+    logging.info(f"Nº of Human protein coding genes: {len(registry)}")
+
+    with stage("ingest.signatures") as s:
+        store = ingest_signatures(
+            data_path=DATA_PATH,
+            path=STORE_PATH,
+            registry=registry,
+            data_info_path=DATA_INFO_PATH,
+            n_jobs=N_JOBS,
+        )
+        s.set(n_signatures=store.shape[1])
+    manifest = load_manifest(STORE_PATH)
+
+    logging.info(f"Signature matrix: {store.shape[0]} genes x {store.shape[1]} signatures")
+    logging.info(
+        f"Median nº of registered genes per signature: "
+        f"{manifest['n_registered'].median():.0f}"
+    )
+
+    # per-stage time, memory and I/O summary + JSON trace in ../results/traces
+    instrumentation.finish("DiSignAtlas.ingest")
@@ -0,0 +1,308 @@
+"""ANN Index
+Approximate nearest-neighbour index over signatures (IVF, pure NumPy).
+
+Signatures are prepared as in `similarity` (unit norm for cosine, centred +
+unit norm for Pearson), clustered with spherical k-means, and stored grouped
+by cluster (inverted lists). A query only scans the `n_probe` lists whose
+centroids are closest, instead of the whole atlas. The index is saved as
+plain `.npy` files that are memory-mapped on load, and new signatures can be
+added without retraining.
+
+Scores follow `similarity`: Pearson is a correlation (higher is closer),
+cosine a distance (lower is closer).
+
+Structure:
+    1. Imports, Variables, Functions
+    2. IVF Index
+    3. Benchmark
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import similarity
+
+# variables
+METRICS = ("cosine", "pearson")
+N_PROBE = 8
+N_ITER = 20
+TRAIN_POINTS_PER_LIST = 256
+BLOCK_SIZE = 4096
+
+
+# functions
+def _assign(X, centroids, block_size=BLOCK_SIZE):
+    """Nearest centroid (highest dot product) of each prepared row."""
+    labels = np.empty(len(X), dtype=np.int64)
+    for i in range(0, len(X), block_size):
+        labels[i : i + block_size] = np.argmax(X[i : i + block_size] @ centroids.T, axis=1)
+    return labels
+
+
+def spherical_kmeans(X, n_clusters, n_iter=N_ITER, seed=0):
+    """Spherical K-Means
+    Arguments:
+        - X (np.array): prepared (unit-norm) float32 rows
+        - n_clusters (int): nº of clusters
+        - n_iter (int): nº of Lloyd iterations
+        - seed (int): random seed
+    Returns:
+        - centroids (np.array): n_clusters x dims unit-norm float32 matrix
+    """
+    rng = np.random.default_rng(seed)
+    centroids = X[rng.choice(len(X), size=n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        labels = _assign(X, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, X)
+        counts = np.bincount(labels, minlength=n_clusters)
+
+        # re-seed empty clusters with random points
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = X[rng.choice(len(X), size=len(empty), replace=False)]
+
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        centroids = (sums / norms).astype(np.float32)
+
+    return centroids
+
+
+# 2. IVF Index
+class IVFIndex:
+    """Inverted-file index with spherical k-means coarse quantizer."""
+
+    def __init__(self, metric="cosine", n_probe=N_PROBE):
+        if metric not in METRICS:
+            raise ValueError(f"Err unknown metric '{metric}', choose from {METRICS}")
+        self.metric = metric
+        self.n_probe = n_probe
+        self.centroids = None
+        self.vectors = None
+        self.ids = None
+        self.list_offsets = None
+
+    def __len__(self):
+        return 0 if self.ids is None else len(self.ids)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def _prepare(self, X):
+        return similarity.prepare(X, self.metric)[0]
+
+    def build(self, X, ids=None, n_lists=None, n_iter=N_ITER, seed=0):
+        """Build
+        Trains the coarse quantizer on (a sample of) X and indexes X.
+
+        Arguments:
+            - X (np.array): signatures x genes matrix
+            - ids (np.array): integer id of each row, defaults to 0..N-1
+            - n_lists (int): nº of inverted lists, defaults to sqrt(N)
+            - n_iter (int): k-means iterations
+            - seed (int): random seed
+        Returns:
+            - self (IVFIndex)
+        """
+        Xp = self._prepare(X)
+        n_lists = n_lists or max(1, int(np.sqrt(len(Xp))))
+        n_lists = min(n_lists, len(Xp))
+
+        rng = np.random.default_rng(seed)
+        n_train = min(len(Xp), n_lists * TRAIN_POINTS_PER_LIST)
+        train = Xp[np.sort(rng.choice(len(Xp), size=n_train, replace=False))]
+        self.centroids = spherical_kmeans(train, n_lists, n_iter=n_iter, seed=seed)
+
+        self.vectors = np.empty((0, Xp.shape[1]), dtype=np.float32)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        return self._add_prepared(Xp, np.arange(len(Xp)) if ids is None else ids)
+
+    def add(self, X, ids=None):
+        """Add
+        Adds signatures to their nearest lists without retraining.
+
+        Arguments:
+            - X (np.array): signatures x genes matrix
+            - ids (np.array): integer ids, defaults to continuing 0..N-1
+        Returns:
+            - self (IVFIndex)
+        """
+        if ids is None:
+            start = int(self.ids.max()) + 1 if len(self) else 0
+            ids = np.arange(start, start + len(X))
+        return self._add_prepared(self._prepare(X), ids)
+
+    def _add_prepared(self, Xp, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        old_labels = np.repeat(np.arange(self.n_lists), np.diff(self.list_offsets))
+        labels = np.concatenate([old_labels, _assign(Xp, self.centroids)])
+
+        order = np.argsort(labels, kind="stable")
+        self.vectors = np.concatenate([np.asarray(self.vectors), Xp])[order]
+        self.ids = np.concatenate([np.asarray(self.ids), ids])[order]
+        self.list_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(labels, minlength=self.n_lists))]
+        )
+        return self
+
+    def _to_scores(self, dot):
+        if self.metric == "cosine":
+            return 1 - dot
+        return dot
+
+    def search(self, Q, k=10, n_probe=None):
+        """Search
+        Arguments:
+            - Q (np.array): queries x genes matrix
+            - k (int): nº of neighbours
+            - n_probe (int): nº of lists scanned per query
+        Returns:
+            - ids (np.array): queries x k neighbour ids, closest first
+              (-1 if fewer than k candidates were scanned)
+            - scores (np.array): queries x k scores, closest first
+        """
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        Qp = self._prepare(np.atleast_2d(Q))
+        n_queries = len(Qp)
+
+        probes = np.argpartition(-(Qp @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+
+        best_pos = np.full((n_queries, k), -1, dtype=np.int64)
+        best_dot = np.full((n_queries, k), -np.inf, dtype=np.float32)
+
+        # group queries by probed list, one matrix product per list
+        probe_lists = probes.ravel()
+        probe_queries = np.repeat(np.arange(n_queries), n_probe)
+        order = np.argsort(probe_lists, kind="stable")
+        bounds = np.searchsorted(probe_lists[order], np.arange(self.n_lists + 1))
+
+        for l in range(self.n_lists):
+            queries = probe_queries[order[bounds[l] : bounds[l + 1]]]
+            start, stop = self.list_offsets[l], self.list_offsets[l + 1]
+            if len(queries) == 0 or start == stop:
+                continue
+
+            dot = Qp[queries] @ np.asarray(self.vectors[start:stop]).T
+            pos = np.broadcast_to(np.arange(start, stop), dot.shape)
+
+            cand_dot = np.concatenate([best_dot[queries], dot], axis=1)
+            cand_pos = np.concatenate([best_pos[queries], pos], axis=1)
+            keep = np.argpartition(-cand_dot, k - 1, axis=1)[:, :k]
+            best_dot[queries] = np.take_along_axis(cand_dot, keep, axis=1)
+            best_pos[queries] = np.take_along_axis(cand_pos, keep, axis=1)
+
+        order = np.argsort(-best_dot, axis=1, kind="stable")
+        best_dot = np.take_along_axis(best_dot, order, axis=1)
+        best_pos = np.take_along_axis(best_pos, order, axis=1)
+        ids = np.where(best_pos >= 0, np.asarray(self.ids)[best_pos], -1)
+        return ids, self._to_scores(best_dot)
+
+    def exact_search(self, Q, k=10):
+        """Exact Search
+        Brute-force scan of every indexed signature, for reference.
+
+        Arguments:
+            - Q (np.array): queries x genes matrix
+            - k (int): nº of neighbours
+        Returns:
+            - ids (np.array): queries x k neighbour ids, closest first
+              (-1 if fewer than k signatures are indexed)
+            - scores (np.array): queries x k scores, closest first
+        """
+        Qp = self._prepare(np.atleast_2d(Q))
+        ids = np.full((len(Qp), k), -1, dtype=np.int64)
+        dots = np.full((len(Qp), k), -np.inf, dtype=np.float32)
+        vectors = np.asarray(self.vectors)
+        n_k = min(k, len(vectors))
+        if n_k == 0:
+            return ids, self._to_scores(dots)
+        for i in range(0, len(Qp), BLOCK_SIZE):
+            dot = Qp[i : i + BLOCK_SIZE] @ vectors.T
+            part = np.argpartition(-dot, n_k - 1, axis=1)[:, :n_k]
+            part_dot = np.take_along_axis(dot, part, axis=1)
+            order = np.argsort(-part_dot, axis=1, kind="stable")
+            ids[i : i + BLOCK_SIZE, :n_k] = np.asarray(self.ids)[np.take_along_axis(part, order, axis=1)]
+            dots[i : i + BLOCK_SIZE, :n_k] = np.take_along_axis(part_dot, order, axis=1)
+        return ids, self._to_scores(dots)
+
+    def save(self, path):
+        """Save
+        Arguments:
+            - path (str): index directory
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in ("centroids", "vectors", "ids", "list_offsets"):
+            np.save(os.path.join(path, f"{name}.npy"), np.asarray(getattr(self, name)))
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"metric": self.metric, "n_probe": self.n_probe}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """Load
+        Arguments:
+            - path (str): index directory
+            - mmap_mode (str): numpy memmap mode for the vectors, None loads
+              them into memory
+        Returns:
+            - index (IVFIndex)
+        """
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        index = cls(metric=meta["metric"], n_probe=meta["n_probe"])
+        index.centroids = np.load(os.path.join(path, "centroids.npy"))
+        index.list_offsets = np.load(os.path.join(path, "list_offsets.npy"))
+        index.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode=mmap_mode)
+        index.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode=mmap_mode)
+        return index
+
+
+# 3. Benchmark
+def recall_at_k(ids, exact_ids):
+    """Recall@K
+    Arguments:
+        - ids (np.array): queries x k approximate neighbour ids
+        - exact_ids (np.array): queries x k exact neighbour ids, -1
+          padding (fewer than k indexed signatures) is ignored
+    Returns:
+        - recall (float): fraction of exact neighbours retrieved
+    """
+    hits = [len(np.intersect1d(a, e[e >= 0])) for a, e in zip(ids, exact_ids)]
+    return float(np.sum(hits)) / max(int((exact_ids >= 0).sum()), 1)
+
+
+def benchmark(index, Q, k=10, n_probes=(1, 2, 4, 8, 16, 32)):
+    """Benchmark
+    Recall@k against exact search and query latency for several `n_probe`.
+
+    Arguments:
+        - index (IVFIndex): built index
+        - Q (np.array): queries x genes matrix
+        - k (int): nº of neighbours
+        - n_probes (tuple): `n_probe` values tried
+    Returns:
+        - df (pd.DataFrame): method, n_probe, recall@k, ms_per_query
+    """
+    start = time.perf_counter()
+    exact_ids, _ = index.exact_search(Q, k=k)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(Q)
+
+    rows = list()
+    for n_probe in n_probes:
+        if n_probe > index.n_lists:
+            continue
+        start = time.perf_counter()
+        ids, _ = index.search(Q, k=k, n_probe=n_probe)
+        ms = (time.perf_counter() - start) * 1000 / len(Q)
+        rows.append(["ivf", n_probe, recall_at_k(ids, exact_ids), ms])
+    rows.append(["exact", index.n_lists, 1.0, exact_ms])
+
+    return pd.DataFrame(rows, columns=["method", "n_probe", f"recall@{k}", "ms_per_query"])
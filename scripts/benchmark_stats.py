@@ -0,0 +1,334 @@
+"""Benchmark Statistics
+Batched evaluation of "same disease" (interest) vs "other disease" (rest)
+similarity distributions.
+
+Distributions are ragged arrays: one flat `values` buffer plus `offsets`,
+where group i is `values[offsets[i]:offsets[i + 1]]` (e.g. the
+`RaggedArray`s of `bootstrap_engine`). Interest and rest values of every
+disease are sorted together once (by group, then value), and from
+that single ordering the two-sample KS statistic, AUROC (Mann-Whitney U
+with midranks) and percentiles of all diseases are read off with cumulative
+sums and `reduceat`, instead of one `ks_2samp` / `roc_auc_score` call per
+disease. Metrics and selection modes are evaluated in parallel threads
+(NumPy sorts release the GIL).
+
+AUROC is the probability that an interest value is closer than a rest
+value: higher values for Pearson, lower values for distances.
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Ragged Statistics
+    3. Benchmark Evaluation
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.stats import distributions, ks_2samp
+
+import similarity
+
+# variables
+PERCENTILES = (5, 25, 50, 75, 95)
+KINDS = ("all", "top_k", "top_k_percent")
+MAX_EXACT_N = 10000  # scipy's limit for method="auto"
+
+
+# functions
+def as_ragged(ragged):
+    """As Ragged
+    Arguments:
+        - ragged (RaggedArray | tuple): object with `values` and `offsets`,
+          or a (values, offsets) tuple
+    Returns:
+        - values (np.array): flat values
+        - offsets (np.array): int64 group boundaries
+    """
+    if hasattr(ragged, "values") and hasattr(ragged, "offsets"):
+        values, offsets = ragged.values, ragged.offsets
+    else:
+        values, offsets = ragged
+    return np.asarray(values).ravel(), np.asarray(offsets, dtype=np.int64)
+
+
+def from_lists(lists):
+    """From Lists
+    Converts the notebooks' list-of-lists to a ragged array.
+
+    Arguments:
+        - lists (list): one list (or nested lists) of values per disease
+    Returns:
+        - values (np.array): flat float64 values
+        - offsets (np.array): int64 group boundaries
+    """
+    arrays = [np.ravel(np.asarray(l, dtype=np.float64)) for l in lists]
+    offsets = np.concatenate([[0], np.cumsum([len(a) for a in arrays])]).astype(np.int64)
+    values = np.concatenate(arrays) if arrays else np.empty(0)
+    return values, offsets
+
+
+def _group_ids(offsets):
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def _group_sort_order(values, groups):
+    # sort by value, then stable sort by group; small integer group ids are
+    # radix sorted, much faster than `np.lexsort` on large inputs
+    order = np.argsort(values)
+    groups = groups[order]
+    if len(groups) and groups.max() < 1 << 16:
+        groups = groups.astype(np.uint16)
+    return order[np.argsort(groups, kind="stable")]
+
+
+def _sort_within_groups(values, offsets):
+    return values[_group_sort_order(values, _group_ids(offsets))]
+
+
+# 2. Ragged Statistics
+def ragged_mean(values, offsets):
+    """Ragged Mean
+    Arguments:
+        - values (np.array): flat values
+        - offsets (np.array): group boundaries
+    Returns:
+        - means (np.array): mean per group, NaN if empty
+    """
+    sizes = np.diff(offsets)
+    sums = np.bincount(_group_ids(offsets), weights=values, minlength=len(sizes))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / sizes
+
+
+def ragged_percentiles(values, offsets, q=PERCENTILES, sorted_values=None):
+    """Ragged Percentiles
+    Same as `np.percentile` (linear interpolation) per group.
+
+    Arguments:
+        - values (np.array): flat values
+        - offsets (np.array): group boundaries
+        - q (tuple): percentiles in [0, 100]
+        - sorted_values (np.array): values already sorted within groups
+    Returns:
+        - percentiles (np.array): groups x len(q), NaN for empty groups
+    """
+    if sorted_values is None:
+        sorted_values = _sort_within_groups(values, offsets)
+    sizes = np.diff(offsets)
+    empty = sizes == 0
+
+    q = np.asarray(q, dtype=np.float64)
+    pos = q[None, :] / 100 * (np.maximum(sizes, 1) - 1)[:, None]
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    starts = offsets[:-1, None]
+
+    if len(sorted_values) == 0:
+        return np.full(pos.shape, np.nan)
+    idx_lo = np.minimum(starts + lo, len(sorted_values) - 1)
+    idx_hi = np.minimum(starts + hi, len(sorted_values) - 1)
+    out = sorted_values[idx_lo] + (sorted_values[idx_hi] - sorted_values[idx_lo]) * (pos - lo)
+    out[empty] = np.nan
+    return out
+
+
+def ragged_ks_auroc(x, y, higher=True, method="asymp", return_sorted=False):
+    """Ragged KS & AUROC
+    Two-sample KS test and AUROC for every group from one joint sort.
+
+    Arguments:
+        - x (tuple): interest (values, offsets)
+        - y (tuple): rest (values, offsets), same nº of groups as x
+        - higher (bool): higher values are closer (AUROC orientation)
+        - method (str): "asymp" uses Smirnov's asymptotic p-value for every
+          group (as `ks_2samp(method="asymp")`); "auto" falls back to
+          `ks_2samp` for the groups where scipy would compute it exactly
+        - return_sorted (bool): also return x and y values sorted within
+          groups, e.g. for `ragged_percentiles`
+    Returns:
+        - ks_statistic (np.array): KS statistic per group
+        - ks_pvalue (np.array): two-sided p-value per group
+        - auroc (np.array): AUROC per group
+    """
+    if method not in ("asymp", "auto"):
+        raise ValueError(f"Err unknown method '{method}', choose 'asymp' or 'auto'")
+    x_values, x_offsets = as_ragged(x)
+    y_values, y_offsets = as_ragged(y)
+    if len(x_offsets) != len(y_offsets):
+        raise ValueError("Err interest and rest have a different nº of groups")
+
+    n_x = np.diff(x_offsets)
+    n_y = np.diff(y_offsets)
+    n_groups = len(n_x)
+    offsets = x_offsets + y_offsets
+    starts = offsets[:-1]
+    if offsets[-1] == 0:
+        nan = np.full(n_groups, np.nan)
+        return (nan, nan, nan, x_values, y_values) if return_sorted else (nan, nan, nan)
+
+    values = np.concatenate([x_values, y_values]).astype(np.float64, copy=False)
+    groups = np.concatenate([_group_ids(x_offsets), _group_ids(y_offsets)])
+    is_x = np.concatenate(
+        [np.ones(len(x_values), dtype=bool), np.zeros(len(y_values), dtype=bool)]
+    )
+
+    order = _group_sort_order(values, groups)
+    values, groups, is_x = values[order], groups[order], is_x[order]
+
+    # within-group cumulative counts
+    cum_x = np.concatenate([[0], np.cumsum(is_x)])
+    cum_x_group = cum_x[1:] - cum_x[starts][groups]
+    cum_y_group = (np.arange(1, len(values) + 1) - starts[groups]) - cum_x_group
+
+    # last element of each run of tied values within a group
+    run_end = np.ones(len(values), dtype=bool)
+    run_end[:-1] = (values[1:] != values[:-1]) | (groups[1:] != groups[:-1])
+
+    # KS: max |F_x - F_y| evaluated after each run of ties
+    with np.errstate(invalid="ignore", divide="ignore"):
+        diff = np.abs(cum_x_group / n_x[groups] - cum_y_group / n_y[groups])
+    diff = np.where(run_end, diff, 0)
+    valid = (n_x > 0) & (n_y > 0)
+    nonempty = (n_x + n_y) > 0
+    ks_statistic = np.full(n_groups, np.nan)
+    if nonempty.any():
+        # groups are contiguous, so consecutive non-empty starts delimit them
+        ks_statistic[nonempty] = np.maximum.reduceat(diff, starts[nonempty])
+    ks_statistic[~valid] = np.nan
+
+    # AUROC: Mann-Whitney U with midranks of tied values
+    run_id = np.concatenate([[0], np.cumsum(run_end[:-1])])
+    run_first = np.concatenate([[0], np.flatnonzero(run_end[:-1]) + 1])
+    run_last = np.flatnonzero(run_end)
+    midrank = (run_first + run_last) / 2 - starts[groups[run_first]] + 1
+    ranks = midrank[run_id]
+    rank_sum_x = np.bincount(groups, weights=ranks * is_x, minlength=n_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        u = (rank_sum_x - n_x * (n_x + 1) / 2) / (n_x * n_y)
+    auroc = np.where(valid, u if higher else 1 - u, np.nan)
+
+    # p-values
+    m = np.maximum(n_x, n_y).astype(np.float64)
+    n = np.minimum(n_x, n_y).astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        en = np.round(m * n / (m + n))
+    ks_pvalue = np.full(n_groups, np.nan)
+    ks_pvalue[valid] = np.clip(distributions.kstwo.sf(ks_statistic[valid], en[valid]), 0, 1)
+
+    if method == "auto":
+        for g in np.flatnonzero(valid & (np.maximum(n_x, n_y) <= MAX_EXACT_N)):
+            ks_pvalue[g] = ks_2samp(
+                x_values[x_offsets[g] : x_offsets[g + 1]],
+                y_values[y_offsets[g] : y_offsets[g + 1]],
+            )[1]
+
+    if return_sorted:
+        return ks_statistic, ks_pvalue, auroc, values[is_x], values[~is_x]
+    return ks_statistic, ks_pvalue, auroc
+
+
+# 3. Benchmark Evaluation
+def evaluate(interest, rest, higher=True, q=PERCENTILES, method="asymp"):
+    """Evaluate
+    Arguments:
+        - interest (tuple): interest (values, offsets), one group per disease
+        - rest (tuple): rest (values, offsets), one group per disease
+        - higher (bool): higher values are closer
+        - q (tuple): percentiles reported
+        - method (str): KS p-value method, see `ragged_ks_auroc`
+    Returns:
+        - df (pd.DataFrame): one row per group with sizes, means, KS
+          statistic and p-value, AUROC and percentiles of both distributions
+    """
+    x_values, x_offsets = as_ragged(interest)
+    y_values, y_offsets = as_ragged(rest)
+    ks_statistic, ks_pvalue, auroc, x_sorted, y_sorted = ragged_ks_auroc(
+        (x_values, x_offsets),
+        (y_values, y_offsets),
+        higher=higher,
+        method=method,
+        return_sorted=True,
+    )
+
+    df = pd.DataFrame(
+        {
+            "n_interest": np.diff(x_offsets),
+            "n_rest": np.diff(y_offsets),
+            "interest_mean": ragged_mean(x_values, x_offsets),
+            "rest_mean": ragged_mean(y_values, y_offsets),
+            "ks_statistic": ks_statistic,
+            "ks_pvalue": ks_pvalue,
+            "auroc": auroc,
+        }
+    )
+    x_pct = ragged_percentiles(x_values, x_offsets, q, sorted_values=x_sorted)
+    y_pct = ragged_percentiles(y_values, y_offsets, q, sorted_values=y_sorted)
+    for i, p in enumerate(q):
+        df[f"interest_p{p}"] = x_pct[:, i]
+        df[f"rest_p{p}"] = y_pct[:, i]
+    return df
+
+
+def evaluate_bootstrap(results, kinds=KINDS, n_jobs=3, method="asymp", q=PERCENTILES):
+    """Evaluate Bootstrap
+    Evaluates every metric x selection mode of a `BootstrapResults`, each
+    in its own thread.
+
+    Arguments:
+        - results (BootstrapResults): output of `bootstrap_engine.run_bootstrap`
+        - kinds (tuple): selection modes, "all", "top_k", "top_k_percent"
+        - n_jobs (int): nº of threads
+        - method (str): KS p-value method, see `ragged_ks_auroc`
+        - q (tuple): percentiles reported
+    Returns:
+        - df (pd.DataFrame): disease, metric, kind + `evaluate` columns
+    """
+    jobs = [(metric, kind) for metric in results.metrics for kind in kinds]
+
+    def _evaluate(job):
+        metric, kind = job
+        df = evaluate(
+            results.values[(metric, f"interest_{kind}")],
+            results.values[(metric, f"rest_{kind}")],
+            higher=similarity.HIGHER_IS_CLOSER[metric],
+            q=q,
+            method=method,
+        )
+        df.insert(0, "kind", kind)
+        df.insert(0, "metric", metric)
+        df.insert(0, "disease", results.diseases)
+        return df
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        dfs = list(executor.map(_evaluate, jobs))
+    logging.info(f"Evaluated {len(jobs)} metric x selection mode combinations")
+    return pd.concat(dfs, ignore_index=True)
+
+
+def summarize(df):
+    """Summarize
+    Benchmark table: mean ± std of the KS p-values (as in the figure titles)
+    and AUROC per metric and selection mode.
+
+    Arguments:
+        - df (pd.DataFrame): output of `evaluate_bootstrap`
+    Returns:
+        - summary (pd.DataFrame): one row per metric x kind
+    """
+    return (
+        df.groupby(["metric", "kind"])
+        .agg(
+            n_diseases=("disease", "size"),
+            ks_pvalue_mean=("ks_pvalue", "mean"),
+            ks_pvalue_std=("ks_pvalue", lambda s: np.std(s)),
+            auroc_mean=("auroc", "mean"),
+            auroc_std=("auroc", lambda s: np.std(s)),
+            interest_mean=("interest_mean", "mean"),
+            rest_mean=("rest_mean", "mean"),
+        )
+        .reset_index()
+    )
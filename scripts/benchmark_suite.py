@@ -0,0 +1,451 @@
+"""Benchmark Suite
+Times and memory-profiles the hot paths of the signature pipeline on
+synthetic data (see `synthetic_data`), and keeps a JSON history of the runs
+so throughput regressions show up before a production run.
+
+Stages:
+    - ilincs_ingest: `signature_store.write_signature_matrix`
+    - disignatlas_ingest: `signature_ingest.ingest_signatures`
+    - transforms: `signature_transforms.apply_transform`
+    - similarity.<metric>: `similarity.pairwise`
+    - mesh_parse: `mesh_parser.parse_mesh_descriptors`
+    - mesh_mapping: `fuzzy_matcher.FuzzyMatcher.match_many`, the lexical
+      MeSH mapping of `DiSignAtlas.get_Mesh.py`
+    - mesh_hierarchy: `mesh_hierarchy.MeshHierarchy.signature_matrices`
+    - harmonizome_parse / harmonizome_load_matrix: `harmonizomeapi._parse`
+      and `harmonizomeapi._load_matrix`
+
+Each stage is run `n_repeats` times (median wall and CPU time reported),
+plus once under `tracemalloc` for the peak allocated memory (heap only,
+memory-mapped stores are not counted). Every run is
+appended as one JSON line to `results/benchmarks/history.jsonl` with the
+git commit, scale and environment, and compared with the previous run at
+the same scale. The whole run is also traced with `instrumentation` (RSS,
+I/O per stage, setup included) to `results/benchmarks/traces`.
+
+Run with:
+    python benchmark_suite.py [small|medium|large]
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Synthetic Inputs
+    3. Stages
+    4. Run & History
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import synthetic_data
+
+# variables
+RESULTS_PATH = os.path.join("..", "results", "benchmarks")
+HISTORY_FILE = "history.jsonl"
+N_REPEATS = 3
+REGRESSION_THRESHOLD = 1.2
+BENCHMARK_TRANSFORMS = (
+    "Log2FC", "iLINCS.100", "Ranking.Log2FC", "Significant.Log2FC", "Filtered.Log2FC",
+)
+SIMILARITY_METRICS = ("pearson", "cosine", "euclidean")
+STAGES = dict()
+
+
+# functions
+def register_stage(name):
+    """Register Stage
+    Decorator adding a stage to `STAGES`. A stage receives the synthetic
+    inputs and returns `(run, n_items, setup)`: `run()` is the timed call,
+    `n_items` what throughput is reported in, and `setup()` (or None) runs
+    untimed before every repeat.
+    """
+
+    def decorator(fn):
+        STAGES[name] = fn
+        return fn
+
+    return decorator
+
+
+def measure(run, setup=None, n_repeats=N_REPEATS):
+    """Measure
+    Arguments:
+        - run (callable): timed call
+        - setup (callable): untimed call before every repeat
+        - n_repeats (int): nº of timed repeats
+    Returns:
+        - stats (dict): wall_s and cpu_s (medians), wall_min_s, peak_mb
+    """
+    walls, cpus = list(), list()
+    for _ in range(n_repeats):
+        if setup is not None:
+            setup()
+        wall, cpu = time.perf_counter(), time.process_time()
+        run()
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+
+    # separate traced run, tracemalloc slows allocations down
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "wall_s": float(np.median(walls)),
+        "wall_min_s": float(np.min(walls)),
+        "cpu_s": float(np.median(cpus)),
+        "peak_mb": peak / 1024**2,
+    }
+
+
+# 2. Synthetic Inputs
+def prepare_inputs(scale="small", seed=synthetic_data.SEED, work_dir=None):
+    """Prepare Inputs
+    Generates every synthetic input once, files are written to `work_dir`.
+
+    Arguments:
+        - scale (str | dict): see `synthetic_data.get_scale`
+        - seed (int): random seed
+        - work_dir (str): directory for the files, a new temporary one if
+          None
+    Returns:
+        - inputs (dict): sizes, paths and in-memory inputs of every stage
+    """
+    sizes = synthetic_data.get_scale(scale)
+    work_dir = work_dir or tempfile.mkdtemp(prefix="benchmark_")
+    logging.info(f"Generating synthetic inputs {sizes} in {work_dir}")
+
+    registry = synthetic_data.make_registry(sizes["n_genes"], seed=seed)
+    signatures = list(
+        synthetic_data.make_de_signatures(registry, sizes["n_signatures"], seed=seed)
+    )
+    diff_path = os.path.join(work_dir, "dsa_diff_download.processed")
+    synthetic_data.write_diff_files(diff_path, signatures)
+
+    descriptors = synthetic_data.make_mesh_descriptors(sizes["n_mesh_terms"], seed=seed)
+    mesh_path = os.path.join(work_dir, "MeSH", "desc.xml")
+    synthetic_data.write_mesh_xml(mesh_path, descriptors)
+
+    harmonizome_path = os.path.join(work_dir, "Harmonizome", "gene_attribute_matrix.txt")
+    synthetic_data.write_harmonizome_matrix(
+        harmonizome_path,
+        synthetic_data.make_registry(sizes["n_harmonizome_genes"], seed=seed),
+        sizes["n_harmonizome_genes"],
+        sizes["n_harmonizome_attributes"],
+        seed=seed,
+    )
+
+    return {
+        "sizes": sizes,
+        "seed": seed,
+        "work_dir": work_dir,
+        "registry": registry,
+        "diff_path": diff_path,
+        "ilincs_vectors": synthetic_data.make_ilincs_vectors(signatures),
+        "values": synthetic_data.make_matrix(registry, sizes["n_signatures"], seed=seed),
+        "mesh_path": mesh_path,
+        "descriptors": descriptors,
+        "diseases": synthetic_data.make_disease_names(
+            descriptors, sizes["n_diseases"], seed=seed
+        ),
+        "signature_tree_numbers": synthetic_data.make_signature_tree_numbers(
+            descriptors, sizes["n_signatures"], seed=seed
+        ),
+        "harmonizome_path": harmonizome_path,
+    }
+
+
+def _fresh_dir(path):
+    def setup():
+        shutil.rmtree(path, ignore_errors=True)
+
+    return setup
+
+
+# 3. Stages
+@register_stage("ilincs_ingest")
+def _ilincs_ingest(inputs):
+    from signature_store import write_signature_matrix
+
+    path = os.path.join(inputs["work_dir"], "ilincs_store")
+    vectors = inputs["ilincs_vectors"]
+    return lambda: write_signature_matrix(path, vectors), len(vectors), _fresh_dir(path)
+
+
+@register_stage("disignatlas_ingest")
+def _disignatlas_ingest(inputs):
+    from signature_ingest import ingest_signatures
+
+    path = os.path.join(inputs["work_dir"], "disignatlas_store")
+
+    def run():
+        ingest_signatures(
+            data_path=inputs["diff_path"],
+            path=path,
+            registry=inputs["registry"],
+            data_info_path=None,
+            n_jobs=1,
+        )
+
+    return run, inputs["sizes"]["n_signatures"], _fresh_dir(path)
+
+
+@register_stage("transforms")
+def _transforms(inputs):
+    from signature_transforms import apply_transform
+
+    values = inputs["values"]
+
+    def run():
+        for name in BENCHMARK_TRANSFORMS:
+            apply_transform(name, values, fill=True)
+
+    return run, inputs["sizes"]["n_signatures"] * len(BENCHMARK_TRANSFORMS), None
+
+
+def _similarity_stage(metric):
+    def stage(inputs):
+        from similarity import pairwise
+
+        X = np.ascontiguousarray(np.nan_to_num(inputs["values"]["Log2FC"]).T)
+        return lambda: pairwise(X, metric=metric), len(X) ** 2, None
+
+    return stage
+
+
+for _metric in SIMILARITY_METRICS:
+    register_stage(f"similarity.{_metric}")(_similarity_stage(_metric))
+
+
+@register_stage("mesh_parse")
+def _mesh_parse(inputs):
+    from mesh_parser import parse_mesh_descriptors
+
+    path = inputs["mesh_path"]
+    return lambda: parse_mesh_descriptors(path), len(inputs["descriptors"]), None
+
+
+@register_stage("mesh_mapping")
+def _mesh_mapping(inputs):
+    from fuzzy_matcher import FuzzyMatcher
+
+    descriptors = [d for d in inputs["descriptors"] if d["tree_numbers"][0].startswith("C")]
+    terms = [d["term"] for d in descriptors]
+    synonyms = {d["term"]: d["synonyms"] for d in descriptors}
+    diseases = inputs["diseases"]
+
+    def run():
+        FuzzyMatcher(terms=terms, synonyms=synonyms).match_many(diseases, k=5)
+
+    return run, len(diseases), None
+
+
+@register_stage("mesh_hierarchy")
+def _mesh_hierarchy(inputs):
+    from mesh_hierarchy import MeshHierarchy
+
+    tree_numbers = [t for d in inputs["descriptors"] for t in d["tree_numbers"]]
+    signature_tree_numbers = inputs["signature_tree_numbers"]
+
+    def run():
+        MeshHierarchy(tree_numbers).signature_matrices(signature_tree_numbers)
+
+    return run, len(signature_tree_numbers) ** 2, None
+
+
+@register_stage("harmonizome_parse")
+def _harmonizome_parse(inputs):
+    from harmonizomeapi import _parse
+
+    path = inputs["harmonizome_path"]
+    return lambda: _parse(path), inputs["sizes"]["n_harmonizome_genes"], None
+
+
+@register_stage("harmonizome_load_matrix")
+def _harmonizome_load_matrix(inputs):
+    from harmonizomeapi import _load_matrix
+
+    path = inputs["harmonizome_path"]
+    return lambda: _load_matrix(path, cache=False), inputs["sizes"]["n_harmonizome_genes"], None
+
+
+# 4. Run & History
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(results_path=RESULTS_PATH):
+    """Load History
+    Arguments:
+        - results_path (str): benchmark results directory
+    Returns:
+        - records (list): runs, oldest first
+    """
+    history_path = os.path.join(results_path, HISTORY_FILE)
+    if not os.path.exists(history_path):
+        return list()
+    with open(history_path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def history_frame(records):
+    """History Frame
+    Arguments:
+        - records (list): runs, see `load_history`
+    Returns:
+        - df (pd.DataFrame): one row per run and stage
+    """
+    return pd.DataFrame(
+        [
+            {
+                "timestamp": r["timestamp"],
+                "commit": r["commit"],
+                "scale": r["scale"],
+                "stage": stage,
+                **stats,
+            }
+            for r in records
+            for stage, stats in r["stages"].items()
+        ]
+    )
+
+
+def compare(record, previous, threshold=REGRESSION_THRESHOLD):
+    """Compare
+    Arguments:
+        - record (dict): current run
+        - previous (dict): earlier run at the same scale
+        - threshold (float): wall-time ratio above which a stage is flagged
+    Returns:
+        - df (pd.DataFrame): stage, previous and current wall_s, ratio,
+          regression
+    """
+    rows = list()
+    for stage, stats in record["stages"].items():
+        before = previous["stages"].get(stage)
+        if before is None or "wall_s" not in before or "wall_s" not in stats:
+            continue
+        ratio = stats["wall_s"] / before["wall_s"] if before["wall_s"] else np.nan
+        rows.append([stage, before["wall_s"], stats["wall_s"], ratio, ratio > threshold])
+    return pd.DataFrame(
+        rows, columns=["stage", "previous_wall_s", "wall_s", "ratio", "regression"]
+    )
+
+
+def run_suite(
+    scale="small",
+    stages=None,
+    n_repeats=N_REPEATS,
+    seed=synthetic_data.SEED,
+    results_path=RESULTS_PATH,
+    work_dir=None,
+    save=True,
+):
+    """Run Suite
+    Arguments:
+        - scale (str | dict): see `synthetic_data.get_scale`
+        - stages (list): stage names, None runs all of `STAGES`
+        - n_repeats (int): timed repeats per stage
+        - seed (int): random seed of the synthetic inputs
+        - results_path (str): directory of the JSON history
+        - work_dir (str): directory for synthetic files, a temporary one
+          (removed afterwards) if None
+        - save (bool): append the run to the history and write its trace
+    Returns:
+        - record (dict): run metadata and per-stage stats
+    """
+    stages = list(STAGES) if stages is None else stages
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise KeyError(f"Err unknown stages {sorted(unknown)}, available: {list(STAGES)}")
+
+    cleanup = work_dir is None
+    tracer = instrumentation.Tracer()
+    with tracer.stage("benchmark.prepare_inputs"):
+        inputs = prepare_inputs(scale, seed=seed, work_dir=work_dir)
+    record = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "scale": scale if isinstance(scale, str) else "custom",
+        "sizes": inputs["sizes"],
+        "seed": seed,
+        "n_repeats": n_repeats,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "stages": dict(),
+    }
+
+    try:
+        for name in stages:
+            try:
+                run, n_items, setup = STAGES[name](inputs)
+            except ImportError as e:
+                logging.warning(f"Skipping {name}: {e}")
+                record["stages"][name] = {"skipped": str(e)}
+                continue
+            with tracer.stage(f"benchmark.{name}", items=int(n_items)):
+                stats = measure(run, setup=setup, n_repeats=n_repeats)
+            stats["n_items"] = int(n_items)
+            stats["items_per_s"] = n_items / stats["wall_s"] if stats["wall_s"] else None
+            record["stages"][name] = stats
+            logging.info(
+                f"{name}: {stats['wall_s']:.3f} s, {stats['items_per_s']:.1f} items/s, "
+                f"peak {stats['peak_mb']:.1f} MB"
+            )
+    finally:
+        if cleanup:
+            shutil.rmtree(inputs["work_dir"], ignore_errors=True)
+
+    previous = [
+        r for r in load_history(results_path)
+        if r["scale"] == record["scale"] and r["sizes"] == record["sizes"]
+    ]
+    if previous:
+        df = compare(record, previous[-1])
+        logging.info(f"Compared with {previous[-1]['commit']} ({previous[-1]['timestamp']}):\n{df}")
+        for stage in df.loc[df["regression"], "stage"]:
+            logging.warning(f"Regression in {stage}")
+
+    trace_path = os.path.join(results_path, "traces") if save else None
+    record["trace"] = tracer.finish(f"benchmark.{record['scale']}", trace_path=trace_path)
+
+    if save:
+        os.makedirs(results_path, exist_ok=True)
+        with open(os.path.join(results_path, HISTORY_FILE), "a") as f:
+            f.write(json.dumps(record) + "\n")
+    return record
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    run_suite(scale=sys.argv[1] if len(sys.argv) > 1 else "small")
@@ -0,0 +1,411 @@
+"""Bootstrap Engine
+Vectorized bootstrap of disease signature similarities (see
+`DiSignAtlas.Disease_Similarity_Benchmark.bootstrap_sampling.ipynb`).
+
+Each metric's signatures x signatures matrix is computed once. For every
+disease, the similarities between its signatures ("interest") and against
+`n_bootstrap` resamples of the remaining signatures ("rest") are gathered
+with fancy indexing from that matrix: all resamples are drawn at once as an
+n_bootstrap x n index array. Diseases are split across worker processes that
+attach to the matrices through `multiprocessing.shared_memory` instead of
+receiving a copy.
+
+Results are kept as ragged float32 arrays (one flat buffer + offsets per
+quantity) instead of nested lists:
+    - interest_all: n x (n - 1), each signature against the other ones
+    - interest_top_k / interest_top_k_percent: closest values per row
+    - rest_all: n_bootstrap x n x n, each signature against each resample
+    - rest_top_k / rest_top_k_percent: closest values per row and resample
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Bootstrap per Disease
+    3. Parallel Bootstrap
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import similarity
+
+# variables
+METRICS = similarity.METRICS
+N_BOOTSTRAP = 100
+K_TOP = 1
+K_PERCENT = 0.2
+QUANTITIES = (
+    "interest_all",
+    "interest_top_k",
+    "interest_top_k_percent",
+    "rest_all",
+    "rest_top_k",
+    "rest_top_k_percent",
+)
+
+_worker_scores = dict()
+_worker_shms = list()
+
+
+# functions
+def compute_metric_matrices(
+    X, metrics=METRICS, block_size=similarity.BLOCK_SIZE, p_values=None, n_jobs=1
+):
+    """Compute Metric Matrices
+    Arguments:
+        - X (np.array): signatures x genes matrix
+        - metrics (tuple): metrics computed, may include "weighted_pearson"
+        - block_size (int): rows per block
+        - p_values (np.array): signatures x genes p-values, required by
+          "weighted_pearson"
+        - n_jobs (int): nº of threads for "weighted_pearson"
+    Returns:
+        - scores (dict): metric -> signatures x signatures float32 matrix
+    """
+    scores = dict()
+    for metric in metrics:
+        logging.info(f"Computing {metric} matrix for {len(X)} signatures")
+        if metric == similarity.WEIGHTED_METRIC:
+            if p_values is None:
+                raise ValueError(f"Err {metric} requires p_values")
+            scores[metric] = similarity.weighted_pairwise(
+                X, p_values, block_size=block_size, n_jobs=n_jobs
+            )
+        else:
+            scores[metric] = similarity.pairwise(X, metric=metric, block_size=block_size)
+    return scores
+
+
+def get_disease_indexes(signature_ids, disease_2_signature_ids):
+    """Get Disease Indexes
+    Arguments:
+        - signature_ids (list): signature id of each matrix row (e.g. dsaids)
+        - disease_2_signature_ids (dict): disease -> list of signature ids
+    Returns:
+        - disease_2_idxs (dict): disease -> np.array of row indexes
+    """
+    index = pd.Index(signature_ids)
+    disease_2_idxs = dict()
+    for disease, ids in disease_2_signature_ids.items():
+        idxs = index.get_indexer(ids)
+        if (idxs < 0).any():
+            raise KeyError(f"Err signatures of {disease} not in matrix")
+        disease_2_idxs[disease] = idxs
+    return disease_2_idxs
+
+
+def get_top_k(values, k, higher=True):
+    """Get Top K
+    Vectorized `get_top_k` over the last axis.
+
+    Arguments:
+        - values (np.array): ... x m values
+        - k (int): nº of values kept per row
+        - higher (bool): keep the highest values, else the lowest
+    Returns:
+        - top_k_values (np.array): ... x k values in ascending order
+    """
+    k = min(k, values.shape[-1])
+    if k == 0:
+        return values[..., :0]
+    if higher:
+        part = np.partition(values, values.shape[-1] - k, axis=-1)[..., -k:]
+    else:
+        part = np.partition(values, k - 1, axis=-1)[..., :k]
+    return np.sort(part, axis=-1)
+
+
+def draw_resamples(rest_idxs, size, n_bootstrap=N_BOOTSTRAP, rng=None):
+    """Draw Resamples
+    Arguments:
+        - rest_idxs (np.array): indexes sampled from
+        - size (int): nº of indexes per resample
+        - n_bootstrap (int): nº of resamples
+        - rng (np.random.Generator): random generator
+    Returns:
+        - samples (np.array): n_bootstrap x size indexes, with replacement
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    return rng.choice(np.asarray(rest_idxs), size=(n_bootstrap, size), replace=True)
+
+
+# 2. Bootstrap per Disease
+def bootstrap_disease(
+    scores,
+    interest_idxs,
+    n_bootstrap=N_BOOTSTRAP,
+    k_top=K_TOP,
+    k_percent=K_PERCENT,
+    rng=None,
+):
+    """Bootstrap Disease
+    Same values as the per-pair loops of the bootstrap notebook, gathered
+    from the precomputed matrices. The same resamples are used for every
+    metric.
+
+    Arguments:
+        - scores (dict): metric -> signatures x signatures matrix
+        - interest_idxs (np.array): row indexes of the disease's signatures
+        - n_bootstrap (int): nº of resamples
+        - k_top (int): nº of closest values kept per row
+        - k_percent (float): fraction of closest values kept per row
+        - rng (np.random.Generator): random generator
+    Returns:
+        - samples (np.array): n_bootstrap x n resampled row indexes
+        - values (dict): metric -> quantity -> float32 array
+    """
+    interest_idxs = np.asarray(interest_idxs, dtype=np.int64)
+    n = len(interest_idxs)
+    n_signatures = len(next(iter(scores.values())))
+
+    rest_mask = np.ones(n_signatures, dtype=bool)
+    rest_mask[interest_idxs] = False
+    samples = draw_resamples(np.flatnonzero(rest_mask), n, n_bootstrap, rng)
+
+    off_diagonal = ~np.eye(n, dtype=bool)
+    k_percent_interest = round(k_percent * (n - 1))
+    k_percent_rest = round(k_percent * n)
+
+    values = dict()
+    for metric, matrix in scores.items():
+        higher = similarity.HIGHER_IS_CLOSER[metric]
+        interest = matrix[np.ix_(interest_idxs, interest_idxs)][off_diagonal]
+        interest = interest.reshape(n, n - 1)
+        rest = matrix[interest_idxs[None, :, None], samples[:, None, :]]
+
+        values[metric] = {
+            "interest_all": interest,
+            "interest_top_k": get_top_k(interest, k_top, higher),
+            "interest_top_k_percent": get_top_k(interest, k_percent_interest, higher),
+            "rest_all": rest,
+            "rest_top_k": get_top_k(rest, k_top, higher),
+            "rest_top_k_percent": get_top_k(rest, k_percent_rest, higher),
+        }
+    return samples, values
+
+
+def _init_worker(shm_specs):
+    for metric, (name, shape, dtype) in shm_specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _worker_shms.append(shm)
+        _worker_scores[metric] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _bootstrap_task(args):
+    interest_idxs, n_bootstrap, k_top, k_percent, seed = args
+    return bootstrap_disease(
+        _worker_scores,
+        interest_idxs,
+        n_bootstrap=n_bootstrap,
+        k_top=k_top,
+        k_percent=k_percent,
+        rng=np.random.default_rng(seed),
+    )
+
+
+# 3. Parallel Bootstrap
+class RaggedArray:
+    """Arrays of different shapes stored as one flat buffer + offsets."""
+
+    def __init__(self, values, offsets, shapes):
+        """
+        Arguments:
+            - values (np.array): concatenated, flattened arrays
+            - offsets (np.array): start of each array in `values`, plus the end
+            - shapes (np.array): n_arrays x ndim shape of each array
+        """
+        self.values = values
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.shapes = np.asarray(shapes, dtype=np.int64)
+
+    @classmethod
+    def from_arrays(cls, arrays, dtype=np.float32):
+        sizes = [a.size for a in arrays]
+        offsets = np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)])
+        values = np.empty(offsets[-1], dtype=dtype)
+        for a, start, stop in zip(arrays, offsets[:-1], offsets[1:]):
+            values[start:stop] = a.ravel()
+        return cls(values, offsets, [a.shape for a in arrays])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i] : self.offsets[i + 1]].reshape(self.shapes[i])
+
+
+class BootstrapResults:
+    """Bootstrap values of every disease, metric and quantity."""
+
+    def __init__(self, diseases, samples, values):
+        """
+        Arguments:
+            - diseases (list): disease names
+            - samples (RaggedArray): resampled row indexes per disease
+            - values (dict): (metric, quantity) -> RaggedArray
+        """
+        self.diseases = list(diseases)
+        self.samples = samples
+        self.values = values
+
+    @property
+    def metrics(self):
+        return sorted({metric for metric, _ in self.values})
+
+    def get(self, metric, quantity, disease):
+        """Get
+        Arguments:
+            - metric (str): "pearson", "cosine" or "euclidean"
+            - quantity (str): one of `QUANTITIES`
+            - disease (str): disease name
+        Returns:
+            - values (np.array): float32 array, see module docstring
+        """
+        return self.values[(metric, quantity)][self.diseases.index(disease)]
+
+    def summary(self):
+        """Summary
+        Mean of the interest values and mean (over resamples) of the rest
+        values, as `value_1` / `value_2` in the notebook.
+
+        Returns:
+            - df (pd.DataFrame): disease, metric, kind, interest_mean, rest_mean
+        """
+        rows = list()
+        for metric in self.metrics:
+            for kind in ("all", "top_k", "top_k_percent"):
+                interest = self.values[(metric, f"interest_{kind}")]
+                rest = self.values[(metric, f"rest_{kind}")]
+                for i, disease in enumerate(self.diseases):
+                    rest_i = rest[i]
+                    rest_i = rest_i.reshape(len(rest_i), -1)
+                    rows.append(
+                        [
+                            disease,
+                            metric,
+                            kind,
+                            np.mean(interest[i]) if interest[i].size else np.nan,
+                            np.mean(rest_i.mean(axis=1)) if rest_i.size else np.nan,
+                        ]
+                    )
+        return pd.DataFrame(
+            rows, columns=["disease", "metric", "kind", "interest_mean", "rest_mean"]
+        )
+
+    def save(self, path):
+        """Save
+        Arguments:
+            - path (str): .npz file
+        """
+        arrays = {
+            "diseases": np.asarray(self.diseases, dtype=str),
+            "samples.values": self.samples.values,
+            "samples.offsets": self.samples.offsets,
+            "samples.shapes": self.samples.shapes,
+        }
+        for (metric, quantity), ragged in self.values.items():
+            arrays[f"{metric}.{quantity}.values"] = ragged.values
+            arrays[f"{metric}.{quantity}.offsets"] = ragged.offsets
+            arrays[f"{metric}.{quantity}.shapes"] = ragged.shapes
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+
+        def ragged(prefix):
+            return RaggedArray(
+                arrays[f"{prefix}.values"],
+                arrays[f"{prefix}.offsets"],
+                arrays[f"{prefix}.shapes"],
+            )
+
+        keys = {
+            tuple(name.rsplit(".", 1)[0].split(".", 1))
+            for name in arrays
+            if name.endswith(".values") and not name.startswith("samples.")
+        }
+        values = {key: ragged(".".join(key)) for key in keys}
+        return cls(arrays["diseases"].tolist(), ragged("samples"), values)
+
+
+def run_bootstrap(
+    scores,
+    disease_2_idxs,
+    n_bootstrap=N_BOOTSTRAP,
+    k_top=K_TOP,
+    k_percent=K_PERCENT,
+    n_jobs=1,
+    seed=0,
+):
+    """Run Bootstrap
+    Arguments:
+        - scores (dict): metric -> signatures x signatures matrix, see
+          `compute_metric_matrices`
+        - disease_2_idxs (dict): disease -> row indexes, see
+          `get_disease_indexes`
+        - n_bootstrap (int): nº of resamples per disease
+        - k_top (int): nº of closest values kept per row
+        - k_percent (float): fraction of closest values kept per row
+        - n_jobs (int): nº of worker processes, 1 runs in process
+        - seed (int): random seed, results do not depend on `n_jobs`
+    Returns:
+        - results (BootstrapResults)
+    """
+    diseases = list(disease_2_idxs)
+    seeds = np.random.SeedSequence(seed).spawn(len(diseases))
+    tasks = [
+        (np.asarray(disease_2_idxs[d]), n_bootstrap, k_top, k_percent, s)
+        for d, s in zip(diseases, seeds)
+    ]
+
+    if n_jobs == 1:
+        results = [
+            bootstrap_disease(
+                scores, idxs, n_bootstrap, k_top, k_percent, np.random.default_rng(s)
+            )
+            for idxs, n_bootstrap, k_top, k_percent, s in tasks
+        ]
+    else:
+        shms = dict()
+        try:
+            shm_specs = dict()
+            for metric, matrix in scores.items():
+                matrix = np.ascontiguousarray(matrix)
+                shm = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+                shms[metric] = shm
+                np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=shm.buf)[:] = matrix
+                shm_specs[metric] = (shm.name, matrix.shape, matrix.dtype.str)
+
+            with ProcessPoolExecutor(
+                max_workers=n_jobs, initializer=_init_worker, initargs=(shm_specs,)
+            ) as executor:
+                chunksize = max(1, len(tasks) // (n_jobs * 4))
+                results = list(executor.map(_bootstrap_task, tasks, chunksize=chunksize))
+        finally:
+            for shm in shms.values():
+                shm.close()
+                shm.unlink()
+
+    logging.info(f"Bootstrapped {len(diseases)} diseases x {n_bootstrap} resamples")
+
+    samples = RaggedArray.from_arrays([s for s, _ in results], dtype=np.int64)
+    values = {
+        (metric, quantity): RaggedArray.from_arrays(
+            [v[metric][quantity] for _, v in results]
+        )
+        for metric in scores
+        for quantity in QUANTITIES
+    }
+    return BootstrapResults(diseases, samples, values)
@@ -0,0 +1,275 @@
+"""Checkpoint Store
+Persists notebook variables so the next notebook can pick them up, as a
+faster replacement for IPython `%store` (see `store_variables.py`).
+
+Every variable is written in the cheapest format that fits it:
+    - np.ndarray (non-object): `.npy`, restored memory-mapped
+    - pd.DataFrame / pd.Series: Parquet (needs pyarrow or fastparquet)
+    - anything else, or when the above fails: pickle
+An `index.json` records the format, on-disk size and in-memory size of each
+variable (`nbytes` / `memory_usage(deep=True)`, not `sys.getsizeof`).
+
+Restoring returns the original objects: arrays come back memory-mapped
+(read page by page on access), everything else is loaded. `LazyValue`
+proxies, which defer reading until first use but are not the original
+type, are an explicit opt-in via `lazy`.
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Lazy Values
+    3. Checkpoint Store
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import json
+import logging
+import os
+import pickle
+import shutil
+import sys
+from importlib.util import find_spec
+
+import numpy as np
+import pandas as pd
+
+# variables
+CHECKPOINT_PATH = "checkpoints"
+INDEX_FILE = "index.json"
+HAS_PARQUET = any(find_spec(m) is not None for m in ("pyarrow", "fastparquet"))
+
+
+# functions
+def memory_size(value):
+    """Memory Size
+    Arguments:
+        - value: any object
+    Returns:
+        - nbytes (int): bytes held by arrays/DataFrames (deep for object
+          columns), pickled size for other objects
+    """
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        return int(value.nbytes)
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+# 2. Lazy Values
+class LazyValue:
+    """Proxy loading a checkpointed variable on first access (opt-in, see
+    `CheckpointStore.lazy`).
+
+    Attribute access, indexing, `len`, iteration and numpy conversion are
+    forwarded to the loaded value; use `.value` to get the object itself
+    (e.g. before arithmetic, `pd.concat` or `isinstance` checks).
+    """
+
+    def __init__(self, store, name):
+        self._store = store
+        self._name = name
+        self._value = None
+        self._loaded = False
+
+    @property
+    def value(self):
+        if not self._loaded:
+            self._value = self._store.load(self._name)
+            self._loaded = True
+        return self._value
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return getattr(self.value, attr)
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __len__(self):
+        return len(self.value)
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __contains__(self, item):
+        return item in self.value
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.value, dtype=dtype)
+
+    def __repr__(self):
+        if not self._loaded:
+            entry = self._store.index[self._name]
+            return (
+                f"<LazyValue {self._name}: {entry['type']} "
+                f"({entry['memory_bytes'] / 1024**2:.2f} MB), not loaded>"
+            )
+        return repr(self._value)
+
+
+# 3. Checkpoint Store
+class CheckpointStore:
+    """Directory of variables saved as `.npy`, Parquet or pickle."""
+
+    def __init__(self, path=CHECKPOINT_PATH, mmap_mode="r"):
+        """
+        Arguments:
+            - path (str): checkpoint directory
+            - mmap_mode (str): mode `.npy` files are restored with, None
+              reads them into memory
+        """
+        self.path = path
+        self.mmap_mode = mmap_mode
+        index_path = os.path.join(path, INDEX_FILE)
+        self.index = dict()
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                self.index = json.load(f)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def _write_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(index_path + ".tmp", index_path)
+
+    def _write(self, value, file_path):
+        """Writes `value` to `file_path` + extension, returns the extension."""
+        if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+            with open(file_path + ".npy.tmp", "wb") as f:
+                np.save(f, value, allow_pickle=False)
+            return "npy"
+        if HAS_PARQUET and isinstance(value, (pd.DataFrame, pd.Series)):
+            df = value.to_frame() if isinstance(value, pd.Series) else value
+            try:
+                df.to_parquet(file_path + ".parquet.tmp")
+                return "parquet"
+            except (ValueError, TypeError, ImportError) as e:
+                logging.info(f"Parquet failed for {os.path.basename(file_path)} ({e}), pickling")
+                if os.path.exists(file_path + ".parquet.tmp"):
+                    os.remove(file_path + ".parquet.tmp")
+        with open(file_path + ".pkl.tmp", "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return "pkl"
+
+    def save(self, name, value):
+        """Save
+        Arguments:
+            - name (str): variable name
+            - value: variable
+        """
+        os.makedirs(self.path, exist_ok=True)
+        file_path = os.path.join(self.path, name)
+        extension = self._write(value, file_path)
+        self.delete(name, write_index=False)
+        os.replace(f"{file_path}.{extension}.tmp", f"{file_path}.{extension}")
+
+        self.index[name] = {
+            "file": f"{name}.{extension}",
+            "format": extension,
+            "type": type(value).__name__,
+            "series": isinstance(value, pd.Series),
+            "memory_bytes": memory_size(value),
+            "disk_bytes": os.path.getsize(f"{file_path}.{extension}"),
+        }
+        self._write_index()
+
+    def save_many(self, variables):
+        """Save Many
+        Arguments:
+            - variables (dict): name -> value
+        Returns:
+            - saved (list): names saved, variables that could not be
+              written are logged and skipped
+        """
+        saved = list()
+        for name, value in variables.items():
+            try:
+                self.save(name, value)
+                saved.append(name)
+            except Exception as e:
+                logging.warning(f"Err could not checkpoint {name}: {e}")
+        return saved
+
+    def load(self, name):
+        """Load
+        Arguments:
+            - name (str): variable name
+        Returns:
+            - value: the variable, `.npy` arrays memory-mapped
+        """
+        entry = self.index[name]
+        file_path = os.path.join(self.path, entry["file"])
+        if entry["format"] == "npy":
+            return np.load(file_path, mmap_mode=self.mmap_mode, allow_pickle=False)
+        if entry["format"] == "parquet":
+            df = pd.read_parquet(file_path)
+            return df.iloc[:, 0] if entry["series"] else df
+        with open(file_path, "rb") as f:
+            return pickle.load(f)
+
+    def lazy(self, name):
+        """Lazy
+        Arguments:
+            - name (str): variable name
+        Returns:
+            - proxy (LazyValue): loads the variable on first access; not an
+              instance of the original type, use `.value` for operators,
+              `pd.concat` or `isinstance`
+        """
+        if name not in self.index:
+            raise KeyError(f"Err {name} not in checkpoint {self.path}")
+        return LazyValue(self, name)
+
+    def restore(self, names=None, lazy=False):
+        """Restore
+        Arguments:
+            - names (list): variables to restore, None restores all
+            - lazy (bool): return `LazyValue` proxies instead of the
+              variables, see `lazy`
+        Returns:
+            - variables (dict): name -> value or proxy, e.g. for
+              `globals().update(...)`
+        """
+        names = list(self.index) if names is None else names
+        return {n: self.lazy(n) if lazy else self.load(n) for n in names}
+
+    def delete(self, name, write_index=True):
+        entry = self.index.pop(name, None)
+        if entry is not None:
+            file_path = os.path.join(self.path, entry["file"])
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            if write_index:
+                self._write_index()
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.index = dict()
+
+    def report(self):
+        """Report
+        Returns:
+            - df (pd.DataFrame): name, type, format, memory and disk MB
+        """
+        df = pd.DataFrame(
+            [
+                (name, e["type"], e["format"], e["memory_bytes"], e["disk_bytes"])
+                for name, e in self.index.items()
+            ],
+            columns=["name", "type", "format", "memory_bytes", "disk_bytes"],
+        )
+        df["memory_MB"] = df.pop("memory_bytes") / 1024**2
+        df["disk_MB"] = df.pop("disk_bytes") / 1024**2
+        return df.sort_values("memory_MB", ascending=False, ignore_index=True)
@@ -0,0 +1,403 @@
+"""Disease Ontology
+Disease Ontology (doid.obo) distances for the `do_1` benchmarks without
+NetworkX.
+
+The OBO file is parsed once into integer term ids and a sparse CSR
+child -> parent adjacency (`is_a` edges, the direction of the `obonet`
+graph). Breadth-first searches from every term in use run together as
+sparse frontier x adjacency products, batched over threads, giving each
+term's distance to all of its ancestors. From these:
+    - hop[i, j]: directed shortest path from term i up to term j, what
+      `nx.shortest_path_length(do_G, i, j)` returns in `check_do_related`
+    - lca[i, j]: shortest path through a common ancestor,
+      min_a hop[i, a] + hop[j, a]
+Both are int16 matrices over the terms in use, -1 (`NO_PATH`) when no path
+exists. They are persisted next to the OBO keyed by the ontology
+`data-version` and a hash of the terms, so later lookups are array
+indexing.
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Disease Ontology
+    3. Distance Matrices
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import hashlib
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from mesh_parser import file_checksum
+
+# variables
+DO_PATH = os.path.join("..", "data", "DiseaseOntology", "doid.obo")
+CACHE_DIR = os.path.join("..", "data", "DiseaseOntology", "cache")
+EDGE_TYPES = ("is_a",)
+NO_PATH = -1
+BATCH_SIZE = 512
+
+
+# functions
+def parse_obo(obo_path, edge_types=EDGE_TYPES):
+    """Parse OBO
+    Reads the header and the `[Term]` stanzas of an OBO file, skipping
+    obsolete terms as `obonet.read_obo` does.
+
+    Arguments:
+        - obo_path (str): OBO file
+        - edge_types (tuple): relationships kept as edges, "is_a" or the
+          type of a `relationship:` line (e.g. "part_of")
+    Returns:
+        - header (dict): header tag -> value
+        - terms (list): dicts with id, name, alt_ids, parents
+    """
+    header, terms = dict(), list()
+    stanza, term = None, None
+    with open(obo_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("!"):
+                continue
+            if line.startswith("["):
+                if term is not None and not term["is_obsolete"]:
+                    terms.append(term)
+                stanza = line
+                term = None
+                if stanza == "[Term]":
+                    term = {"id": None, "name": None, "alt_ids": [], "parents": [],
+                            "is_obsolete": False}
+                continue
+
+            tag, _, value = line.partition(":")
+            # trailing "! comment"
+            value = re.sub(r"\s+!.*$", "", value.strip())
+            if stanza is None:
+                header.setdefault(tag, value)
+            elif term is None:
+                continue
+            elif tag == "id":
+                term["id"] = value
+            elif tag == "name":
+                term["name"] = value
+            elif tag == "alt_id":
+                term["alt_ids"].append(value)
+            elif tag == "is_obsolete":
+                term["is_obsolete"] = value == "true"
+            elif tag == "is_a" and "is_a" in edge_types:
+                term["parents"].append(value.split()[0])
+            elif tag == "relationship":
+                relation, target = value.split()[:2]
+                if relation in edge_types:
+                    term["parents"].append(target)
+    if term is not None and not term["is_obsolete"]:
+        terms.append(term)
+    return header, terms
+
+
+# 2. Disease Ontology
+class DiseaseOntology:
+    """Disease Ontology terms with a CSR child -> parent adjacency."""
+
+    def __init__(self, header, terms):
+        """
+        Arguments:
+            - header (dict): OBO header, see `parse_obo`
+            - terms (list): OBO terms, see `parse_obo`
+        """
+        self.data_version = header.get("data-version")
+        # parents not defined as terms still become nodes, as in NetworkX
+        ids = [t["id"] for t in terms]
+        seen = set(ids)
+        for t in terms:
+            for parent in t["parents"]:
+                if parent not in seen:
+                    seen.add(parent)
+                    ids.append(parent)
+        self.ids = np.array(ids, dtype=object)
+        self._index = pd.Index(self.ids)
+        self.names = np.array(
+            [t["name"] for t in terms] + [None] * (len(ids) - len(terms)), dtype=object
+        )
+        self.alt_ids = {alt: t["id"] for t in terms for alt in t["alt_ids"]}
+
+        children = np.repeat(
+            np.arange(len(terms)), [len(t["parents"]) for t in terms]
+        )
+        parents = self._index.get_indexer([p for t in terms for p in t["parents"]])
+        adjacency = sp.csr_matrix(
+            (np.ones(len(children), dtype=np.int8), (children, parents)),
+            shape=(len(ids), len(ids)),
+        )
+        # duplicated edges collapse like in nx.DiGraph
+        adjacency.data[:] = 1
+        self.adjacency = adjacency
+
+    @classmethod
+    def from_obo(cls, obo_path=DO_PATH, edge_types=EDGE_TYPES):
+        header, terms = parse_obo(obo_path, edge_types=edge_types)
+        ontology = cls(header, terms)
+        if ontology.data_version is None:
+            ontology.data_version = f"sha256-{file_checksum(obo_path)[:16]}"
+        logging.info(
+            f"Disease Ontology {ontology.data_version}: {len(ontology)} terms, "
+            f"{ontology.adjacency.nnz} edges"
+        )
+        return ontology
+
+    def __len__(self):
+        return len(self.ids)
+
+    def positions(self, doids, resolve_alt_ids=False):
+        """Positions
+        Arguments:
+            - doids (list): DOIDs
+            - resolve_alt_ids (bool): map alternative ids to their primary
+              term (the notebooks do not, so those never match)
+        Returns:
+            - positions (np.array): term position, -1 if unknown
+        """
+        doids = list(doids)
+        if resolve_alt_ids:
+            doids = [self.alt_ids.get(d, d) for d in doids]
+        return self._index.get_indexer(doids)
+
+    def _ancestor_batch(self, sources):
+        frontier = sp.csr_matrix(
+            (np.ones(len(sources), dtype=np.int32), (np.arange(len(sources)), sources)),
+            shape=(len(sources), len(self)),
+        )
+        visited = frontier.copy()
+        rows, cols, dists = [np.arange(len(sources))], [sources], [np.zeros(len(sources))]
+        distance = 0
+        while frontier.nnz:
+            distance += 1
+            frontier = frontier @ self.adjacency
+            frontier.data[:] = 1
+            frontier = (frontier - frontier.multiply(visited)).tocsr()
+            frontier.eliminate_zeros()
+            visited = visited + frontier
+            coo = frontier.tocoo()
+            rows.append(coo.row)
+            cols.append(coo.col)
+            dists.append(np.full(coo.nnz, distance))
+        return (
+            np.concatenate(rows).astype(np.int64),
+            np.concatenate(cols).astype(np.int64),
+            np.concatenate(dists).astype(np.int16),
+        )
+
+    def ancestor_distances(self, sources, batch_size=BATCH_SIZE, n_jobs=1):
+        """Ancestor Distances
+        Batched BFS up the is_a hierarchy from every source term.
+
+        Arguments:
+            - sources (np.array): term positions
+            - batch_size (int): sources per sparse frontier
+            - n_jobs (int): nº of threads, one batch each
+        Returns:
+            - rows (np.array): index into `sources`
+            - ancestors (np.array): term position of the ancestor (the
+              source itself at distance 0)
+            - distances (np.array): nº of hops
+        """
+        sources = np.asarray(sources, dtype=np.int64)
+        batches = [sources[i : i + batch_size] for i in range(0, len(sources), batch_size)]
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(self._ancestor_batch, batches))
+        rows, ancestors, distances = [], [], []
+        for start, (r, a, d) in zip(range(0, len(sources), batch_size), results):
+            rows.append(r + start)
+            ancestors.append(a)
+            distances.append(d)
+        if not rows:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty.astype(np.int16)
+        return np.concatenate(rows), np.concatenate(ancestors), np.concatenate(distances)
+
+
+# 3. Distance Matrices
+class DODistances:
+    """All-pairs hop and LCA distances between a fixed set of DOIDs."""
+
+    def __init__(self, terms, hop, lca, data_version=None):
+        """
+        Arguments:
+            - terms (list): DOIDs, position i is row/column i
+            - hop (np.array): terms x terms directed hop distances
+            - lca (np.array): terms x terms distances through the closest
+              common ancestor
+            - data_version (str): ontology version they were computed on
+        """
+        self.terms = np.asarray(terms, dtype=object)
+        self.hop = hop
+        self.lca = lca
+        self.data_version = data_version
+        self._index = pd.Index(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def positions(self, doids):
+        return self._index.get_indexer(list(doids))
+
+    def _lookup(self, matrix, doids_1, doids_2):
+        i = self.positions(np.ravel(doids_1))
+        j = self.positions(np.ravel(doids_2))
+        i, j = np.broadcast_arrays(i.reshape(np.shape(doids_1)), j.reshape(np.shape(doids_2)))
+        found = (i >= 0) & (j >= 0)
+        return np.where(found, matrix[np.maximum(i, 0), np.maximum(j, 0)], NO_PATH)
+
+    def hop_distance(self, doids_1, doids_2):
+        """Hop Distance
+        Arguments:
+            - doids_1 (np.array): source DOIDs
+            - doids_2 (np.array): target DOIDs, broadcast against `doids_1`
+        Returns:
+            - hop (np.array): directed hops, -1 if no path or unknown term
+        """
+        return self._lookup(self.hop, doids_1, doids_2)
+
+    def lca_distance(self, doids_1, doids_2):
+        """LCA Distance
+        Arguments:
+            - doids_1 (np.array): DOIDs
+            - doids_2 (np.array): DOIDs, broadcast against `doids_1`
+        Returns:
+            - lca (np.array): hops through the closest common ancestor, -1 if
+              none or unknown term
+        """
+        return self._lookup(self.lca, doids_1, doids_2)
+
+    def related(self, doids_1, doids_2):
+        """Related
+        Array version of `check_do_related`.
+
+        Arguments:
+            - doids_1 (list): DOIDs
+            - doids_2 (list): DOIDs
+        Returns:
+            - related (bool): True if any pair has a path
+            - distances (list): hop distance of every pair with a path
+        """
+        if len(doids_1) == 0 or len(doids_2) == 0:
+            return False, []
+        hop = self.hop_distance(
+            np.asarray(doids_1, dtype=object)[:, None], np.asarray(doids_2, dtype=object)[None, :]
+        ).ravel()
+        distances = hop[hop != NO_PATH].tolist()
+        return len(distances) > 0, distances
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(
+                f,
+                terms=self.terms.astype(str),
+                hop=self.hop,
+                lca=self.lca,
+                data_version=np.array(self.data_version or ""),
+            )
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as npz:
+            return cls(npz["terms"], npz["hop"], npz["lca"], str(npz["data_version"]) or None)
+
+
+def compute_distances(ontology, doids, batch_size=BATCH_SIZE, n_jobs=1):
+    """Compute Distances
+    Arguments:
+        - ontology (DiseaseOntology): parsed ontology
+        - doids (list): DOIDs in use, unknown ones get -1 everywhere but the
+          diagonal
+        - batch_size (int): sources per sparse frontier
+        - n_jobs (int): nº of threads
+    Returns:
+        - distances (DODistances)
+    """
+    terms = np.array(sorted(set(doids)), dtype=object)
+    n = len(terms)
+    hop = np.full((n, n), NO_PATH, dtype=np.int16)
+    lca = np.full((n, n), NO_PATH, dtype=np.int16)
+    np.fill_diagonal(hop, 0)
+    np.fill_diagonal(lca, 0)
+
+    known = np.flatnonzero(ontology.positions(terms) >= 0)
+    sources = ontology.positions(terms[known])
+    rows, ancestors, dists = ontology.ancestor_distances(sources, batch_size, n_jobs)
+    rows = known[rows]
+
+    # hop: ancestors that are themselves terms in use
+    term_of_node = np.full(len(ontology), -1, dtype=np.int64)
+    term_of_node[sources] = known
+    target = term_of_node[ancestors]
+    in_use = target >= 0
+    hop[rows[in_use], target[in_use]] = dists[in_use]
+
+    # lca: for each shared ancestor, every pair of its descendants in use
+    order = np.argsort(ancestors, kind="stable")
+    rows, ancestors, dists = rows[order], ancestors[order], dists[order]
+    starts = np.flatnonzero(np.r_[True, ancestors[1:] != ancestors[:-1]])
+    ends = np.r_[starts[1:], len(ancestors)]
+    best = np.where(lca == NO_PATH, np.iinfo(np.int16).max, lca)
+    for start, end in zip(starts, ends):
+        if end - start < 2:
+            continue
+        r, d = rows[start:end], dists[start:end]
+        block = np.ix_(r, r)
+        best[block] = np.minimum(best[block], d[:, None] + d[None, :])
+    lca = np.where(best == np.iinfo(np.int16).max, NO_PATH, best).astype(np.int16)
+
+    return DODistances(terms, hop, lca, ontology.data_version)
+
+
+def _cache_path(cache_dir, data_version, terms, edge_types):
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", data_version).strip("_")
+    h = hashlib.sha256("\n".join([*edge_types, "", *terms]).encode()).hexdigest()
+    return os.path.join(cache_dir, f"do_distances.{slug}.{h[:16]}.npz")
+
+
+def _read_data_version(obo_path):
+    with open(obo_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("["):
+                break
+            if line.startswith("data-version:"):
+                return line.partition(":")[2].strip()
+    return f"sha256-{file_checksum(obo_path)[:16]}"
+
+
+def load_do_distances(
+    doids, obo_path=DO_PATH, cache_dir=CACHE_DIR, edge_types=EDGE_TYPES, n_jobs=1,
+):
+    """Load DO Distances
+    Returns the cached distance matrices for these DOIDs and ontology
+    version, computing and persisting them on a miss.
+
+    Arguments:
+        - doids (list): DOIDs in use (e.g. from `dsaids_2_doids`)
+        - obo_path (str): Disease Ontology OBO file
+        - cache_dir (str): cache directory
+        - edge_types (tuple): relationships followed, see `parse_obo`
+        - n_jobs (int): nº of threads for the BFS
+    Returns:
+        - distances (DODistances)
+    """
+    terms = sorted(set(doids))
+    cache_path = _cache_path(cache_dir, _read_data_version(obo_path), terms, edge_types)
+    if os.path.exists(cache_path):
+        return DODistances.load(cache_path)
+
+    ontology = DiseaseOntology.from_obo(obo_path, edge_types=edge_types)
+    distances = compute_distances(ontology, terms, n_jobs=n_jobs)
+    distances.save(cache_path)
+    logging.info(f"Cached DO distances for {len(terms)} terms to {cache_path}")
+    return distances
@@ -0,0 +1,193 @@
+"""Fuzzy Matcher
+Lexical matching of disease names against MeSH terms and their synonyms.
+
+A character n-gram inverted index (sparse choices x n-grams matrix) is built
+once. Each query is pruned to the few choices sharing the most n-grams, and
+only those candidates are scored with `fuzz.ratio`, so the result is the
+same as `find_best_fuzzy_match` whenever the best match is among the
+candidates. Batches of queries can be scored across processes.
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Fuzzy Matcher
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from fuzzywuzzy import fuzz
+from scipy.sparse import csr_matrix
+
+# variables
+NGRAM_SIZE = 3
+N_CANDIDATES = 50
+BATCH_SIZE = 256
+
+_worker_matcher = None
+
+
+# functions
+def get_ngrams(text, n=NGRAM_SIZE):
+    """Get N-grams
+    Arguments:
+        - text (str): string
+        - n (int): n-gram size
+    Returns:
+        - ngrams (set): character n-grams of the lowercased, padded string
+    """
+    text = f" {text.lower()} "
+    if len(text) < n:
+        return {text}
+    return {text[i : i + n] for i in range(len(text) - n + 1)}
+
+
+def _init_worker(matcher):
+    global _worker_matcher
+    _worker_matcher = matcher
+
+
+def _match_batch(args):
+    queries, k, n_candidates = args
+    return [_worker_matcher.match(q, k=k, n_candidates=n_candidates) for q in queries]
+
+
+# 2. Fuzzy Matcher
+class FuzzyMatcher:
+    """Character n-gram index over MeSH terms and synonyms."""
+
+    def __init__(self, terms, synonyms=None, n=NGRAM_SIZE):
+        """
+        Arguments:
+            - terms (list): MeSH terms
+            - synonyms (dict): MeSH term -> list of synonyms (entry terms)
+            - n (int): n-gram size
+        """
+        self.n = n
+        self.choices = list()
+        self.choice_terms = list()
+        for term in terms:
+            self.choices.append(term)
+            self.choice_terms.append(term)
+            for synonym in (synonyms or {}).get(term, []):
+                if synonym != term:
+                    self.choices.append(synonym)
+                    self.choice_terms.append(term)
+
+        self.vocabulary = dict()
+        self.index = self._vectorize(self.choices, grow=True)
+        self.n_ngrams = np.asarray(self.index.sum(axis=1)).ravel()
+
+    def _vectorize(self, texts, grow=False):
+        rows, cols = list(), list()
+        for row, text in enumerate(texts):
+            for ngram in get_ngrams(text, self.n):
+                col = self.vocabulary.get(ngram)
+                if col is None:
+                    if not grow:
+                        continue
+                    col = self.vocabulary[ngram] = len(self.vocabulary)
+                rows.append(row)
+                cols.append(col)
+        return csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+            shape=(len(texts), len(self.vocabulary)),
+        )
+
+    def candidates(self, query, n_candidates=N_CANDIDATES):
+        """Candidates
+        Choices sharing the most n-grams with the query (Dice coefficient).
+
+        Arguments:
+            - query (str): query string
+            - n_candidates (int): nº of candidates kept
+        Returns:
+            - idxs (np.array): indexes into `choices`
+        """
+        q = self._vectorize([query])
+        shared = (self.index @ q.T).tocoo()
+        if shared.nnz == 0:
+            return np.array([], dtype=np.int64)
+
+        n_query = len(get_ngrams(query, self.n))
+        dice = 2 * shared.data / (self.n_ngrams[shared.row] + n_query)
+        if len(dice) > n_candidates:
+            keep = np.argpartition(dice, -n_candidates)[-n_candidates:]
+            return shared.row[keep]
+        return shared.row
+
+    def match(self, query, k=1, n_candidates=N_CANDIDATES):
+        """Match
+        Arguments:
+            - query (str): query string
+            - k (int): nº of MeSH terms returned
+            - n_candidates (int): nº of candidates scored with `fuzz.ratio`
+        Returns:
+            - matches (list): (mesh_term, matched_string, score), best first
+        """
+        best = dict()
+        for idx in self.candidates(query, n_candidates):
+            choice = self.choices[idx]
+            term = self.choice_terms[idx]
+            score = fuzz.ratio(query, choice)
+            if term not in best or score > best[term][1]:
+                best[term] = (choice, score)
+
+        ranked = sorted(best.items(), key=lambda item: -item[1][1])[:k]
+        return [(term, choice, score) for term, (choice, score) in ranked]
+
+    def match_many(
+        self, queries, k=1, n_candidates=N_CANDIDATES, n_jobs=1, batch_size=BATCH_SIZE
+    ):
+        """Match Many
+        Arguments:
+            - queries (list): query strings
+            - k (int): nº of MeSH terms kept per query
+            - n_candidates (int): nº of candidates scored per query
+            - n_jobs (int): nº of worker processes, 1 runs in process
+            - batch_size (int): nº of queries sent to a worker at once
+        Returns:
+            - df (pd.DataFrame): disease, mesh_term, matched_name, score and
+              the top-k terms/scores as JSON lists
+        """
+        queries = list(queries)
+
+        if n_jobs == 1:
+            results = [self.match(q, k=k, n_candidates=n_candidates) for q in queries]
+        else:
+            batches = [
+                (queries[i : i + batch_size], k, n_candidates)
+                for i in range(0, len(queries), batch_size)
+            ]
+            with ProcessPoolExecutor(
+                max_workers=n_jobs, initializer=_init_worker, initargs=(self,)
+            ) as executor:
+                results = [r for batch in executor.map(_match_batch, batches) for r in batch]
+
+        rows = list()
+        for query, matches in zip(queries, results):
+            best = matches[0] if matches else (None, None, 0)
+            rows.append(
+                [
+                    query,
+                    best[0],
+                    best[1],
+                    best[2],
+                    json.dumps([m[0] for m in matches]),
+                    json.dumps([m[2] for m in matches]),
+                ]
+            )
+        return pd.DataFrame(
+            rows,
+            columns=[
+                "disease",
+                "mesh_term",
+                "matched_name",
+                "score",
+                "top_k_mesh_terms",
+                "top_k_scores",
+            ],
+        )
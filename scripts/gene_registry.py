@@ -0,0 +1,176 @@
+"""Gene Registry
+Maps Entrez gene IDs and symbols to dense integer positions, so signatures
+from DiSignAtlas, iLINCS and Harmonizome share one matrix layout.
+
+Alignment is done with array indexing (`np.searchsorted` on the sorted
+Entrez IDs, a hashed `pd.Index` for symbols) instead of building a
+dictionary per signature as `sort_values` does.
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Gene Registry
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+# variables
+GENE_INFO_PATH = os.path.join("..", "data", "ncbi_gene_info", "gene_info")
+REGISTRY_PATH = os.path.join("..", "data", "ncbi_gene_info", "gene_registry.npz")
+
+
+# functions
+def load_registry(path=REGISTRY_PATH, gene_info_path=GENE_INFO_PATH):
+    """Load Registry
+    Loads the persisted registry, building it from NCBI gene_info (human
+    protein-coding genes) the first time.
+
+    Arguments:
+        - path (str): registry file
+        - gene_info_path (str): NCBI gene_info file
+    Returns:
+        - registry (GeneRegistry)
+    """
+    if os.path.exists(path):
+        return GeneRegistry.load(path)
+    registry = GeneRegistry.from_gene_info(gene_info_path)
+    registry.save(path)
+    return registry
+
+
+# 2. Gene Registry
+class GeneRegistry:
+    """Dense integer positions for a fixed gene universe."""
+
+    def __init__(self, entrez_ids, symbols=None):
+        """
+        Arguments:
+            - entrez_ids (list): Entrez IDs, position i is gene i
+            - symbols (list): gene symbols aligned to `entrez_ids`
+        """
+        self.entrez_ids = np.asarray(entrez_ids, dtype=np.int64)
+        if len(np.unique(self.entrez_ids)) != len(self.entrez_ids):
+            raise ValueError("Err duplicated Entrez IDs in registry")
+        self.symbols = None if symbols is None else np.asarray(symbols, dtype=object)
+
+        self._sorter = np.argsort(self.entrez_ids, kind="stable")
+        self._sorted_ids = self.entrez_ids[self._sorter]
+        # duplicated symbols map to their first registered gene
+        self._symbol_index = None
+        if symbols is not None:
+            first = ~pd.Index(self.symbols).duplicated(keep="first")
+            self._symbol_index = pd.Index(self.symbols[first])
+            self._symbol_positions = np.flatnonzero(first)
+
+    @classmethod
+    def from_gene_info(cls, gene_info_path=GENE_INFO_PATH, tax_id=9606,
+                       type_of_gene="protein-coding"):
+        """From Gene Info
+        Arguments:
+            - gene_info_path (str): NCBI gene_info file
+            - tax_id (int): taxonomy id, 9606 is human
+            - type_of_gene (str): gene type kept, None keeps all
+        Returns:
+            - registry (GeneRegistry): genes sorted by Entrez ID
+        """
+        df = pd.read_csv(
+            gene_info_path,
+            sep="\t",
+            usecols=["#tax_id", "GeneID", "Symbol", "type_of_gene"],
+        )
+        mask = df["#tax_id"] == tax_id
+        if type_of_gene is not None:
+            mask &= df["type_of_gene"] == type_of_gene
+        df = df[mask].sort_values("GeneID")
+        logging.info(f"Gene registry with {len(df)} genes")
+        return cls(df["GeneID"].to_numpy(), df["Symbol"].to_numpy())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as npz:
+            symbols = npz["symbols"] if "symbols" in npz.files else None
+            return cls(npz["entrez_ids"], symbols)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        arrays = {"entrez_ids": self.entrez_ids}
+        if self.symbols is not None:
+            arrays["symbols"] = self.symbols.astype(str)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(path + ".tmp", path)
+
+    def __len__(self):
+        return len(self.entrez_ids)
+
+    def positions(self, entrez_ids):
+        """Positions
+        Arguments:
+            - entrez_ids (list): Entrez IDs
+        Returns:
+            - positions (np.array): position of each ID, -1 if not registered
+        """
+        entrez_ids = np.asarray(entrez_ids, dtype=np.int64)
+        idx = np.searchsorted(self._sorted_ids, entrez_ids)
+        idx = np.minimum(idx, len(self._sorted_ids) - 1)
+        found = self._sorted_ids[idx] == entrez_ids
+        return np.where(found, self._sorter[idx], -1)
+
+    def symbol_positions(self, symbols):
+        """Symbol Positions
+        Arguments:
+            - symbols (list): gene symbols
+        Returns:
+            - positions (np.array): position of each symbol, -1 if unknown
+        """
+        if self._symbol_index is None:
+            raise ValueError("Err registry built without symbols")
+        idx = self._symbol_index.get_indexer(symbols)
+        return np.where(idx >= 0, self._symbol_positions[idx], -1)
+
+    def align(self, ids, values, fill_value=np.nan, dtype=np.float32, by="entrez"):
+        """Align
+        Places values into the registry layout. Unregistered IDs are dropped;
+        for repeated IDs the last value wins, as with `sort_values`.
+
+        Arguments:
+            - ids (list): Entrez IDs (or symbols if by="symbol")
+            - values (np.array): values aligned to `ids`, 1-D or ids x k
+            - fill_value (float): value of genes absent from `ids`
+            - dtype (type): output dtype
+            - by (str): "entrez" or "symbol"
+        Returns:
+            - aligned (np.array): len(registry) (x k) array
+        """
+        positions = self.positions(ids) if by == "entrez" else self.symbol_positions(ids)
+        values = np.asarray(values)
+        out = np.full((len(self),) + values.shape[1:], fill_value, dtype=dtype)
+        mask = positions >= 0
+        out[positions[mask]] = values[mask]
+        return out
+
+    def align_many(self, ids_list, values_list, fill_value=np.nan, dtype=np.float32,
+                   by="entrez"):
+        """Align Many
+        Arguments:
+            - ids_list (list): one list of IDs per signature
+            - values_list (list): one list of values per signature
+            - fill_value (float): value of genes absent from a signature
+            - dtype (type): output dtype
+            - by (str): "entrez" or "symbol"
+        Returns:
+            - matrix (np.array): genes x signatures matrix
+        """
+        matrix = np.full((len(self), len(ids_list)), fill_value, dtype=dtype)
+        for j, (ids, values) in enumerate(zip(ids_list, values_list)):
+            positions = (
+                self.positions(ids) if by == "entrez" else self.symbol_positions(ids)
+            )
+            mask = positions >= 0
+            matrix[positions[mask], j] = np.asarray(values)[mask]
+        return matrix
@@ -5,17 +5,22 @@ import gzip
 import json
 import os
 import logging
+import shutil
+import threading
+import time
+import zlib
+
+import http_cache
+from instrumentation import current_stage, record_http, stage
 
 # Support for both Python2.X and 3.X.
 # -----------------------------------------------------------------------------
 try:
-    from io import BytesIO
-    from urllib.request import urlopen
+    from urllib.request import Request, urlopen
     from urllib.error import HTTPError
     from urllib.parse import quote_plus
 except ImportError:
-    from StringIO import StringIO as BytesIO
-    from urllib2 import urlopen, HTTPError
+    from urllib2 import Request, urlopen, HTTPError
     from urllib import quote_plus
 
 try:
@@ -51,24 +56,117 @@ class Entity(Enum):
     RESOURCE = 'resource'
 
 
-def json_from_url(url):
-    """Returns API response after decoding and loading JSON.
+def json_from_url(url, refresh=False):
+    """Returns API response after decoding and loading JSON. Responses are
+    recorded and replayed by `http_cache.default_cache()`; `refresh`
+    revalidates a recorded response with the server.
     """
-    response = urlopen(url)
-    data = response.read().decode('utf-8')
-    return json.loads(data)
+    response = http_cache.default_cache().fetch('GET', url, refresh=refresh)
+    if response.status != 200:
+        raise HTTPError(url, response.status, response.reason,
+                        response.headers, None)
+    return response.json()
 
 
 VERSION = '1.0'
 API_URL = 'https://maayanlab.cloud/Harmonizome/api'
 DOWNLOAD_URL = 'https://maayanlab.cloud/static/hdfs/harmonizome/data'
 
+# Local cache for the script config; API responses are recorded by
+# `http_cache`. Set HARMONIZOME_OFFLINE=1 to never contact the API and rely
+# on the caches alone.
+CACHE_DIR = os.environ.get(
+    'HARMONIZOME_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'harmonizome'))
+CONFIG_TTL = 24 * 60 * 60
+PAGE_TTL = 24 * 60 * 60
+CHUNK_SIZE = 1 << 20
+OFFLINE = os.environ.get('HARMONIZOME_OFFLINE', '0').lower() not in ('', '0', 'false')
+
+
 # This config objects pulls the names of the datasets, their directories, and
 # the possible downloads from the API. This allows us to add new datasets and
-# downloads without breaking this file.
-config = json_from_url(API_URL + '/dark/script_config')
-DOWNLOADS = [x for x in config.get('downloads')]
-DATASET_TO_PATH = config.get('datasets')
+# downloads without breaking this file. It is only fetched on first use and
+# cached on disk for `CONFIG_TTL` seconds, so importing this module is free.
+_config = None
+
+
+def _config_cache_path():
+    return os.path.join(CACHE_DIR, 'script_config.json')
+
+
+def set_offline(offline=True):
+    """Switches offline mode on or off; in offline mode the config is only
+    read from the on-disk cache.
+    """
+    global OFFLINE
+    OFFLINE = offline
+
+
+def get_config(refresh=False):
+    """Returns the script config, loading it lazily. The on-disk copy is used
+    while younger than `CONFIG_TTL` (or at any age when offline); otherwise it
+    is refreshed from the API, falling back to a stale copy on network errors.
+    """
+    global _config
+    if _config is not None and not refresh:
+        return _config
+
+    path = _config_cache_path()
+    cached = None
+    if os.path.isfile(path):
+        with open(path) as f:
+            cached = json.load(f)
+        is_fresh = time.time() - os.path.getmtime(path) < CONFIG_TTL
+        if OFFLINE or (is_fresh and not refresh):
+            _config = cached
+            return _config
+
+    if OFFLINE:
+        raise Exception('Offline mode is on and there is no cached config at '
+                        '%s. Run once online to populate it.' % path)
+
+    try:
+        config = json_from_url(API_URL + '/dark/script_config', refresh=True)
+    except Exception as e:
+        if cached is None:
+            raise
+        logging.warning('Using stale cached config, refresh failed: %s' % e)
+        _config = cached
+        return _config
+
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(config, f)
+    os.replace(path + '.tmp', path)
+    _config = config
+    return _config
+
+
+def _downloads():
+    return [x for x in get_config().get('downloads')]
+
+
+def _dataset_to_path():
+    return get_config().get('datasets')
+
+
+def __getattr__(name):
+    # Lazily resolve the config-derived module constants (Python 3.7+).
+    if name == 'DOWNLOADS':
+        return _downloads()
+    if name == 'DATASET_TO_PATH':
+        return _dataset_to_path()
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+class _LazyDatasets(object):
+    """Descriptor resolving `Harmonizome.DATASETS` on first access.
+    """
+
+    def __get__(self, instance, owner):
+        return _dataset_to_path().keys()
 
 
 # Harmonizome class
@@ -77,7 +175,7 @@ DATASET_TO_PATH = config.get('datasets')
 class Harmonizome(object):
 
     __version__ = VERSION
-    DATASETS = DATASET_TO_PATH.keys()
+    DATASETS = _LazyDatasets()
 
     @classmethod
     def get(cls, entity, name=None, start_at=None):
@@ -103,8 +201,60 @@ class Harmonizome(object):
         return cls.get(entity=entity, start_at=start_at)
 
     @classmethod
-    def download(cls, datasets=None, what=None):
+    def iterate(cls, entity, start_at=0, prefetch=4, cache=True):
+        """Yields every record of an entity type (e.g. `Entity.GENE`),
+        walking the cursor API from `start_at`. Up to `prefetch` upcoming
+        pages are requested concurrently over keep-alive connections.
+        Pages are replayed by `http_cache` while younger than `PAGE_TTL`;
+        with `cache=False` every page is revalidated with the server.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        def fetch(cursor):
+            return _get_page(entity, cursor, cache=cache)
+
+        page = fetch(start_at)
+        for record in page.get('entities', []):
+            yield record
+        next_at = _get_next(page)
+        if next_at is None:
+            return
+
+        # Cursors are offsets, so upcoming pages can be requested before
+        # the current one arrives. Each page's `next` is checked against the
+        # prediction; on a mismatch we fall back to following `next`.
+        page_size = next_at - start_at
+        executor = ThreadPoolExecutor(max_workers=max(prefetch, 1))
+        try:
+            pending = {}
+            cursor = next_at
+            while cursor is not None:
+                for k in range(max(prefetch, 1)):
+                    ahead = cursor + k * page_size
+                    if ahead not in pending:
+                        pending[ahead] = executor.submit(fetch, ahead)
+                page = pending.pop(cursor).result()
+                for record in page.get('entities', []):
+                    yield record
+
+                next_at = _get_next(page)
+                if next_at is not None and next_at != cursor + page_size:
+                    for future in pending.values():
+                        future.cancel()
+                    pending = {}
+                    page_size = next_at - cursor
+                cursor = next_at
+        finally:
+            for future in pending.values():
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    @classmethod
+    def download(cls, datasets=None, what=None, n_jobs=1):
         """For each dataset, creates a directory and downloads files into it.
+        Files are streamed and decompressed straight to disk, and interrupted
+        downloads resume where they stopped. With `n_jobs > 1`, up to `n_jobs`
+        files are downloaded at once and yielded as they finish.
         """
         # Why not check `if not datasets`? Because in principle, a user could 
         # call `download([])`, which should download nothing, not everything.
@@ -118,6 +268,7 @@ class Harmonizome(object):
             if resp.lower() != 'y':
                 return
 
+        jobs = []
         for dataset in datasets:
             if dataset not in cls.DATASETS:
                 msg = '"%s" is not a valid dataset name. Check the `DATASETS`'\
@@ -126,33 +277,54 @@ class Harmonizome(object):
             if not os.path.exists(dataset):
                 os.mkdir(dataset)
 
-            if what is None:
-                what = DOWNLOADS
-
-            for dl in what:
-                path = DATASET_TO_PATH[dataset]
+            for dl in (what if what is not None else _downloads()):
+                path = _dataset_to_path()[dataset]
                 url = '%s/%s/%s' % (DOWNLOAD_URL, path, dl)
-
+                filename = '%s/%s' % (dataset, dl)
+                filename = filename.replace('.gz', '')
+                jobs.append((url, filename))
+
+        # Not every dataset has all downloads, so missing files are only an
+        # error when the user asked for them explicitly. Each file is traced
+        # as a stage under the caller's stage, also from worker threads.
+        parent = current_stage()
+
+        def run(job):
+            url, filename = job
+            if os.path.isfile(filename):
+                logging.info('Using cached `%s`' % (filename))
+                return filename
+            logging.info('Downloading `%s`' % (filename))
+            with stage('harmonizome.download_file', parent=parent,
+                       file=filename) as file_stage:
                 try:
-                    response = urlopen(url)
+                    _download_file(url, filename)
                 except HTTPError as e:
-                    # Not every dataset has all downloads.
                     if what is not None:
                         raise Exception('Error downloading from %s: %s' % (url, e))
-
-                filename = '%s/%s' % (dataset, dl)
-                filename = filename.replace('.gz', '')
-
-                if response.code != 200:
-                    raise Exception('This should not happen')
-                
-                if os.path.isfile(filename):
-                    logging.info('Using cached `%s`' % (filename))
-                else:
-                    logging.info('Downloading `%s`' % (filename))
-                    _download_and_decompress_file(response, filename)
-
-                yield filename
+                    logging.info('Skipping `%s`: %s' % (filename, e))
+                    file_stage.set(skipped=str(e))
+                    return None
+                file_stage.set(bytes=os.path.getsize(filename))
+            return filename
+
+        if n_jobs == 1:
+            results = (run(job) for job in jobs)
+        else:
+            from concurrent.futures import ThreadPoolExecutor, as_completed
+            executor = ThreadPoolExecutor(max_workers=n_jobs)
+            futures = [executor.submit(run, job) for job in jobs]
+            results = (future.result() for future in as_completed(futures))
+
+        try:
+            for filename in results:
+                if filename is not None:
+                    yield filename
+        finally:
+            if n_jobs != 1:
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=True)
 
     @classmethod
     def download_df(cls, datasets=None, what=None, sparse=False, **kwargs):
@@ -173,6 +345,76 @@ def _get_with_cursor(entity, start_at):
     return result
 
 
+def _get_page(entity, start_at, cache=True):
+    """Returns one cursor page. Pages are recorded by `http_cache` and
+    replayed while younger than `PAGE_TTL`, so a recrawl picks up new
+    records; `cache=False` revalidates the page. In offline mode only
+    recorded pages are returned, at any age.
+    """
+    url = '%s/%s/%s?cursor=%s' % (API_URL, VERSION, entity, str(start_at))
+    if OFFLINE:
+        replay = http_cache.HTTPCache(http_cache.default_cache().cache_dir,
+                                      mode='replay')
+        try:
+            return replay.fetch('GET', url).json()
+        except http_cache.CacheMiss:
+            raise Exception('Offline mode is on and %s is not cached.' % url)
+    return _pooled_json_from_url(url, refresh=not cache, max_age=PAGE_TTL)
+
+
+_connections = threading.local()
+
+
+def _pooled_send(method, url, body=None, headers=None):
+    """`http_cache` transport reusing one keep-alive connection per thread
+    and host instead of opening a new one for every request. Requests are
+    recorded with `instrumentation.record_http`, which cannot see them
+    otherwise.
+    """
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlsplit
+
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    pool = _connections.__dict__.setdefault('pool', {})
+    path = parts.path + ('?' + parts.query if parts.query else '')
+
+    for attempt in range(2):
+        conn = pool.get(key)
+        if conn is None:
+            conn_type = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+            conn = pool[key] = conn_type(parts.netloc, timeout=60)
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            data = response.read()
+        except (HTTPException, OSError):
+            record_http(url, method, None, time.perf_counter() - start)
+            # The server may have closed an idle connection; retry once.
+            conn.close()
+            del pool[key]
+            if attempt:
+                raise
+            continue
+        record_http(url, method, response.status, time.perf_counter() - start,
+                    len(data))
+        return response.status, response.reason, dict(response.getheaders()), data
+
+
+def _pooled_json_from_url(url, refresh=False, max_age=None):
+    """Like `json_from_url`, but over the keep-alive connections of
+    `_pooled_send`. `max_age` (seconds) revalidates older recorded
+    responses.
+    """
+    response = http_cache.default_cache().fetch('GET', url, send=_pooled_send,
+                                                refresh=refresh, max_age=max_age)
+    if response.status != 200:
+        raise HTTPError(url, response.status, response.reason,
+                        response.headers, None)
+    return response.json()
+
+
 def _get_by_name(entity, name):
     """Returns a single entity based on name.
     """
@@ -195,15 +437,59 @@ def _get_next(response):
     return None
 
 
-# This function was adopted from here: http://stackoverflow.com/a/15353312.
-def _download_and_decompress_file(response, filename):
-    """Downloads and decompresses a single file from a response object.
-    """
-    compressed_file = BytesIO(response.read())
-    decompressed_file = gzip.GzipFile(fileobj=compressed_file)
+def _download_file(url, filename, chunk_size=CHUNK_SIZE):
+    """Downloads a gzip file from `url` and decompresses it to `filename`.
 
-    with open(filename, 'wb+') as outfile:
-        outfile.write(decompressed_file.read())
+    Compressed bytes are streamed to `<filename>.gz.part`. If that file
+    already exists, the download resumes from its end with a Range request.
+    Its size is then checked against the size announced by the server. The
+    part file is decompressed chunk by chunk; gzip checks its own CRC32 and
+    length trailer along the way. A corrupt part file is removed so the next
+    call starts from scratch.
+    """
+    part = filename + '.gz.part'
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+    headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+
+    try:
+        response = urlopen(Request(url, headers=headers))
+    except HTTPError as e:
+        # 416: the part file already holds the whole file.
+        if e.code != 416:
+            raise
+        response = None
+
+    expected_size = None
+    if response is not None:
+        if response.code == 206:
+            content_range = response.headers.get('Content-Range', '')
+            total = content_range.rsplit('/', 1)[-1]
+            expected_size = int(total) if total.isdigit() else None
+            mode = 'ab'
+        else:
+            length = response.headers.get('Content-Length')
+            expected_size = int(length) if length else None
+            mode = 'wb'
+
+        with open(part, mode) as outfile:
+            shutil.copyfileobj(response, outfile, chunk_size)
+
+    size = os.path.getsize(part)
+    if expected_size is not None and size != expected_size:
+        raise Exception('Incomplete download of %s: %d of %d bytes, rerun to '
+                        'resume' % (url, size, expected_size))
+
+    try:
+        with gzip.open(part, 'rb') as infile:
+            with open(filename + '.tmp', 'wb') as outfile:
+                shutil.copyfileobj(infile, outfile, chunk_size)
+    except (IOError, EOFError, zlib.error) as e:
+        os.remove(part)
+        raise Exception('Corrupt download of %s (%s), removed partial file'
+                        % (url, e))
+
+    os.replace(filename + '.tmp', filename)
+    os.remove(part)
 
 
 def _getfshape(fn, row_sep='\n', col_sep='\t', open_args={}):
@@ -234,7 +520,7 @@ def _parse(fn, column_size=3, index_size=3, shape=None,
 
     if index_fmt is None: index_fmt = np.ndarray
     if data_fmt is None: data_fmt = np.ndarray
-    if index_dtype is None: index_dtype = np.object
+    if index_dtype is None: index_dtype = object
     if data_dtype is None: data_dtype = np.float64
 
     if shape is not None:
@@ -270,7 +556,7 @@ def _parse_df(fn, sparse=False, default_fill_value=None,
     from scipy.sparse import lil_matrix
 
     data_fmt = lil_matrix if sparse else np.ndarray
-    df_type = pd.SparseDataFrame if sparse else pd.DataFrame
+    df_type = pd.DataFrame.sparse.from_spmatrix if sparse else pd.DataFrame
     (
         column_names, columns,
         index_names, index,
@@ -290,26 +576,143 @@ def _parse_df(fn, sparse=False, default_fill_value=None,
         index=pd.Index(
             data=index,
             name=str(index_names),
-            dtype=np.object,
+            dtype=object,
         ),
         columns=pd.Index(
             data=columns,
             name=str(column_names),
-            dtype=np.object,
+            dtype=object,
         ),
         **df_args,
     )
 
+def _load_matrix(fn, column_size=3, index_size=3, chunksize=5000,
+                 data_dtype='float32', col_sep='\t', cache=True,
+                 open_args={}):
+    '''
+    Single-pass loader for matrix formats such as gene_attribute_matrix.txt.
+     Rows are parsed in chunks by pandas' C reader and each chunk is
+     converted to CSR at once, so the dense matrix is never held in memory
+     and the file is read only once. The result is cached as `<fn>.npz`
+     and reused while the text file and the parse arguments (sizes,
+     separator, dtype, open arguments) are unchanged.
+
+    Returns:
+        (column_names, columns, index_names, index, data) as `_parse`, with
+        `data` a scipy CSR matrix
+    '''
+    import numpy as np
+    import pandas as pd
+    from scipy.sparse import csr_matrix, vstack
+
+    cache_fn = fn + '.npz'
+    stat = os.stat(fn)
+    params = json.dumps({
+        'column_size': column_size, 'index_size': index_size,
+        'data_dtype': np.dtype(data_dtype).str, 'col_sep': col_sep,
+        'open_args': open_args,
+    }, sort_keys=True)
+    if cache and os.path.isfile(cache_fn):
+        with np.load(cache_fn, allow_pickle=False) as npz:
+            if (int(npz['source_size']) == stat.st_size and
+                    float(npz['source_mtime']) == stat.st_mtime and
+                    'params' in npz and str(npz['params']) == params):
+                data = csr_matrix(
+                    (npz['data'], npz['indices'], npz['indptr']),
+                    shape=tuple(npz['shape']))
+                return (npz['column_names'].astype(object),
+                        npz['columns'].astype(object),
+                        npz['index_names'].astype(object),
+                        npz['index'].astype(object),
+                        data)
+
+    with open(fn, 'r', **open_args) as fh:
+        header = np.array([next(fh).rstrip('\r\n').split(col_sep)
+                           for _ in range(column_size)], dtype=object)
+        column_names = header[:column_size, index_size - 1]
+        index_names = header[column_size - 1, :index_size]
+        columns = header[:column_size, index_size:]
+
+        dtype = {i: (object if i < index_size else data_dtype)
+                 for i in range(header.shape[1])}
+        reader = pd.read_csv(fh, sep=col_sep, header=None, dtype=dtype,
+                             na_filter=False, chunksize=chunksize)
+        index_chunks, data_chunks = [], []
+        for chunk in reader:
+            index_chunks.append(chunk.iloc[:, :index_size].to_numpy(dtype=object))
+            data_chunks.append(csr_matrix(chunk.iloc[:, index_size:].to_numpy()))
+
+    n_cols = columns.shape[1]
+    index = (np.concatenate(index_chunks) if index_chunks
+             else np.empty((0, index_size), dtype=object))
+    data = (vstack(data_chunks, format='csr') if data_chunks
+            else csr_matrix((0, n_cols), dtype=data_dtype))
+
+    if cache:
+        with open(cache_fn + '.tmp', 'wb') as f:
+            np.savez(f, data=data.data, indices=data.indices,
+                     indptr=data.indptr, shape=np.array(data.shape),
+                     column_names=column_names.astype(str),
+                     columns=columns.astype(str),
+                     index_names=index_names.astype(str),
+                     index=index.astype(str),
+                     source_size=stat.st_size, source_mtime=stat.st_mtime,
+                     params=np.array(params))
+        os.replace(cache_fn + '.tmp', cache_fn)
+
+    return (column_names, columns, index_names, index, data)
+
+def _load_matrix_df(fn, sparse=True, column_apply=None, index_apply=None,
+                    as_csr=False, **kwargs):
+    '''
+    Loads a matrix file with `_load_matrix` and labels it. Returns a
+     DataFrame backed by pandas sparse arrays (or dense if `sparse=False`),
+     or `(csr, index, columns)` if `as_csr=True`.
+    '''
+    import pandas as pd
+
+    (
+        column_names, columns,
+        index_names, index,
+        data,
+    ) = _load_matrix(fn, **kwargs)
+
+    # without an apply function, the label rows become MultiIndex levels
+    if column_apply is not None:
+        column_names, columns = column_apply(column_names.T, columns.T)
+        columns = pd.Index(data=columns, name=str(column_names), dtype=object)
+    else:
+        columns = pd.MultiIndex.from_arrays(list(columns), names=list(column_names))
+
+    if index_apply is not None:
+        index_names, index = index_apply(index_names, index)
+        index = pd.Index(data=index, name=str(index_names), dtype=object)
+    else:
+        index = pd.MultiIndex.from_arrays(list(index.T), names=list(index_names))
+
+    if as_csr:
+        return data, index, columns
+    if sparse:
+        # the fill value differs across pandas versions, pin it to 0
+        return pd.DataFrame.sparse.from_spmatrix(
+            data, index=index, columns=columns,
+        ).astype(pd.SparseDtype(data.dtype, 0))
+    return pd.DataFrame(data.toarray(), index=index, columns=columns)
+
 def _df_column_uniquify(df):
     df_columns = df.columns
+    if df_columns.is_unique:
+        return df
     new_columns = []
+    seen = set()
     for item in df_columns:
             counter = 0
             newitem = item
-            while newitem in new_columns:
+            while newitem in seen:
                     counter += 1
                     newitem = "{}_{}".format(item, counter)
             new_columns.append(newitem)
+            seen.add(newitem)
     df.columns = new_columns
     return df
 
@@ -325,11 +728,12 @@ def _json_ind_no_slash(ind_names, ind):
 def _read_as_dataframe(fn):
     ''' Standard loading of dataframe '''
     if fn.endswith('gene_attribute_matrix.txt'):
-        return _df_column_uniquify(_parse_df(
+        return _df_column_uniquify(_load_matrix_df(
             fn,
             sparse=False,
             index_apply=_json_ind_no_slash,
             column_apply=_json_ind_no_slash,
+            data_dtype='float64',
             open_args=dict(encoding="latin-1"),
         ))
     elif fn.endswith('gene_list_terms.txt') or fn.endswith('attribute_list_entries.txt'):
@@ -341,12 +745,11 @@ def _read_as_dataframe(fn):
 def _read_as_sparse_dataframe(fn, blocksize=10e6, fill_value=0):
     ''' Efficient loading sparse dataframe '''
     if fn.endswith('gene_attribute_matrix.txt'):
-        return _df_column_uniquify(_parse_df(
+        return _df_column_uniquify(_load_matrix_df(
             fn,
             sparse=True,
             index_apply=_json_ind_no_slash,
             column_apply=_json_ind_no_slash,
-            df_args=dict(default_fill_value=0),
             open_args=dict(encoding="latin-1"),
         ))
     else:
@@ -0,0 +1,510 @@
+"""HTTP Cache
+Record/replay transport shared by the iLINCS, Harmonizome and notebook
+(iLINCS/Entrez) clients, so reruns read identical payloads from disk
+instead of downloading them again.
+
+Responses are recorded in a content-indexed store under `CACHE_DIR`:
+    - index/<kk>/<key>.json: request (method, normalized URL, body hash),
+      status, headers, validators and the digest of the body
+    - blobs/<dd>/<digest>.gz: gzip-compressed body, named by its sha256,
+      so identical payloads behind different requests are stored once
+
+Modes (`HTTP_CACHE_MODE` environment variable or `HTTPCache(mode=...)`):
+    - record: replay recorded responses, fetch and record the others
+      (entries older than `max_age` are refreshed conditionally)
+    - refresh: revalidate every entry with If-None-Match/If-Modified-Since;
+      a 304 replays the recorded body, a 200 replaces it
+    - replay: never touch the network, a missing entry raises `CacheMiss`
+    - off: pass every request through
+
+Only GET/HEAD 200 responses are recorded by default. Streams and file
+downloads (e.g. `harmonizomeapi._download_file`) bypass the cache.
+
+Clients:
+    - requests: `cached_session()` or mount `CachingAdapter`
+    - urllib / http.client: `HTTPCache.fetch(method, url, send=...)`
+    - notebooks: `sys.path.append('../scripts/')`, then use
+      `http_cache.cached_session().get` instead of `requests.get`
+
+Stand-in server: `python http_cache.py serve [port] [upstream]` replays the
+store over HTTP. Clients either use it as a proxy (`HTTP_PROXY=
+http://127.0.0.1:8765`, http URLs only) or point their base URL at it with
+`upstream` set to the recorded host, e.g. `https://maayanlab.cloud`. With
+`HTTP_CACHE_MODE=off` on the client side, the downloaders can be
+load-tested offline at any concurrency.
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Store
+    3. Transports
+    4. Stand-in Server
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from urllib.request import Request, urlopen
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# variables
+CACHE_DIR = os.environ.get("HTTP_CACHE_DIR", os.path.join("..", "data", "cache", "http"))
+MODE = os.environ.get("HTTP_CACHE_MODE", "record")
+MODES = ("record", "refresh", "replay", "off")
+MAX_AGE = float(os.environ["HTTP_CACHE_MAX_AGE"]) if os.environ.get("HTTP_CACHE_MAX_AGE") else None
+CACHEABLE_METHODS = ("GET", "HEAD")
+CACHEABLE_STATUS = (200,)
+CACHE_HEADER = "X-HTTP-Cache"
+STANDIN_PORT = 8765
+# headers describing the transfer, not the payload (bodies are stored decoded)
+_TRANSFER_HEADERS = {
+    "connection", "keep-alive", "transfer-encoding", "content-encoding",
+    "content-length", "date", "set-cookie",
+}
+
+
+class CacheMiss(LookupError):
+    """Raised in replay mode for a request that was never recorded."""
+
+
+# functions
+def normalize_url(url):
+    """Normalize URL
+    Arguments:
+        - url (str): request URL
+    Returns:
+        - url (str): lowercase scheme/host, sorted query, no fragment, so
+          `...api/Compounds?` and `...api/Compounds` share an entry
+    """
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or "/", query, ""))
+
+
+def request_key(method, url, body=None):
+    """Request Key
+    Arguments:
+        - method (str): HTTP method
+        - url (str): request URL
+        - body (bytes | str): request body, None for none
+    Returns:
+        - key (str): sha256 of method, normalized URL and body
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    h = hashlib.sha256(f"{method.upper()} {normalize_url(url)}\n".encode("utf-8"))
+    h.update(body or b"")
+    return h.hexdigest()
+
+
+class CachedResponse:
+    """Response returned by `HTTPCache.fetch`."""
+
+    def __init__(self, status, reason, headers, content, url, cache_status):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+        self.url = url
+        self.cache_status = cache_status  # HIT, MISS, REVALIDATED or BYPASS
+
+    @property
+    def from_cache(self):
+        return self.cache_status in ("HIT", "REVALIDATED")
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content.decode("utf-8"))
+
+
+def urllib_send(method, url, body=None, headers=None, timeout=60):
+    """Urllib Send
+    Default transport of `HTTPCache.fetch`.
+
+    Arguments:
+        - method (str): HTTP method
+        - url (str): request URL
+        - body (bytes): request body
+        - headers (dict): request headers
+        - timeout (float): seconds
+    Returns:
+        - response (tuple): status, reason, headers (dict), body (bytes);
+          HTTP errors (and 304) are returned, not raised
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    request = Request(url, data=body, headers=headers or {}, method=method)
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            return response.status, response.reason, dict(response.headers), response.read()
+    except HTTPError as e:
+        return e.code, e.reason, dict(e.headers), e.read()
+
+
+# 2. Store
+class HTTPCache:
+    """Content-indexed, gzip-compressed record/replay store, see the module
+    docstring."""
+
+    def __init__(self, cache_dir=CACHE_DIR, mode=MODE, max_age=MAX_AGE, methods=CACHEABLE_METHODS):
+        """
+        Arguments:
+            - cache_dir (str): store directory
+            - mode (str): record, refresh, replay or off
+            - max_age (float): seconds after which recorded entries are
+              revalidated in record mode, None never
+            - methods (tuple): methods recorded, others pass through
+              (e.g. add "POST" to record the iLINCS batch downloads)
+        """
+        if mode not in MODES:
+            raise ValueError(f"Err unknown HTTP cache mode {mode}, use one of {MODES}")
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.max_age = max_age
+        self.methods = tuple(m.upper() for m in methods)
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def key(self, method, url, body=None):
+        return request_key(method, url, body)
+
+    def _index_path(self, key):
+        return os.path.join(self.cache_dir, "index", key[:2], f"{key}.json")
+
+    def _blob_path(self, digest):
+        return os.path.join(self.cache_dir, "blobs", digest[:2], f"{digest}.gz")
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def lookup(self, key):
+        """Lookup
+        Arguments:
+            - key (str): request key
+        Returns:
+            - entry (dict): recorded response metadata, None if missing
+        """
+        try:
+            with open(self._index_path(key), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def read_body(self, entry):
+        with gzip.open(self._blob_path(entry["body"]), "rb") as f:
+            return f.read()
+
+    def record(self, key, method, url, status, reason, headers, body):
+        """Record
+        Arguments:
+            - key (str): request key
+            - method, url (str): request
+            - status (int), reason (str), headers (dict), body (bytes):
+              response, `body` decoded (no Content-Encoding)
+        Returns:
+            - entry (dict): index entry
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        if not os.path.exists(self._blob_path(digest)):
+            self._write(self._blob_path(digest), gzip.compress(body, compresslevel=6))
+        now = time.time()
+        entry = {
+            "method": method,
+            "url": url,
+            "status": status,
+            "reason": reason,
+            "headers": {k: v for k, v in headers.items() if k.lower() not in _TRANSFER_HEADERS},
+            "body": digest,
+            "size": len(body),
+            "recorded": now,
+            "validated": now,
+        }
+        self._write(self._index_path(key), json.dumps(entry).encode("utf-8"))
+        return entry
+
+    def _revalidated(self, key, entry, headers):
+        """Marks `entry` fresh after a 304, taking over new validators."""
+        entry["validated"] = time.time()
+        for name, value in headers.items():
+            if name.lower() in ("etag", "last-modified", "cache-control", "expires"):
+                entry["headers"] = {k: v for k, v in entry["headers"].items() if k.lower() != name.lower()}
+                entry["headers"][name] = value
+        self._write(self._index_path(key), json.dumps(entry).encode("utf-8"))
+        return entry
+
+    def _replay(self, entry, url, cache_status):
+        with self._lock:
+            self.stats[cache_status] += 1
+        return CachedResponse(
+            entry["status"], entry["reason"], dict(entry["headers"]),
+            self.read_body(entry), url, cache_status,
+        )
+
+    def fetch(self, method, url, body=None, headers=None, send=urllib_send, refresh=False,
+              max_age=None):
+        """Fetch
+        Arguments:
+            - method (str): HTTP method
+            - url (str): request URL
+            - body (bytes | str): request body
+            - headers (dict): request headers
+            - send (callable): `send(method, url, body, headers)` returning
+              status, reason, headers, body; `urllib_send` by default
+            - refresh (bool): revalidate a recorded entry as in refresh
+              mode (ignored in replay mode)
+            - max_age (float): seconds after which this entry is
+              revalidated, overrides `self.max_age` if given
+        Returns:
+            - response (CachedResponse): replayed or fetched response
+        """
+        method = method.upper()
+        headers = dict(headers or {})
+        if self.mode == "off" or method not in self.methods:
+            with self._lock:
+                self.stats["BYPASS"] += 1
+            return CachedResponse(*send(method, url, body, headers), url, "BYPASS")
+
+        key = self.key(method, url, body)
+        entry = self.lookup(key)
+        if entry is not None and self.mode == "replay":
+            return self._replay(entry, url, "HIT")
+        if entry is None and self.mode == "replay":
+            raise CacheMiss(f"Err {method} {url} not recorded in {self.cache_dir}")
+
+        max_age = self.max_age if max_age is None else max_age
+        stale = entry is not None and (
+            refresh
+            or self.mode == "refresh"
+            or (max_age is not None and time.time() - entry["validated"] > max_age)
+        )
+        if entry is not None and not stale:
+            return self._replay(entry, url, "HIT")
+
+        if entry is not None:
+            validators = CaseInsensitiveDict(entry["headers"])
+            if "ETag" in validators:
+                headers["If-None-Match"] = validators["ETag"]
+            if "Last-Modified" in validators:
+                headers["If-Modified-Since"] = validators["Last-Modified"]
+
+        status, reason, response_headers, content = send(method, url, body, headers)
+        if status == 304 and entry is not None:
+            entry = self._revalidated(key, entry, response_headers)
+            return self._replay(entry, url, "REVALIDATED")
+        with self._lock:
+            self.stats["MISS"] += 1
+        if status in CACHEABLE_STATUS:
+            self.record(key, method, url, status, reason, response_headers, content)
+        return CachedResponse(status, reason, response_headers, content, url, "MISS")
+
+    def entries(self):
+        """Yields every recorded index entry."""
+        index_path = os.path.join(self.cache_dir, "index")
+        for root, _, files in os.walk(index_path):
+            for name in files:
+                if name.endswith(".json"):
+                    with open(os.path.join(root, name), "r") as f:
+                        yield json.load(f)
+
+
+_default_cache = None
+
+
+def default_cache():
+    """Returns the process-wide cache configured by the HTTP_CACHE_*
+    environment variables."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = HTTPCache()
+    return _default_cache
+
+
+# 3. Transports
+class CachingAdapter(HTTPAdapter):
+    """`requests` transport adapter answering from an `HTTPCache`.
+
+    Recorded methods go through `HTTPCache.fetch`, with the adapter's own
+    connection pool as transport; streamed requests and other methods are
+    sent as usual. Responses carry an `X-HTTP-Cache` header (HIT, MISS,
+    REVALIDATED).
+    """
+
+    def __init__(self, cache=None, **kwargs):
+        """
+        Arguments:
+            - cache (HTTPCache): store, `default_cache()` if None
+            - kwargs: `HTTPAdapter` arguments (pool_connections,
+              pool_maxsize, max_retries...)
+        """
+        super().__init__(**kwargs)
+        self.cache = cache if cache is not None else default_cache()
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        body = request.body
+        if (
+            stream
+            or self.cache.mode == "off"
+            or request.method.upper() not in self.cache.methods
+            or not (body is None or isinstance(body, (bytes, str)))
+        ):
+            return super().send(request, stream=stream, timeout=timeout,
+                                verify=verify, cert=cert, proxies=proxies)
+
+        def send_upstream(method, url, body, headers):
+            prepared = request.copy()
+            prepared.headers.update(headers)
+            response = super(CachingAdapter, self).send(
+                prepared, stream=False, timeout=timeout, verify=verify, cert=cert, proxies=proxies
+            )
+            return response.status_code, response.reason, dict(response.headers), response.content
+
+        cached = self.cache.fetch(request.method, request.url, body, {}, send=send_upstream)
+        return self._build(request, cached)
+
+    def _build(self, request, cached):
+        response = requests.Response()
+        response.status_code = cached.status
+        response.reason = cached.reason
+        response.headers = CaseInsensitiveDict(cached.headers)
+        response.headers.pop("Content-Encoding", None)  # content is decoded
+        response.headers[CACHE_HEADER] = cached.cache_status
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(cached.content)
+        response._content = cached.content
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+
+def cached_session(cache=None, pool_size=10):
+    """Cached Session
+    Arguments:
+        - cache (HTTPCache): store, `default_cache()` if None
+        - pool_size (int): connections kept alive per host
+    Returns:
+        - session (requests.Session): with a `CachingAdapter` mounted for
+          http and https
+    """
+    session = requests.Session()
+    adapter = CachingAdapter(cache, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# 4. Stand-in Server
+def make_server(cache=None, host="127.0.0.1", port=STANDIN_PORT, upstream=None, latency=0.0):
+    """Make Server
+    Arguments:
+        - cache (HTTPCache): store to replay, `default_cache()` if None
+        - host (str), port (int): address to listen on, port 0 picks a
+          free one
+        - upstream (str): base URL (e.g. "https://maayanlab.cloud") that
+          relative request paths are resolved against; proxy requests
+          carry the absolute URL and do not need it
+        - latency (float): seconds added to every response, to mimic the
+          real server
+    Returns:
+        - server (ThreadingHTTPServer): call `serve_forever()`; requests
+          that were never recorded get a 504
+    """
+    cache = cache if cache is not None else default_cache()
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _replay(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else None
+            if self.path.startswith(("http://", "https://")):
+                url = self.path
+            else:
+                url = upstream.rstrip("/") + self.path if upstream else None
+            entry = cache.lookup(cache.key(self.command, url, body)) if url else None
+            if latency:
+                time.sleep(latency)
+
+            if entry is None:
+                content = f"Err {self.command} {url or self.path} not recorded".encode("utf-8")
+                self.send_response(504)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+                return
+
+            headers = CaseInsensitiveDict(entry["headers"])
+            if "ETag" in headers and self.headers.get("If-None-Match") == headers["ETag"]:
+                self.send_response(304)
+                self.send_header("ETag", headers["ETag"])
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            content = cache.read_body(entry)
+            self.send_response(entry["status"], entry["reason"])
+            for name, value in entry["headers"].items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(content)
+
+        do_GET = do_POST = do_HEAD = _replay
+
+        def log_message(self, format, *args):
+            logging.debug(f"{self.address_string()} {format % args}")
+
+    server = ThreadingHTTPServer((host, port), StandInHandler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(cache=None, host="127.0.0.1", port=STANDIN_PORT, upstream=None, latency=0.0):
+    """Runs the stand-in server until interrupted, see `make_server`."""
+    server = make_server(cache, host=host, port=port, upstream=upstream, latency=latency)
+    logging.info(
+        f"Replaying {(cache or default_cache()).cache_dir} on "
+        f"http://{host}:{server.server_address[1]}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    if len(sys.argv) < 2 or sys.argv[1] != "serve":
+        sys.exit("usage: python http_cache.py serve [port] [upstream]")
+    serve(
+        port=int(sys.argv[2]) if len(sys.argv) > 2 else STANDIN_PORT,
+        upstream=sys.argv[3] if len(sys.argv) > 3 else None,
+    )
@@ -12,18 +12,31 @@ Structure:
 
 # 1. Imports, Variables, Functions
 # imports
-import requests, os
+import requests, os, json, hashlib
 import pandas as pd
 import logging, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from signature_store import write_signature_matrix
+import http_cache
+import instrumentation
+from instrumentation import stage
 
 # Reconfigure logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 logging.info("iLINCS Freeze: CSV")
+instrumentation.instrument_http()
 
 # variabels
 OUTPUT_PATH = "../data/iLINCS"
+CHECKPOINT_PATH = os.path.join(OUTPUT_PATH, "signature_vectors.checkpoints")
+SIGNATURE_MATRIX_PATH = os.path.join(OUTPUT_PATH, "signature_matrix")
+N_WORKERS = 8
+# responses are recorded under ../data/cache/http and replayed on reruns,
+# see http_cache for the HTTP_CACHE_MODE options
+HTTP_CACHE = http_cache.default_cache()
+SESSION = http_cache.cached_session(HTTP_CACHE)
 
 
 # functions
@@ -41,7 +54,7 @@ def get_signatures():
     """
     url = "http://www.ilincs.org/api/SignatureMeta?"
     url = "http://www.ilincs.org/api/SignatureMeta?"
-    response = requests.get(url)
+    response = SESSION.get(url)
     if response.status_code == 200:
         data = response.json()
         return data
@@ -64,7 +77,7 @@ def get_datasets():
     """
     # url = 'http://www.ilincs.org/api/PublicDatasets?filter={"limit":1000}'
     url = "http://www.ilincs.org/api/PublicDatasets?"
-    response = requests.get(url)
+    response = SESSION.get(url)
     if response.status_code == 200:
         return response.json()
     else:
@@ -85,7 +98,7 @@ def get_genes():
         A list of dictionaries, each representing a gene. Returns None in case of failure.
     """
     url = "http://www.ilincs.org/api/GeneInfos?"
-    response = requests.get(url)
+    response = SESSION.get(url)
     if response.status_code == 200:
         return response.json()
     else:
@@ -105,7 +118,7 @@ def get_compounds():
     - List[Dict]: A list of dictionaries, each representing a compound. Returns None in case of failure.
     """
     url = "http://www.ilincs.org/api/Compounds?"
-    response = requests.get(url)
+    response = SESSION.get(url)
     if response.status_code == 200:
         
         return response.json()
@@ -263,21 +276,265 @@ def download_batch_signature_data(
     return processed_data
 
 
+def get_session(pool_size):
+    """
+    get_session
+    Creates an HTTP session whose connection pool is sized for `pool_size`
+    concurrent workers, so connections are reused between batches. Requests
+    go through `HTTP_CACHE` (POST batches are only recorded if its
+    `methods` include POST).
+
+    Parameters:
+    - pool_size: int
+        Number of connections kept alive in the pool.
+
+    Returns:
+    - session: requests.Session
+    """
+    session = requests.Session()
+    adapter = http_cache.CachingAdapter(
+        HTTP_CACHE, pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def save_checkpoint(batch_ids, batch_data, checkpoint_path):
+    """
+    save_checkpoint
+    Writes one finished batch to its own JSON file. The file is written to a
+    temporary name first and then renamed, so a crash never leaves a
+    half-written checkpoint behind.
+
+    Parameters:
+    - batch_ids: list of str
+        Signature IDs requested in the batch.
+    - batch_data: dict
+        Dictionary with SignatureID -> [{}]
+    - checkpoint_path: str
+        Directory holding the checkpoint files.
+
+    Returns:
+    - filename: str
+    """
+    batch_key = hashlib.sha1(",".join(sorted(batch_ids)).encode("utf-8")).hexdigest()
+    filename = os.path.join(checkpoint_path, f"batch_{batch_key}.json")
+    with open(filename + ".tmp", "w") as f:
+        json.dump({"signature_ids": list(batch_ids), "data": batch_data}, f)
+    os.replace(filename + ".tmp", filename)
+    return filename
+
+
+def load_checkpoints(checkpoint_path):
+    """
+    load_checkpoints
+    Reads every finished batch from the checkpoint directory.
+
+    Parameters:
+    - checkpoint_path: str
+        Directory holding the checkpoint files.
+
+    Returns:
+    - finished_ids: set of str
+        Signature IDs whose batch already finished.
+    - processed_data: dict
+        Dictionary with SignatureID -> [{}]
+    """
+    finished_ids = set()
+    processed_data = {}
+    if not os.path.isdir(checkpoint_path):
+        return finished_ids, processed_data
+
+    for filename in sorted(os.listdir(checkpoint_path)):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(checkpoint_path, filename)) as f:
+                checkpoint = json.load(f)
+        except ValueError:
+            logging.warning(f"Skipping unreadable checkpoint {filename}")
+            continue
+        finished_ids.update(checkpoint["signature_ids"])
+        for signatureID, items in checkpoint["data"].items():
+            processed_data.setdefault(signatureID, []).extend(items)
+
+    return finished_ids, processed_data
+
+
+def download_signature_batch(
+    session, batch_ids, no_of_top_genes, display, retries=10, timeout=300, parent=None
+):
+    """
+    Download a single batch of iLINCS Signature Data, retrying with
+    exponential backoff.
+
+    Arguments:
+    - session: requests.Session
+        Session used to post the request
+    - batch_ids: list of str
+        List of signature IDs in the batch
+    - no_of_top_genes: int
+        Number of top differentially expressed genes
+    - display: bool
+        Whether to display the data
+    - retries: int
+        Number of attempts before giving up on the batch
+    - timeout: int
+        Request timeout in seconds
+    - parent: instrumentation.Stage
+        Stage the batch is traced under
+
+    Returns:
+    - batch_data: dict
+        Dictionary with SignatureID -> [{}]. None if every attempt failed.
+    """
+    endpoint = "http://www.ilincs.org/api/ilincsR/downloadSignature"
+    data = {
+        "sigID": ",".join(batch_ids),
+        "noOfTopGenes": no_of_top_genes,
+        "display": display,
+    }
+
+    with stage(
+        "ilincs.download_batch", parent=parent, items=len(batch_ids), batch=batch_ids[0]
+    ) as batch_stage:
+        for attempt in range(retries):
+            try:
+                response = session.post(endpoint, data=data, timeout=timeout)
+                if response.status_code == 200:
+                    batch_data = {}
+                    for item in response.json()["data"]["signature"]:
+                        batch_data.setdefault(item["signatureID"], []).append(item)
+                    batch_stage.set(attempts=attempt + 1)
+                    return batch_data
+                logging.error(f"Error in batch {batch_ids[0]}: {response.status_code}, {response.text}")
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                logging.error(f"Timeout occurred in batch {batch_ids[0]}, attempt {attempt + 1}")
+            except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+                # malformed or unexpected body: count as a failed attempt
+                # instead of aborting the whole pooled run
+                logging.error(f"Error in batch {batch_ids[0]}, attempt {attempt + 1}: {e!r}")
+            if attempt < retries - 1:
+                time.sleep(2 ** attempt)  # Exponential backoff
+
+        batch_stage.set(attempts=retries, failed=True)
+        return None
+
+
+def download_batch_signature_data_concurrent(
+    signature_ids,
+    no_of_top_genes,
+    display,
+    batch_size=10,
+    n_workers=N_WORKERS,
+    checkpoint_path=CHECKPOINT_PATH,
+    retries=10,
+    timeout=300,
+):
+    """
+    Download iLINCS Signature Data - concurrent & resumable
+
+    Batches are posted by a bounded pool of `n_workers` threads sharing a
+    pooled session. Every finished batch is checkpointed to
+    `checkpoint_path`; signature IDs found there are skipped on a rerun.
+
+    Arguments:
+    - signature_ids: list of str
+        List of signature IDs
+    - no_of_top_genes: int
+        Number of top differentially expressed genes
+    - display: bool
+        Whether to display the data
+    - batch_size: int
+        Number of signatures to download in each batch
+    - n_workers: int
+        Number of batches downloaded at the same time
+    - checkpoint_path: str
+        Directory where finished batches are stored
+    - retries: int
+        Number of attempts per batch
+    - timeout: int
+        Request timeout in seconds
+
+    Returns:
+    - processed_data: dict
+        Dictionary with SignatureID -> [{}]
+    """
+    os.makedirs(checkpoint_path, exist_ok=True)
+    finished_ids, processed_data = load_checkpoints(checkpoint_path)
+
+    pending_ids = [s for s in signature_ids if s not in finished_ids]
+    batches = [
+        list(pending_ids[i : i + batch_size])
+        for i in range(0, len(pending_ids), batch_size)
+    ]
+    logging.info(
+        f"{len(finished_ids)} signatures already downloaded, {len(batches)} batches pending"
+    )
+
+    session = get_session(n_workers)
+    failed_batches = 0
+    with stage("ilincs.download", batches=len(batches)) as download_stage, \
+            ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {
+            executor.submit(
+                download_signature_batch,
+                session,
+                batch_ids,
+                no_of_top_genes,
+                display,
+                retries,
+                timeout,
+                download_stage,
+            ): batch_ids
+            for batch_ids in batches
+        }
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            batch_ids = futures[future]
+            batch_data = future.result()
+            if batch_data is None:
+                failed_batches += 1
+                continue
+            with stage("ilincs.save_checkpoint", items=len(batch_ids)):
+                save_checkpoint(batch_ids, batch_data, checkpoint_path)
+            for signatureID, items in batch_data.items():
+                processed_data.setdefault(signatureID, []).extend(items)
+            download_stage.add_items(len(batch_ids))
+            logging.info(
+                f"Batch {n_done}/{len(batches)}, "
+                f"{download_stage.items / download_stage.elapsed:.1f} signatures/s"
+            )
+
+    if failed_batches:
+        logging.error(f"{failed_batches} batches failed, rerun to resume them")
+
+    return processed_data
+
+
 # 2. Retrieve Data
 # get signatures
-signatures = get_signatures()
+with stage("ilincs.get_signatures") as s:
+    signatures = get_signatures()
+    s.add_items(len(signatures))
 logging.info(f"Nº Retrieved Signatures {len(signatures)}")
 
 # get datasets
-datasets = get_datasets()
+with stage("ilincs.get_datasets") as s:
+    datasets = get_datasets()
+    s.add_items(len(datasets))
 logging.info(f"Nº Retrieved Datasets {len(datasets)}")
 
 # get genes
-genes = get_genes()
+with stage("ilincs.get_genes") as s:
+    genes = get_genes()
+    s.add_items(len(genes))
 logging.info(f"Nº Retrieved Genes {len(genes)}")
 
 # get compounds
-compounds = get_compounds()
+with stage("ilincs.get_compounds") as s:
+    compounds = get_compounds()
+    s.add_items(len(compounds))
 logging.info(f"Nº Retrieved Compounds {len(compounds)}")
 
 # get signature vectors for diseases
@@ -289,27 +546,40 @@ disease_signatureIDs = df_signatures[df_signatures["libraryid"] == "LIB_1"][
 logging.info(f"Nº Disease Signatures {len(disease_signatureIDs)}")
 
 # download signature data
-signature_vectors = download_batch_signature_data(signature_ids=disease_signatureIDs, 
-                                                  no_of_top_genes=100000,
-                                                  display=True, 
-                                                  batch_size=10)
+signature_vectors = download_batch_signature_data_concurrent(
+    signature_ids=disease_signatureIDs.tolist(),
+    no_of_top_genes=100000,
+    display=True,
+    batch_size=10,
+    n_workers=N_WORKERS,
+    checkpoint_path=CHECKPOINT_PATH,
+)
 
 # 3. Parse & Store Data
 # parse & store signatures
-df_signatures = save_to_csv(signatures, os.path.join(OUTPUT_PATH, "signatures.csv"))
+with stage("ilincs.save_csv", items=len(signatures), file="signatures.csv"):
+    df_signatures = save_to_csv(signatures, os.path.join(OUTPUT_PATH, "signatures.csv"))
 
 # parse & store datasets
-df_datasets = save_to_csv(datasets, os.path.join(OUTPUT_PATH, "datasets.csv"))
+with stage("ilincs.save_csv", items=len(datasets), file="datasets.csv"):
+    df_datasets = save_to_csv(datasets, os.path.join(OUTPUT_PATH, "datasets.csv"))
 
 # parse & store genes
-df_genes = save_to_csv(genes, os.path.join(OUTPUT_PATH, "genes.csv"))
+with stage("ilincs.save_csv", items=len(genes), file="genes.csv"):
+    df_genes = save_to_csv(genes, os.path.join(OUTPUT_PATH, "genes.csv"))
 
 # parse & store compounds
-df_compounds = save_to_csv(compounds, os.path.join(OUTPUT_PATH, "compounds.csv"))
+with stage("ilincs.save_csv", items=len(compounds), file="compounds.csv"):
+    df_compounds = save_to_csv(compounds, os.path.join(OUTPUT_PATH, "compounds.csv"))
 
 # parse & store signature vectors
-for signature_id, data in signature_vectors.items():
-    df_signature = save_to_csv(
-        data=data, 
-        filename=os.path.join(OUTPUT_PATH, "signature_vectors" ,f"{signature_id}.csv")
+# single gene x signature matrix, load with signature_store.load_signature_matrix
+with stage("ilincs.write_signature_matrix", items=len(signature_vectors)):
+    signature_matrix = write_signature_matrix(
+        path=SIGNATURE_MATRIX_PATH, signature_vectors=signature_vectors
     )
+logging.info(f"Stored signature matrix {signature_matrix.shape} in {SIGNATURE_MATRIX_PATH}")
+
+# per-stage time, memory, I/O and HTTP summary + JSON trace in ../results/traces
+logging.info(f"HTTP cache: {dict(HTTP_CACHE.stats)}")
+instrumentation.finish("iLINCS.freeze")
@@ -0,0 +1,499 @@
+"""Instrumentation
+Per-stage accounting for the pipeline entry points (iLINCS freeze,
+Harmonizome downloads, MeSH mapping, ingest, benchmarks), so long runs show
+where the hours go.
+
+A stage is a named block of work, used as a context manager or decorator.
+For every stage the tracer records:
+    - wall time and CPU time (process-wide, so worker threads are included)
+    - resident memory at start/end and its peak, sampled in the background
+    - bytes read/written (`/proc/self/io`: all read/write calls, and the
+      part that actually hit the disk)
+    - HTTP requests, errors, bytes and latencies (see `instrument_http`)
+    - optional item counts, giving items/s throughput (e.g. per batch)
+
+Stages nest: the parent defaults to the innermost open stage of the
+current thread, and can be passed explicitly for work submitted to a
+thread pool. At the end of a run `finish` writes a JSON trace (stage
+records plus Chrome `traceEvents`, viewable in chrome://tracing or
+Perfetto) and logs a per-stage summary table.
+
+Usage:
+    instrumentation.instrument_http()
+    with stage("ilincs.get_signatures") as s:
+        signatures = get_signatures()
+        s.add_items(len(signatures))
+    instrumentation.finish("iLINCS.freeze")
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Probes
+    3. Stages
+    4. Tracer
+    5. HTTP
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import datetime
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# variables
+TRACE_PATH = os.path.join("..", "results", "traces")
+SAMPLE_INTERVAL = 0.05
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+_IO_FIELDS = {
+    "rchar": "read_bytes",
+    "wchar": "write_bytes",
+    "read_bytes": "disk_read_bytes",
+    "write_bytes": "disk_write_bytes",
+}
+
+
+# 2. Probes
+def read_rss():
+    """Read RSS
+    Returns:
+        - rss (int): resident set size in bytes; the peak so far where the
+          current value is not available
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        pass
+    if resource is None:
+        return 0
+    return max_rss()
+
+
+def max_rss():
+    """Max RSS
+    Returns:
+        - rss (int): peak resident set size of the process in bytes
+    """
+    if resource is None:
+        return 0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss if os.uname().sysname == "Darwin" else maxrss * 1024
+
+
+def read_io():
+    """Read IO
+    Returns:
+        - counters (dict): read_bytes/write_bytes (all read and write
+          calls, sockets included) and disk_read_bytes/disk_write_bytes;
+          empty where `/proc/self/io` is not available
+    """
+    counters = dict()
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in _IO_FIELDS:
+                    counters[_IO_FIELDS[key]] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+# 3. Stages
+class Stage:
+    """Named block of work, see `Tracer.stage`.
+
+    Used as a decorator, every call of the function opens a fresh stage
+    with the same name and attributes.
+    """
+
+    def __init__(self, tracer, name, parent=None, items=None, **attrs):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.items = items
+        self.attrs = attrs
+        self.http = list()
+        self.record = None
+
+    def add_items(self, n):
+        """Adds `n` processed items (signatures, rows, files...) to the
+        stage, reported as items/s."""
+        self.items = (self.items or 0) + n
+
+    def set(self, **attrs):
+        """Attaches attributes (batch id, file name...) to the record."""
+        self.attrs.update(attrs)
+
+    @property
+    def elapsed(self):
+        """Seconds since the stage was opened, e.g. for progress logs."""
+        return time.perf_counter() - self._wall
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Stage(self.tracer, self.name, self.parent, self.items, **self.attrs):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def __enter__(self):
+        self._io = read_io()
+        self._rss = read_rss()
+        self.peak_rss = self._rss
+        self.tracer._open(self)
+        self._start = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        rss = read_rss()
+        io = read_io()
+        self.tracer._close(self)
+        self.peak_rss = max(self.peak_rss, rss)
+
+        latencies = np.array([h["latency_s"] for h in self.http], dtype=float)
+        self.record = {
+            "name": self.name,
+            "parent": self.parent.name if self.parent is not None else None,
+            "thread": self._thread,
+            "start": self._start,
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "rss_start": self._rss,
+            "rss_end": rss,
+            "peak_rss": self.peak_rss,
+            **{k: io[k] - self._io[k] for k in io if k in self._io},
+            "http_requests": len(self.http),
+            "http_errors": sum(h["error"] for h in self.http),
+            "http_bytes": sum(h["bytes"] or 0 for h in self.http),
+            "http_latency_s": latencies.tolist(),
+            "items": self.items,
+            "items_per_s": self.items / wall if self.items and wall else None,
+            "error": exc_type.__name__ if exc_type is not None else None,
+            "attrs": {k: v if isinstance(v, (int, float, str, bool)) or v is None else str(v)
+                      for k, v in self.attrs.items()},
+        }
+        self.tracer._add(self.record)
+        return False
+
+
+# 4. Tracer
+class Tracer:
+    """Sink collecting stage records, see the module docstring."""
+
+    def __init__(self, sample_interval=SAMPLE_INTERVAL):
+        """
+        Arguments:
+            - sample_interval (float): seconds between RSS samples while a
+              stage is open
+        """
+        self.sample_interval = sample_interval
+        self.records = list()
+        self.http = list()
+        self._lock = threading.Lock()
+        self._stacks = dict()
+        self._open_stages = list()
+        self._sampler = None
+        self._stop = None
+        self._started = time.time()
+
+    def stage(self, name, parent=None, items=None, **attrs):
+        """Stage
+        Arguments:
+            - name (str): stage name, dotted by pipeline, e.g.
+              "ilincs.download_batch"; records with the same name are
+              aggregated in the summary
+            - parent (Stage): enclosing stage, defaults to the innermost
+              open stage of this thread; pass it for thread pool work
+            - items (int): number of items the stage processes
+            - attrs: extra attributes stored with the record
+        Returns:
+            - stage (Stage): context manager / decorator
+        """
+        return Stage(self, name, parent=parent, items=items, **attrs)
+
+    def current_stage(self):
+        """Returns the innermost open stage of this thread, or None."""
+        stack = self._stacks.get(threading.get_ident())
+        return stack[-1] if stack else None
+
+    def _open(self, stage):
+        with self._lock:
+            stack = self._stacks.setdefault(threading.get_ident(), list())
+            if stage.parent is None and stack:
+                stage.parent = stack[-1]
+            stage._thread = threading.current_thread().name
+            stack.append(stage)
+            self._open_stages.append(stage)
+            if self._sampler is None:
+                self._stop = threading.Event()
+                self._sampler = threading.Thread(
+                    target=self._sample, args=(self._stop,), name="rss-sampler", daemon=True
+                )
+                self._sampler.start()
+
+    def _close(self, stage):
+        with self._lock:
+            stack = self._stacks[threading.get_ident()]
+            stack.remove(stage)
+            if not stack:
+                del self._stacks[threading.get_ident()]
+            self._open_stages.remove(stage)
+            if not self._open_stages:
+                self._stop.set()
+                self._sampler = None
+
+    def _add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def _sample(self, stop):
+        while not stop.wait(self.sample_interval):
+            rss = read_rss()
+            with self._lock:
+                for stage in self._open_stages:
+                    stage.peak_rss = max(stage.peak_rss, rss)
+
+    def record_http(self, url, method, status, latency, nbytes=None, error=False):
+        """Record HTTP
+        Counts one request towards the open stages of the calling thread and
+        their parents. Requests from threads without an open stage count
+        towards the stages open on the main thread.
+
+        Arguments:
+            - url (str): request URL
+            - method (str): HTTP method
+            - status (int): response status, None if no response came back
+            - latency (float): seconds until the response (or error)
+            - nbytes (int): response body size, None if unknown
+            - error (bool): the request failed (exception or status >= 400)
+        """
+        request = {
+            "url": url, "method": method, "status": status, "latency_s": latency,
+            "bytes": nbytes, "error": bool(error or status is None or status >= 400),
+        }
+        with self._lock:
+            self.http.append(request)
+            stack = self._stacks.get(threading.get_ident())
+            if not stack:
+                stack = self._stacks.get(threading.main_thread().ident)
+            stage = stack[-1] if stack else None
+            while stage is not None:
+                stage.http.append(request)
+                stage = stage.parent
+
+    # reports
+    def summary(self):
+        """Summary
+        Returns:
+            - df (pd.DataFrame): one row per stage name in order of first
+              start: calls, total/mean wall and CPU time, peak RSS, MB
+              read/written, HTTP requests/errors/latency and items/s
+        """
+        columns = [
+            "stage", "calls", "wall_s", "mean_wall_s", "cpu_s", "peak_rss_MB",
+            "read_MB", "write_MB", "http_requests", "http_errors",
+            "http_mean_ms", "http_p95_ms", "items", "items_per_s",
+        ]
+        rows = list()
+        with self._lock:
+            records = sorted(self.records, key=lambda r: r["start"])
+        for name in dict.fromkeys(r["name"] for r in records):
+            group = [r for r in records if r["name"] == name]
+            wall = sum(r["wall_s"] for r in group)
+            latencies = np.concatenate([r["http_latency_s"] for r in group])
+            items = sum(r["items"] or 0 for r in group) if any(r["items"] for r in group) else None
+            rows.append((
+                name,
+                len(group),
+                wall,
+                wall / len(group),
+                sum(r["cpu_s"] for r in group),
+                max(r["peak_rss"] for r in group) / 1024**2,
+                sum(r.get("read_bytes", 0) for r in group) / 1024**2,
+                sum(r.get("write_bytes", 0) for r in group) / 1024**2,
+                sum(r["http_requests"] for r in group),
+                sum(r["http_errors"] for r in group),
+                latencies.mean() * 1000 if len(latencies) else np.nan,
+                np.percentile(latencies, 95) * 1000 if len(latencies) else np.nan,
+                items,
+                items / wall if items and wall else np.nan,
+            ))
+        return pd.DataFrame(rows, columns=columns)
+
+    def to_trace(self, run_name=None):
+        """To Trace
+        Arguments:
+            - run_name (str): name stored with the trace
+        Returns:
+            - trace (dict): run metadata, stage records and Chrome trace
+              events (complete events, microseconds)
+        """
+        with self._lock:
+            records = sorted(self.records, key=lambda r: r["start"])
+            n_http = len(self.http)
+        threads = {t: i for i, t in enumerate(dict.fromkeys(r["thread"] for r in records))}
+        events = [
+            {
+                "name": r["name"], "ph": "X", "pid": os.getpid(), "tid": threads[r["thread"]],
+                "ts": (r["start"] - self._started) * 1e6, "dur": r["wall_s"] * 1e6,
+                "args": {k: v for k, v in r.items() if k not in ("name", "http_latency_s")},
+            }
+            for r in records
+        ]
+        return {
+            "run": run_name,
+            "started": datetime.datetime.fromtimestamp(self._started).isoformat(timespec="seconds"),
+            "pid": os.getpid(),
+            "max_rss": max_rss(),
+            "http_requests": n_http,
+            "stages": records,
+            "traceEvents": events,
+        }
+
+    def write_trace(self, path, run_name=None):
+        """Writes `to_trace` as JSON to `path`, returns `path`."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.to_trace(run_name), f)
+        os.replace(path + ".tmp", path)
+        return path
+
+    def finish(self, run_name, trace_path=TRACE_PATH):
+        """Finish
+        Logs the summary table and writes the JSON trace.
+
+        Arguments:
+            - run_name (str): name of the run, e.g. "iLINCS.freeze"
+            - trace_path (str): directory of the traces, None to skip
+              writing
+        Returns:
+            - path (str): trace file, None if not written
+        """
+        df = self.summary()
+        with pd.option_context("display.width", 200, "display.max_columns", None):
+            logging.info(f"{run_name} stages:\n{df.round(3).to_string(index=False)}")
+        if trace_path is None:
+            return None
+        timestamp = datetime.datetime.fromtimestamp(self._started).strftime("%Y%m%d-%H%M%S")
+        path = self.write_trace(os.path.join(trace_path, f"{run_name}.{timestamp}.json"), run_name)
+        logging.info(f"Wrote trace to {path}")
+        return path
+
+    def reset(self):
+        with self._lock:
+            self.records = list()
+            self.http = list()
+            self._started = time.time()
+
+
+TRACER = Tracer()
+
+
+def stage(name, parent=None, items=None, **attrs):
+    """Opens a stage on the default tracer, see `Tracer.stage`."""
+    return TRACER.stage(name, parent=parent, items=items, **attrs)
+
+
+def current_stage():
+    return TRACER.current_stage()
+
+
+def record_http(url, method, status, latency, nbytes=None, error=False):
+    """Records a request on the default tracer, see `Tracer.record_http`."""
+    TRACER.record_http(url, method, status, latency, nbytes=nbytes, error=error)
+
+
+def finish(run_name, trace_path=TRACE_PATH):
+    """Summarizes and writes the default tracer, see `Tracer.finish`."""
+    return TRACER.finish(run_name, trace_path=trace_path)
+
+
+# 5. HTTP
+_http_instrumented = False
+
+
+def _content_length(headers):
+    length = headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+
+def instrument_http():
+    """Instrument HTTP
+    Times every request sent through `requests` (sessions and the
+    module-level helpers) and `urllib.request.urlopen`, and records it with
+    `record_http`. Latency is the time until the response (headers only
+    for streamed responses). Responses replayed by `http_cache` are not
+    counted. Safe to call more than once.
+    """
+    global _http_instrumented
+    if _http_instrumented:
+        return
+    _http_instrumented = True
+
+    import urllib.error
+    import urllib.request
+
+    open_url = urllib.request.OpenerDirector.open
+
+    @functools.wraps(open_url)
+    def timed_open(self, fullurl, *args, **kwargs):
+        url = fullurl if isinstance(fullurl, str) else fullurl.full_url
+        method = "GET" if isinstance(fullurl, str) else fullurl.get_method()
+        start = time.perf_counter()
+        try:
+            response = open_url(self, fullurl, *args, **kwargs)
+        except urllib.error.HTTPError as e:
+            record_http(url, method, e.code, time.perf_counter() - start)
+            raise
+        except Exception:
+            record_http(url, method, None, time.perf_counter() - start)
+            raise
+        record_http(url, method, response.status, time.perf_counter() - start,
+                    _content_length(response.headers))
+        return response
+
+    urllib.request.OpenerDirector.open = timed_open
+
+    try:
+        import requests
+    except ImportError:
+        return
+    send = requests.Session.send
+
+    @functools.wraps(send)
+    def timed_send(self, request, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = send(self, request, **kwargs)
+        except Exception:
+            record_http(request.url, request.method, None, time.perf_counter() - start)
+            raise
+        if response.headers.get("X-HTTP-Cache") == "HIT":
+            return response  # replayed by http_cache, never sent
+        if kwargs.get("stream"):
+            nbytes = _content_length(response.headers)
+        else:
+            nbytes = len(response.content or b"")
+        record_http(request.url, request.method, response.status_code,
+                    time.perf_counter() - start, nbytes)
+        return response
+
+    requests.Session.send = timed_send
@@ -0,0 +1,197 @@
+"""MeSH Embedding
+Maps free-text disease names to MeSH terms by cosine similarity of spaCy
+document vectors.
+
+MeSH terms are embedded once into a normalized float32 matrix that is cached
+on disk, keyed by MeSH release, spaCy model and term list. All query diseases
+are then scored with one batched matrix product and top-k selection, instead
+of re-embedding every MeSH term for every query.
+
+Structure:
+    1. Imports, Variables, Functions
+    2. MeSH Embedding Index
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+# variables
+BATCH_SIZE = 1024
+
+
+# functions
+def embed_texts(nlp, texts, batch_size=BATCH_SIZE):
+    """Embed Texts
+    Embeds texts with a spaCy model. Only the tokenizer and static vectors
+    are needed for `doc.vector`, so the other pipeline components are skipped.
+
+    Arguments:
+        - nlp (spacy.Language): loaded spaCy model
+        - texts (list): list of strings
+        - batch_size (int): nº of texts per spaCy batch
+    Returns:
+        - vectors (np.array): float32 matrix, one row per text
+    """
+    vectors = np.zeros((len(texts), nlp.vocab.vectors_length), dtype=np.float32)
+    for i, doc in enumerate(
+        nlp.pipe(texts, batch_size=batch_size, disable=nlp.pipe_names)
+    ):
+        vectors[i] = doc.vector
+    return vectors
+
+
+def normalize_rows(vectors):
+    """Normalize Rows
+    L2-normalizes each row; all-zero rows (no known tokens) stay zero so
+    they score 0, as `Doc.similarity` does.
+
+    Arguments:
+        - vectors (np.array): matrix of vectors
+    Returns:
+        - vectors (np.array): float32 matrix with unit-norm rows
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def top_k(scores, k):
+    """Top K
+    Arguments:
+        - scores (np.array): queries x candidates matrix
+        - k (int): nº of candidates kept per query
+    Returns:
+        - idxs (np.array): queries x k candidate indexes, best first
+        - top_scores (np.array): queries x k scores, best first
+    """
+    k = min(k, scores.shape[1])
+    idxs = np.argpartition(scores, -k, axis=1)[:, -k:]
+    top_scores = np.take_along_axis(scores, idxs, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return (
+        np.take_along_axis(idxs, order, axis=1),
+        np.take_along_axis(top_scores, order, axis=1),
+    )
+
+
+def _terms_key(terms, model_name):
+    h = hashlib.sha1(model_name.encode("utf-8"))
+    for term in terms:
+        h.update(term.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()[:16]
+
+
+# 2. MeSH Embedding Index
+class MeshEmbeddingIndex:
+    """Normalized embedding matrix of MeSH terms."""
+
+    def __init__(self, terms, vectors):
+        self.terms = list(terms)
+        self.vectors = normalize_rows(vectors)
+        self._term_idx = {t: i for i, t in enumerate(self.terms)}
+
+    @classmethod
+    def build(cls, nlp, terms, release, cache_dir=None):
+        """Build
+        Embeds `terms` or loads them from the on-disk cache.
+
+        Arguments:
+            - nlp (spacy.Language): loaded spaCy model
+            - terms (list): MeSH terms
+            - release (str): MeSH release, e.g. "desc2023"
+            - cache_dir (str): cache directory, None disables caching
+        Returns:
+            - index (MeshEmbeddingIndex)
+        """
+        terms = list(terms)
+        model_name = f"{nlp.meta.get('name', 'model')}-{nlp.meta.get('version', '')}"
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(
+                cache_dir,
+                f"mesh_embeddings.{release}.{model_name}.{_terms_key(terms, model_name)}.npy",
+            )
+            if os.path.exists(cache_path):
+                logging.info(f"Loading cached MeSH embeddings from {cache_path}")
+                return cls(terms, np.load(cache_path))
+
+        logging.info(f"Embedding {len(terms)} MeSH terms")
+        index = cls(terms, embed_texts(nlp, terms))
+
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(cache_path + ".tmp.npy", index.vectors)
+            os.replace(cache_path + ".tmp.npy", cache_path)
+        return index
+
+    def score(self, query_vectors):
+        """Score
+        Arguments:
+            - query_vectors (np.array): queries x dims matrix
+        Returns:
+            - scores (np.array): queries x terms cosine similarities
+        """
+        return normalize_rows(query_vectors) @ self.vectors.T
+
+    def search(self, queries, query_vectors, k=5, batch_size=BATCH_SIZE):
+        """Search
+        Scores queries in batches, keeping the k best terms per query. Exact
+        string matches score 1.0, as with `Doc.similarity`.
+
+        Arguments:
+            - queries (list): query strings
+            - query_vectors (np.array): queries x dims matrix
+            - k (int): nº of candidates per query
+            - batch_size (int): nº of queries scored per matrix product
+        Returns:
+            - idxs (np.array): queries x k term indexes, best first
+            - scores (np.array): queries x k scores, best first
+        """
+        k = min(k, len(self.terms))
+        idxs = np.empty((len(queries), k), dtype=np.int64)
+        scores = np.empty((len(queries), k), dtype=np.float32)
+
+        for start in range(0, len(queries), batch_size):
+            stop = start + batch_size
+            batch_scores = self.score(query_vectors[start:stop])
+            for row, query in enumerate(queries[start:stop]):
+                if query in self._term_idx:
+                    batch_scores[row, self._term_idx[query]] = 1.0
+            idxs[start:stop], scores[start:stop] = top_k(batch_scores, k)
+
+        return idxs, scores
+
+    def map_diseases(self, nlp, diseases, k=5):
+        """Map Diseases
+        Arguments:
+            - nlp (spacy.Language): loaded spaCy model
+            - diseases (list): disease names
+            - k (int): nº of candidates per disease
+        Returns:
+            - df (pd.DataFrame): disease, mesh_term, score plus the top-k
+              candidates as JSON lists (top_k_mesh_terms, top_k_scores)
+        """
+        diseases = list(diseases)
+        idxs, scores = self.search(diseases, embed_texts(nlp, diseases), k=k)
+        terms = np.array(self.terms, dtype=object)
+
+        return pd.DataFrame(
+            {
+                "disease": diseases,
+                "mesh_term": terms[idxs[:, 0]],
+                "score": scores[:, 0],
+                "top_k_mesh_terms": [json.dumps(list(t)) for t in terms[idxs]],
+                "top_k_scores": [
+                    json.dumps([round(float(s), 6) for s in row]) for row in scores
+                ],
+            }
+        )
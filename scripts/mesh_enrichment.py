@@ -0,0 +1,178 @@
+"""MeSH Enrichment
+Over-representation of MeSH (or Disease Ontology) terms among the k closest
+signatures of every query signature, for all queries and all k at once.
+
+Term annotations are a sparse boolean signature x term membership matrix.
+The neighbour sets of every (query, k) are rows of a sparse selection
+matrix, so a single sparse product gives all overlap counts. Only the
+non-zero overlaps are tested, with a vectorized one-sided hypergeometric
+test (identical to Fisher's exact test for over-representation), and
+Benjamini-Hochberg is applied per (query, k) over every annotated term.
+
+Background and draws only count annotated signatures: N is the nº of
+signatures with at least one term, n the nº of annotated neighbours.
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Sparse Membership
+    3. Enrichment
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy import stats
+
+# variables
+KS = (1, 3, 10, 50)
+SEPARATOR = "."
+
+
+# functions
+def _truncate(term, level):
+    return SEPARATOR.join(term.split(SEPARATOR)[:level])
+
+
+# 2. Sparse Membership
+def membership_matrix(signature_terms, terms=None, level=None):
+    """Membership Matrix
+    Arguments:
+        - signature_terms (list): list of terms per signature, e.g.
+          `dsaids_2_mesh_tree_terms[d]` or `dsaids_2_doids[d]`
+        - terms (list): term universe (columns), defaults to the sorted
+          terms found; terms outside it are ignored
+        - level (int): truncate MeSH tree numbers to their first `level`
+          components (1 is the category), None keeps them whole
+    Returns:
+        - membership (sp.csr_matrix): signatures x terms boolean matrix
+        - terms (np.array): term of each column
+    """
+    if level is not None:
+        signature_terms = [{_truncate(t, level) for t in s} for s in signature_terms]
+    if terms is None:
+        terms = sorted({t for s in signature_terms for t in s})
+    terms = np.asarray(terms, dtype=object)
+
+    lengths = np.fromiter(map(len, signature_terms), dtype=np.int64)
+    rows = np.repeat(np.arange(len(signature_terms)), lengths)
+    cols = pd.Index(terms).get_indexer([t for s in signature_terms for t in s])
+    keep = cols >= 0
+    membership = sp.csr_matrix(
+        (np.ones(keep.sum(), dtype=bool), (rows[keep], cols[keep])),
+        shape=(len(signature_terms), len(terms)),
+    )
+    # duplicated terms within a signature count once
+    membership.sum_duplicates()
+    membership.data[:] = True
+    return membership, terms
+
+
+def selection_matrix(neighbors, n_signatures, ks=KS):
+    """Selection Matrix
+    Arguments:
+        - neighbors (np.array): queries x k_max neighbour indexes, closest
+          first (e.g. from `similarity.top_k_neighbors`), -1 is ignored
+        - n_signatures (int): nº of signatures (columns)
+        - ks (tuple): neighbourhood sizes
+    Returns:
+        - selection (sp.csr_matrix): (queries * len(ks)) x signatures, row
+          q * len(ks) + i selects the first ks[i] neighbours of query q
+    """
+    neighbors = np.asarray(neighbors, dtype=np.int64)
+    n_queries, k_max = neighbors.shape
+    ks = np.asarray(ks, dtype=np.int64)
+    if (ks > k_max).any():
+        raise ValueError(f"Err k larger than the {k_max} neighbours given")
+
+    rank = np.arange(k_max)
+    # (query, k, rank) -> selected if rank < k
+    mask = rank[None, None, :] < ks[None, :, None]
+    mask = mask & (neighbors[:, None, :] >= 0)
+    q, i, r = np.nonzero(np.broadcast_to(mask, (n_queries, len(ks), k_max)))
+    return sp.csr_matrix(
+        (np.ones(len(q), dtype=np.int32), (q * len(ks) + i, neighbors[q, r])),
+        shape=(n_queries * len(ks), n_signatures),
+    )
+
+
+# 3. Enrichment
+def _bh_rows(p_values, indptr, n_tests):
+    """BH per CSR row, the untested terms count as p = 1."""
+    n_rows = len(indptr) - 1
+    lengths = np.diff(indptr)
+    if len(p_values) == 0:
+        return p_values.copy()
+    row = np.repeat(np.arange(n_rows), lengths)
+    col = np.arange(len(p_values)) - indptr[row]
+
+    padded = np.full((n_rows, lengths.max()), np.inf)
+    padded[row, col] = p_values
+    order = np.argsort(padded, axis=1, kind="stable")
+    ranked = np.take_along_axis(padded, order, axis=1)
+    ranked = ranked * n_tests / np.arange(1, padded.shape[1] + 1)
+    ranked = np.minimum.accumulate(ranked[:, ::-1], axis=1)[:, ::-1]
+
+    adjusted = np.empty_like(padded)
+    np.put_along_axis(adjusted, order, ranked, axis=1)
+    return np.minimum(adjusted[row, col], 1.0)
+
+
+def enrichment(membership, neighbors, ks=KS, terms=None, queries=None, min_overlap=1):
+    """Enrichment
+    Arguments:
+        - membership (sp.csr_matrix): signatures x terms, see
+          `membership_matrix`
+        - neighbors (np.array): queries x k_max neighbour indexes into the
+          signatures, closest first, -1 is ignored
+        - ks (tuple): neighbourhood sizes
+        - terms (np.array): term labels, defaults to column indexes
+        - queries (np.array): query labels, defaults to row indexes
+        - min_overlap (int): only report terms seen in at least this many
+          neighbours (overlaps of 0 are never enriched)
+    Returns:
+        - df (pd.DataFrame): one row per (query, k, term) with overlap,
+          n_neighbors, term_size, n_background, fold_enrichment, p_value,
+          adj_p_value
+    """
+    membership = sp.csr_matrix(membership, dtype=np.int32)
+    neighbors = np.asarray(neighbors, dtype=np.int64)
+    ks = tuple(ks)
+    n_signatures, n_terms = membership.shape
+
+    annotated = np.asarray(membership.sum(axis=1)).ravel() > 0
+    term_size = np.asarray(membership.sum(axis=0)).ravel()
+    n_background = int(annotated.sum())
+    n_tests = int((term_size > 0).sum())
+
+    selection = selection_matrix(neighbors, n_signatures, ks)
+    n_neighbors = selection @ annotated.astype(np.int32)
+    overlap = (selection @ membership).tocsr()
+    overlap.sort_indices()
+
+    row = np.repeat(np.arange(overlap.shape[0]), np.diff(overlap.indptr))
+    x = overlap.data
+    K = term_size[overlap.indices]
+    n = n_neighbors[row]
+    p_values = stats.hypergeom.sf(x - 1, n_background, K, n)
+    adj_p_values = _bh_rows(p_values, overlap.indptr, n_tests)
+
+    keep = x >= min_overlap
+    row = row[keep]
+    terms = np.arange(n_terms) if terms is None else np.asarray(terms, dtype=object)
+    queries = np.arange(len(neighbors)) if queries is None else np.asarray(queries)
+    return pd.DataFrame(
+        {
+            "query": queries[row // len(ks)],
+            "k": np.asarray(ks)[row % len(ks)],
+            "term": terms[overlap.indices[keep]],
+            "overlap": x[keep],
+            "n_neighbors": n[keep],
+            "term_size": K[keep],
+            "n_background": n_background,
+            "fold_enrichment": (x[keep] / n[keep]) / (K[keep] / n_background),
+            "p_value": p_values[keep],
+            "adj_p_value": adj_p_values[keep],
+        }
+    )
@@ -0,0 +1,296 @@
+"""MeSH Hierarchy
+Index over MeSH tree numbers for the ontology labels of the disease
+similarity benchmark (`mesh_1`, `mesh_2`, `mesh_levels`).
+
+Every tree number and all of its prefixes become nodes of a trie with
+integer ids (node 0 is a virtual root above the 16 MeSH categories). The
+trie is flattened into an Euler tour with a sparse table of range minima
+over node depths, so the lowest common ancestor of any two nodes, and with
+it the shared level, closeness and steps of the notebook helpers, is a
+couple of array lookups. All queries are vectorized over numpy arrays.
+
+Equivalences with `DiSignAtlas.MeSH_Enrichment.ipynb`:
+    - check_common_mesh_terms(l1, l2, level) == shared_level >= level
+    - check_mesh_level(l1, level) == max_level >= level
+    - get_mesh_closeness(t1, t2) == closeness(t1, t2)
+    - get_mesh_steps(...) == steps matrix at those indexes
+
+Structure:
+    1. Imports, Variables, Functions
+    2. MeSH Hierarchy
+    3. Signature Labels
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import numpy as np
+import pandas as pd
+
+from mesh_parser import load_mesh_lookup
+
+# variables
+SEPARATOR = "."
+BLOCK_SIZE = 256
+LABELS = ("shared_level", "steps")
+
+
+# functions
+def load_mesh_hierarchy(mesh_xml_file_path, cache_dir=None, extra_tree_numbers=()):
+    """Load MeSH Hierarchy
+    Arguments:
+        - mesh_xml_file_path (str): path to the MeSH descriptor XML
+        - cache_dir (str): lookup cache directory, see `load_mesh_lookup`
+        - extra_tree_numbers (list): tree numbers missing from the XML
+          (e.g. from an older MeSH release) to add to the trie
+    Returns:
+        - hierarchy (MeshHierarchy)
+    """
+    lookup = load_mesh_lookup(mesh_xml_file_path, cache_dir=cache_dir)
+    return MeshHierarchy([*lookup["tree_number_2_term"], *extra_tree_numbers])
+
+
+# 2. MeSH Hierarchy
+class MeshHierarchy:
+    """Trie over MeSH tree numbers with constant-time LCA queries."""
+
+    def __init__(self, tree_numbers):
+        """
+        Arguments:
+            - tree_numbers (list): tree numbers, their prefixes are added too
+        """
+        prefixes = {""}
+        for tree_number in tree_numbers:
+            parts = tree_number.split(SEPARATOR)
+            for i in range(1, len(parts) + 1):
+                prefixes.add(SEPARATOR.join(parts[:i]))
+        # sorted so that node ids do not depend on the input order, the
+        # virtual root "" comes first
+        self.tree_numbers = np.array(sorted(prefixes), dtype=object)
+        self._index = pd.Index(self.tree_numbers)
+
+        n = len(self.tree_numbers)
+        self.depth = np.zeros(n, dtype=np.int32)
+        self.parent = np.full(n, -1, dtype=np.int64)
+        for i, tree_number in enumerate(self.tree_numbers[1:], start=1):
+            parent, _, _ = tree_number.rpartition(SEPARATOR)
+            self.parent[i] = self._index.get_loc(parent)
+            self.depth[i] = self.depth[self.parent[i]] + 1
+
+        self._build_euler_tour()
+
+    def _build_euler_tour(self):
+        n = len(self.tree_numbers)
+        # children as CSR over the parent array
+        order = np.argsort(self.parent[1:], kind="stable") + 1
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.add.at(indptr, self.parent[1:] + 1, 1)
+        indptr = np.cumsum(indptr)
+
+        euler = np.empty(2 * n - 1, dtype=np.int64)
+        self.first = np.empty(n, dtype=np.int64)
+        next_child = indptr[:-1].copy()
+        stack, t = [0], 0
+        self.first[0] = 0
+        euler[0] = 0
+        while stack:
+            node = stack[-1]
+            if next_child[node] < indptr[node + 1]:
+                child = order[next_child[node]]
+                next_child[node] += 1
+                stack.append(child)
+                t += 1
+                self.first[child] = t
+                euler[t] = child
+            else:
+                stack.pop()
+                if stack:
+                    t += 1
+                    euler[t] = stack[-1]
+
+        # sparse[k, i] = shallowest node in euler[i : i + 2**k]
+        n_levels = max(1, int(np.log2(len(euler))) + 1)
+        self._sparse = np.empty((n_levels, len(euler)), dtype=np.int64)
+        self._sparse[0] = euler
+        for k in range(1, n_levels):
+            half = 1 << (k - 1)
+            a = self._sparse[k - 1]
+            b = np.concatenate([a[half:], a[-half:]])
+            self._sparse[k] = np.where(self.depth[b] < self.depth[a], b, a)
+        self._log2 = np.zeros(len(euler) + 1, dtype=np.int64)
+        self._log2[2:] = np.log2(np.arange(2, len(euler) + 1)).astype(np.int64)
+
+    def __len__(self):
+        return len(self.tree_numbers)
+
+    def node_ids(self, tree_numbers):
+        """Node IDs
+        Arguments:
+            - tree_numbers (list): tree numbers
+        Returns:
+            - node_ids (np.array): node id of each tree number
+        """
+        node_ids = self._index.get_indexer(np.asarray(tree_numbers, dtype=object))
+        if (node_ids < 0).any():
+            missing = np.asarray(tree_numbers, dtype=object)[node_ids < 0]
+            raise KeyError(f"Err unknown tree numbers: {list(missing[:5])}")
+        return node_ids
+
+    def _as_nodes(self, x):
+        x = np.asarray(x)
+        if x.dtype.kind in "iu":
+            return x.astype(np.int64)
+        return self.node_ids(x.ravel()).reshape(x.shape)
+
+    def lca(self, u, v):
+        """Lowest Common Ancestor
+        Arguments:
+            - u (np.array): node ids or tree numbers
+            - v (np.array): node ids or tree numbers, broadcast against `u`
+        Returns:
+            - lca (np.array): node id of the lowest common ancestor, 0 (the
+              virtual root) if they do not share a MeSH category
+        """
+        first_u, first_v = self.first[self._as_nodes(u)], self.first[self._as_nodes(v)]
+        lo, hi = np.minimum(first_u, first_v), np.maximum(first_u, first_v)
+        k = self._log2[hi - lo + 1]
+        a = self._sparse[k, lo]
+        b = self._sparse[k, hi - (1 << k) + 1]
+        return np.where(self.depth[b] < self.depth[a], b, a)
+
+    def shared_level(self, u, v):
+        """Shared Level
+        Nº of leading tree number components two terms have in common.
+
+        Arguments:
+            - u (np.array): node ids or tree numbers
+            - v (np.array): node ids or tree numbers
+        Returns:
+            - shared_level (np.array): 0 when the MeSH categories differ
+        """
+        return self.depth[self.lca(u, v)]
+
+    def closeness(self, u, v):
+        """Closeness
+        Same as `get_mesh_closeness`: path length through the common
+        ancestor, plus one when neither term is an ancestor of the other.
+
+        Arguments:
+            - u (np.array): node ids or tree numbers
+            - v (np.array): node ids or tree numbers
+        Returns:
+            - closeness (np.array): float, NaN when the MeSH categories differ
+        """
+        u, v = self._as_nodes(u), self._as_nodes(v)
+        depth_u, depth_v = self.depth[u], self.depth[v]
+        common = self.depth[self.lca(u, v)]
+        closeness = depth_u + depth_v - 2 * common + (common < np.minimum(depth_u, depth_v))
+        return np.where(common > 0, closeness, np.nan)
+
+    def steps(self, tree_numbers_1, tree_numbers_2):
+        """Steps
+        Smallest closeness between two lists of tree numbers, as computed
+        per pair of signatures by `get_mesh_steps`.
+
+        Arguments:
+            - tree_numbers_1 (list): tree numbers
+            - tree_numbers_2 (list): tree numbers
+        Returns:
+            - steps (float): NaN if no pair shares a MeSH category
+        """
+        if len(tree_numbers_1) == 0 or len(tree_numbers_2) == 0:
+            return np.nan
+        closeness = self.closeness(
+            self._as_nodes(tree_numbers_1)[:, None], self._as_nodes(tree_numbers_2)[None, :]
+        )
+        return np.nan if np.isnan(closeness).all() else float(np.nanmin(closeness))
+
+    # 3. Signature Labels
+    def _flatten(self, signature_tree_numbers):
+        """Flattens lists of tree numbers keeping signatures with at least one."""
+        lengths = np.fromiter(map(len, signature_tree_numbers), dtype=np.int64)
+        present = np.flatnonzero(lengths > 0)
+        nodes = self._as_nodes(
+            [t for i in present for t in signature_tree_numbers[i]]
+        ).astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths[present])])
+        return present, nodes, offsets
+
+    def max_level(self, signature_tree_numbers):
+        """Max Level
+        Deepest level among each signature's tree numbers, so
+        `check_mesh_level(terms, level)` is `max_level >= level`.
+
+        Arguments:
+            - signature_tree_numbers (list): list of tree numbers per signature
+        Returns:
+            - max_level (np.array): 0 for signatures without tree numbers
+        """
+        present, nodes, offsets = self._flatten(signature_tree_numbers)
+        max_level = np.zeros(len(signature_tree_numbers), dtype=np.int32)
+        if len(present):
+            max_level[present] = np.maximum.reduceat(self.depth[nodes], offsets[:-1])
+        return max_level
+
+    def signature_matrices(
+        self, signature_tree_numbers, other_tree_numbers=None, labels=LABELS,
+        block_size=BLOCK_SIZE,
+    ):
+        """Signature Matrices
+        Signature x signature ontology labels, reduced over the tree
+        numbers of each signature:
+            - shared_level: deepest level shared by any pair of tree numbers
+              (`check_common_mesh_terms(l1, l2, level)` is
+              `shared_level >= level`)
+            - steps: smallest closeness over pairs sharing a MeSH category,
+              as in `get_mesh_steps`
+
+        Arguments:
+            - signature_tree_numbers (list): list of tree numbers per signature
+            - other_tree_numbers (list): column signatures, defaults to the
+              row signatures
+            - labels (tuple): labels to compute, see `LABELS`
+            - block_size (int): row signatures per block, bounds memory
+        Returns:
+            - matrices (dict): label -> float32 matrix, NaN where a
+              signature has no tree numbers (and for steps, where no
+              category is shared)
+        """
+        unknown = set(labels) - set(LABELS)
+        if unknown:
+            raise ValueError(f"Err unknown labels: {sorted(unknown)}")
+        if other_tree_numbers is None:
+            other_tree_numbers = signature_tree_numbers
+
+        rows, row_nodes, row_offsets = self._flatten(signature_tree_numbers)
+        cols, col_nodes, col_offsets = self._flatten(other_tree_numbers)
+        shape = (len(signature_tree_numbers), len(other_tree_numbers))
+        matrices = {label: np.full(shape, np.nan, dtype=np.float32) for label in labels}
+        if len(rows) == 0 or len(cols) == 0:
+            return matrices
+
+        depth_cols = self.depth[col_nodes][None, :]
+        for start in range(0, len(rows), block_size):
+            stop = min(start + block_size, len(rows))
+            lo, hi = row_offsets[start], row_offsets[stop]
+            block_nodes = row_nodes[lo:hi, None]
+            block_offsets = row_offsets[start:stop] - lo
+            common = self.depth[self.lca(block_nodes, col_nodes[None, :])]
+
+            if "shared_level" in labels:
+                shared = np.maximum.reduceat(common, col_offsets[:-1], axis=1)
+                shared = np.maximum.reduceat(shared, block_offsets, axis=0)
+                matrices["shared_level"][np.ix_(rows[start:stop], cols)] = shared
+
+            if "steps" in labels:
+                depth_rows = self.depth[block_nodes]
+                closeness = (
+                    depth_rows + depth_cols - 2 * common
+                    + (common < np.minimum(depth_rows, depth_cols))
+                ).astype(np.float32)
+                closeness[common == 0] = np.inf
+                steps = np.minimum.reduceat(closeness, col_offsets[:-1], axis=1)
+                steps = np.minimum.reduceat(steps, block_offsets, axis=0)
+                steps[np.isinf(steps)] = np.nan
+                matrices["steps"][np.ix_(rows[start:stop], cols)] = steps
+
+        return matrices
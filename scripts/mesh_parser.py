@@ -0,0 +1,164 @@
+"""MeSH Parser
+Streaming parser for MeSH descriptor XML files (e.g. desc2023.xml).
+
+Descriptors are read one at a time with `iterparse` and cleared as soon as
+they are processed, so memory stays flat instead of holding the whole tree.
+The resulting lookup tables are pickled next to a checksum of the XML, so
+later loads skip parsing altogether.
+
+Lookup tables:
+    - term_2_tree_numbers: MeSH term -> list of tree numbers
+    - tree_number_2_term: tree number -> MeSH term
+    - term_2_synonyms: MeSH term -> list of entry terms
+    - term_2_scope: MeSH term -> scope note of the preferred concept
+    - term_2_ui: MeSH term -> descriptor UI
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Parse MeSH Descriptors
+    3. Cached Lookup
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import hashlib
+import logging
+import os
+import pickle
+import xml.etree.ElementTree as ET
+
+# variables
+CHUNK_SIZE = 1 << 20
+CACHE_VERSION = 1
+
+
+# functions
+def file_checksum(path, chunk_size=CHUNK_SIZE):
+    """File Checksum
+    Arguments:
+        - path (str): file path
+        - chunk_size (int): bytes read at a time
+    Returns:
+        - checksum (str): sha256 hex digest of the file
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# 2. Parse MeSH Descriptors
+def iter_mesh_descriptors(mesh_xml_file_path):
+    """Iterate MeSH Descriptors
+    Arguments:
+        - mesh_xml_file_path (str): path to the MeSH descriptor XML
+    Yields:
+        - descriptor (dict): ui, term, tree_numbers, synonyms, scope
+    """
+    context = ET.iterparse(mesh_xml_file_path, events=("start", "end"))
+    _, root = next(context)
+
+    for event, elem in context:
+        if event != "end" or elem.tag != "DescriptorRecord":
+            continue
+
+        term = elem.findtext("DescriptorName/String")
+        synonyms = list()
+        scope = None
+        for concept in elem.iterfind("ConceptList/Concept"):
+            if concept.get("PreferredConceptYN") == "Y":
+                scope = concept.findtext("ScopeNote")
+                scope = scope.strip() if scope else None
+            for synonym in concept.iterfind("TermList/Term/String"):
+                if synonym.text != term and synonym.text not in synonyms:
+                    synonyms.append(synonym.text)
+
+        yield {
+            "ui": elem.findtext("DescriptorUI"),
+            "term": term,
+            "tree_numbers": [t.text for t in elem.iterfind("TreeNumberList/TreeNumber")],
+            "synonyms": synonyms,
+            "scope": scope,
+        }
+
+        # free the processed record and its reference from the root
+        elem.clear()
+        root.clear()
+
+
+def parse_mesh_descriptors(mesh_xml_file_path):
+    """Parse MeSH Descriptors
+    Arguments:
+        - mesh_xml_file_path (str): path to the MeSH descriptor XML
+    Returns:
+        - lookup (dict): lookup tables, see module docstring
+    """
+    lookup = {
+        "term_2_tree_numbers": dict(),
+        "tree_number_2_term": dict(),
+        "term_2_synonyms": dict(),
+        "term_2_scope": dict(),
+        "term_2_ui": dict(),
+    }
+    for descriptor in iter_mesh_descriptors(mesh_xml_file_path):
+        term = descriptor["term"]
+        lookup["term_2_tree_numbers"][term] = descriptor["tree_numbers"]
+        for tree_number in descriptor["tree_numbers"]:
+            lookup["tree_number_2_term"][tree_number] = term
+        lookup["term_2_synonyms"][term] = descriptor["synonyms"]
+        lookup["term_2_scope"][term] = descriptor["scope"]
+        lookup["term_2_ui"][term] = descriptor["ui"]
+    return lookup
+
+
+# 3. Cached Lookup
+def load_mesh_lookup(mesh_xml_file_path, cache_dir=None):
+    """Load MeSH Lookup
+    Returns the lookup tables from the cache if one matches the XML's
+    checksum, otherwise parses the XML and writes the cache.
+
+    Arguments:
+        - mesh_xml_file_path (str): path to the MeSH descriptor XML
+        - cache_dir (str): cache directory, defaults to `<xml dir>/cache`
+    Returns:
+        - lookup (dict): lookup tables, see module docstring
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(mesh_xml_file_path), "cache")
+    name = os.path.splitext(os.path.basename(mesh_xml_file_path))[0]
+    checksum = file_checksum(mesh_xml_file_path)
+    cache_path = os.path.join(
+        cache_dir, f"{name}.v{CACHE_VERSION}.{checksum[:16]}.lookup.pkl"
+    )
+
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+
+    logging.info(f"Parsing {mesh_xml_file_path}")
+    lookup = parse_mesh_descriptors(mesh_xml_file_path)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_path + ".tmp", "wb") as f:
+        pickle.dump(lookup, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_path + ".tmp", cache_path)
+    logging.info(f"Cached MeSH lookup to {cache_path}")
+
+    return lookup
+
+
+def build_mesh_term_tree_number_mapping(mesh_xml_file_path, cache_dir=None):
+    """Build MeSH Term <-> Tree Number Mapping
+    Drop-in replacement for the `ET.parse` based helper used in the scripts
+    and notebooks.
+
+    Arguments:
+        - mesh_xml_file_path (str): path to the MeSH descriptor XML
+        - cache_dir (str): cache directory, defaults to `<xml dir>/cache`
+    Returns:
+        - mesh_term_2_symbol (dict): MeSH term -> list of tree numbers
+        - mesh_symbol_2_term (dict): tree number -> MeSH term
+    """
+    lookup = load_mesh_lookup(mesh_xml_file_path, cache_dir=cache_dir)
+    return lookup["term_2_tree_numbers"], lookup["tree_number_2_term"]
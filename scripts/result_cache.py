@@ -0,0 +1,293 @@
+"""Result Cache
+Content-addressed cache for expensive benchmark steps, replacing the
+`if os.path.exists(path_pkl): pickle.load(...)` guards of the notebooks.
+
+Entries are keyed by a hash of everything the result depends on: the
+dataset manifest, the transform and its parameters, the metric, the gene
+universe and the code version (source of the functions involved). Changing
+any of them changes the key, so stale results are never reused.
+
+Each entry is a directory of `.npy` files, loaded memory-mapped, plus a
+`meta.json` describing how to rebuild lists/tuples/dicts around them.
+Values numpy cannot store natively (DataFrames, objects) fall back to
+pickle. The cache is bounded by a total size budget: after every write the
+least recently used entries (by `meta.json` mtime, touched on each hit) are
+evicted.
+
+Usage:
+    cache = ResultCache()
+    key = cache.key("pearson", manifest=manifest, transform="iLINCS.100",
+                    code=code_version(similarity.pairwise))
+    scores = cache.get_or_compute(key, lambda: similarity.pairwise(X))
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Hashing
+    3. Result Cache
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+# variables
+CACHE_DIR = os.path.join("..", "data", "cache", "results")
+MAX_BYTES = 20 * 1024**3
+META_FILE = "meta.json"
+_MISSING = object()
+
+
+# 2. Hashing
+def _update_hash(h, value):
+    """Feeds a canonical, type-tagged encoding of `value` into `h`."""
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        h.update(f"{type(value).__name__}:{value!r};".encode())
+    elif isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        h.update(f"ndarray:{value.dtype.str}:{value.shape};".encode())
+        if value.dtype.hasobject:
+            _update_hash(h, value.tolist())
+        else:
+            h.update(memoryview(value).cast("B"))
+    elif isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        h.update(f"{type(value).__name__}:{value.shape};".encode())
+        if isinstance(value, pd.DataFrame):
+            _update_hash(h, [str(c) for c in value.columns])
+            _update_hash(h, [str(d) for d in value.dtypes])
+        h.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+    elif isinstance(value, dict):
+        h.update(f"dict:{len(value)};".encode())
+        for k in sorted(value, key=repr):
+            _update_hash(h, k)
+            _update_hash(h, value[k])
+    elif isinstance(value, (list, tuple)):
+        h.update(f"{type(value).__name__}:{len(value)};".encode())
+        for v in value:
+            _update_hash(h, v)
+    elif isinstance(value, (set, frozenset)):
+        _update_hash(h, sorted(value, key=repr))
+    elif isinstance(value, np.generic):
+        _update_hash(h, value.item())
+    else:
+        raise TypeError(f"Err cannot hash {type(value).__name__} for a cache key")
+
+
+def hash_inputs(*args, **kwargs):
+    """Hash Inputs
+    Arguments:
+        - args, kwargs: str, numbers, arrays, DataFrames/Series and
+          lists/tuples/dicts/sets of them
+    Returns:
+        - key (str): sha256 hex digest
+    """
+    h = hashlib.sha256()
+    _update_hash(h, list(args))
+    _update_hash(h, kwargs)
+    return h.hexdigest()
+
+
+def code_version(*objects):
+    """Code Version
+    Arguments:
+        - objects: functions, classes or modules the result depends on
+    Returns:
+        - version (str): hash of their source code
+    """
+    h = hashlib.sha256()
+    for obj in objects:
+        h.update(inspect.getsource(obj).encode())
+    return h.hexdigest()[:16]
+
+
+# 3. Result Cache
+def _dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _, files in os.walk(path)
+        for f in files
+    )
+
+
+class ResultCache:
+    """Content-addressed, size-bounded, memory-mapped result cache."""
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES, mmap_mode="r"):
+        """
+        Arguments:
+            - cache_dir (str): cache directory
+            - max_bytes (int): total size budget, LRU entries beyond it are
+              evicted
+            - mmap_mode (str): mode arrays are loaded with, None reads them
+              into memory
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.mmap_mode = mmap_mode
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, name, *args, **kwargs):
+        """Key
+        Arguments:
+            - name (str): name of the step, e.g. "pearson"
+            - args, kwargs: every input the result depends on, see
+              `hash_inputs`
+        Returns:
+            - key (str): entry key
+        """
+        return f"{name}-{hash_inputs(name, *args, **kwargs)[:32]}"
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self._path(key), META_FILE))
+
+    # serialization
+    def _dump(self, value, path, name):
+        if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+            np.save(os.path.join(path, f"{name}.npy"), value, allow_pickle=False)
+            return {"type": "npy", "file": f"{name}.npy"}
+        if type(value) in (list, tuple):
+            return {
+                "type": type(value).__name__,
+                "items": [self._dump(v, path, f"{name}.{i}") for i, v in enumerate(value)],
+            }
+        if type(value) is dict and all(isinstance(k, str) for k in value):
+            return {
+                "type": "dict",
+                "items": {
+                    k: self._dump(v, path, f"{name}.{i}")
+                    for i, (k, v) in enumerate(value.items())
+                },
+            }
+        with open(os.path.join(path, f"{name}.pkl"), "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return {"type": "pickle", "file": f"{name}.pkl"}
+
+    def _load(self, spec, path):
+        if spec["type"] == "npy":
+            return np.load(os.path.join(path, spec["file"]), mmap_mode=self.mmap_mode)
+        if spec["type"] == "pickle":
+            with open(os.path.join(path, spec["file"]), "rb") as f:
+                return pickle.load(f)
+        if spec["type"] == "dict":
+            return {k: self._load(v, path) for k, v in spec["items"].items()}
+        items = [self._load(v, path) for v in spec["items"]]
+        return tuple(items) if spec["type"] == "tuple" else items
+
+    # access
+    def get(self, key, default=None):
+        """Get
+        Arguments:
+            - key (str): entry key
+            - default: returned on a miss
+        Returns:
+            - value: cached value, arrays memory-mapped
+        """
+        path = self._path(key)
+        meta_path = os.path.join(path, META_FILE)
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return default
+        os.utime(meta_path)
+        return self._load(meta["value"], path)
+
+    def put(self, key, value):
+        """Put
+        Arguments:
+            - key (str): entry key
+            - value: ndarray, DataFrame or list/tuple/dict of them (anything
+              else is pickled)
+        Returns:
+            - value: the stored value as `get` returns it
+        """
+        path = self._path(key)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        spec = self._dump(value, tmp_path, "value")
+        meta = {"key": key, "value": spec, "created": time.time(),
+                "size": _dir_size(tmp_path)}
+        with open(os.path.join(tmp_path, META_FILE), "w") as f:
+            json.dump(meta, f)
+
+        if key in self:
+            shutil.rmtree(tmp_path)
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+            os.replace(tmp_path, path)
+        self.evict(keep=key)
+        return self.get(key)
+
+    def get_or_compute(self, key, compute):
+        """Get or Compute
+        Arguments:
+            - key (str): entry key, see `key`
+            - compute (callable): called without arguments on a miss
+        Returns:
+            - value: cached or freshly computed (and stored) value
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            logging.info(f"Cache hit {key}")
+            return value
+        logging.info(f"Cache miss {key}")
+        return self.put(key, compute())
+
+    # eviction
+    def entries(self):
+        """Entries
+        Returns:
+            - df (pd.DataFrame): key, size, last_used; most recent first
+        """
+        rows = list()
+        for entry in os.scandir(self.cache_dir):
+            meta_path = os.path.join(entry.path, META_FILE)
+            if not entry.is_dir() or not os.path.exists(meta_path):
+                continue
+            with open(meta_path, "r") as f:
+                size = json.load(f)["size"]
+            rows.append((entry.name, size, os.path.getmtime(meta_path)))
+        df = pd.DataFrame(rows, columns=["key", "size", "last_used"])
+        return df.sort_values("last_used", ascending=False, ignore_index=True)
+
+    def evict(self, max_bytes=None, keep=None):
+        """Evict
+        Removes least recently used entries until the cache fits the budget.
+
+        Arguments:
+            - max_bytes (int): budget, defaults to `self.max_bytes`
+            - keep (str): key never evicted (the entry just written)
+        Returns:
+            - evicted (list): removed keys
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        df = self.entries()
+        total = df["size"].sum()
+        evicted = list()
+        for key, size in zip(df["key"][::-1], df["size"][::-1]):
+            if total <= max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            total -= size
+            evicted.append(key)
+        if evicted:
+            logging.info(f"Evicted {len(evicted)} cache entries, {total / 1024**2:.1f} MB kept")
+        return evicted
+
+    def clear(self):
+        return self.evict(max_bytes=0)
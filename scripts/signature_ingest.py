@@ -0,0 +1,261 @@
+"""Signature Ingest
+Builds the DiSignAtlas signature store from the processed diff files
+(`dsa_diff_download.processed/{dsaid}_alldiff.txt`, or
+`{dsaid}_whole_diff_regulation.csv` when the former is missing).
+
+Log2FC, PValue and AdjPValue are written into a preallocated
+`signature_store` matrix whose rows are the gene registry (human
+protein-coding Entrez IDs). Files are parsed in worker processes that write
+their signature's column straight into the memory-mapped matrices, so
+nothing but a few counters travels back to the parent.
+
+A `manifest.csv` next to the matrices records, per signature, the source
+file with its size and modification time, parsing counters and the dataset
+metadata. On rebuild, signatures whose file is unchanged are copied column
+by column from the previous store and only new or modified files are
+parsed.
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Parse Diff Files
+    3. Build Store
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from gene_registry import load_registry
+from signature_store import create_signature_matrix, load_signature_matrix
+
+# variables
+DATA_PATH = os.path.join("..", "data", "DiSignAtlas", "dsa_diff_download.processed")
+DATA_INFO_PATH = os.path.join(
+    "..", "data", "DiSignAtlas", "Disease_information_Datasets.csv"
+)
+STORE_PATH = os.path.join("..", "data", "DiSignAtlas", "signature_matrix")
+MANIFEST_FILE = "manifest.csv"
+VALUE_NAMES = ("Log2FC", "PValue", "AdjPValue")
+FILE_SUFFIXES = {
+    "_alldiff.txt": ("GeneID", "Log2FC", "PValue", "AdjPValue"),
+    "_whole_diff_regulation.csv": ("geneid", "log2fc", "pvalue", "adjpvalue"),
+}
+COPY_BLOCK = 512
+
+_worker_store = None
+_worker_registry = None
+
+
+# functions
+def list_diff_files(data_path=DATA_PATH):
+    """List Diff Files
+    Arguments:
+        - data_path (str): directory with the processed diff files
+    Returns:
+        - df (pd.DataFrame): dsaid, file, size, mtime_ns; `_alldiff.txt` is
+          preferred when both files exist for a dsaid
+    """
+    rows = dict()
+    for entry in os.scandir(data_path):
+        for priority, suffix in enumerate(FILE_SUFFIXES):
+            if entry.name.endswith(suffix):
+                dsaid = entry.name[: -len(suffix)]
+                if dsaid not in rows or priority < rows[dsaid][0]:
+                    stat = entry.stat()
+                    rows[dsaid] = (priority, entry.name, stat.st_size, stat.st_mtime_ns)
+    return pd.DataFrame(
+        [[dsaid, *row[1:]] for dsaid, row in sorted(rows.items())],
+        columns=["dsaid", "file", "size", "mtime_ns"],
+    )
+
+
+# 2. Parse Diff Files
+def read_diff_file(file_path, remove_duplicates=True):
+    """Read Diff File
+    Same cleaning as `get_signatures` in the notebooks: genes appearing more
+    than once are dropped altogether and rows with a missing value removed.
+
+    Arguments:
+        - file_path (str): `_alldiff.txt` or `_whole_diff_regulation.csv`
+        - remove_duplicates (bool): drop duplicated gene ids
+    Returns:
+        - genes (np.array): int64 Entrez IDs
+        - values (np.array): genes x 3 float32 Log2FC, PValue, AdjPValue
+        - n_duplicates (int): nº of duplicated gene rows in the file
+    """
+    suffix = next(s for s in FILE_SUFFIXES if file_path.endswith(s))
+    gene_column, *value_columns = FILE_SUFFIXES[suffix]
+
+    df = pd.read_csv(
+        file_path,
+        usecols=[gene_column, *value_columns],
+        dtype={c: np.float64 for c in value_columns},
+    )
+    df[gene_column] = pd.to_numeric(df[gene_column], errors="coerce")
+    n_duplicates = int(df.duplicated(subset=[gene_column]).sum())
+
+    if remove_duplicates:
+        df = df.drop_duplicates(subset=[gene_column], keep=False)
+    df = df.dropna(subset=[gene_column, *value_columns])
+
+    genes = df[gene_column].to_numpy(dtype=np.int64)
+    values = df[value_columns].to_numpy(dtype=np.float32)
+    return genes, values, n_duplicates
+
+
+def _init_worker(store_path, registry):
+    global _worker_store, _worker_registry
+    _worker_store = load_signature_matrix(store_path, mmap_mode="r+")
+    _worker_registry = registry
+
+
+def _ingest_task(args):
+    j, file_path, remove_duplicates = args
+    genes, values, n_duplicates = read_diff_file(file_path, remove_duplicates)
+    aligned = _worker_registry.align(genes, values)
+    for k, name in enumerate(VALUE_NAMES):
+        _worker_store.values(name)[:, j] = aligned[:, k]
+    _worker_store.flush()
+    return j, len(genes), int((~np.isnan(aligned[:, 0])).sum()), n_duplicates
+
+
+# 3. Build Store
+def load_manifest(path=STORE_PATH):
+    """Load Manifest
+    Arguments:
+        - path (str): directory of the store
+    Returns:
+        - df (pd.DataFrame): manifest, None if the store does not exist
+    """
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    return pd.read_csv(manifest_path, dtype={"dsaid": str})
+
+
+def _reusable_columns(path, files, genes):
+    """Maps new column -> old column for signatures whose file is unchanged."""
+    manifest = load_manifest(path)
+    if manifest is None:
+        return dict()
+    old = load_signature_matrix(path)
+    if not np.array_equal(old.genes.to_numpy(), genes):
+        logging.info("Gene registry changed, re-parsing every file")
+        return dict()
+
+    merged = files.reset_index().merge(
+        manifest[["dsaid", "file", "size", "mtime_ns"]].assign(
+            old_column=old.positions(manifest["dsaid"])
+        ),
+        on=["dsaid", "file", "size", "mtime_ns"],
+    )
+    return dict(zip(merged["index"], merged["old_column"]))
+
+
+def _copy_columns(old, new, reuse):
+    new_cols = np.fromiter(reuse.keys(), dtype=np.int64)
+    old_cols = np.fromiter(reuse.values(), dtype=np.int64)
+    for name in VALUE_NAMES:
+        src, dst = old.values(name), new.values(name)
+        for i in range(0, len(new_cols), COPY_BLOCK):
+            dst[:, new_cols[i : i + COPY_BLOCK]] = src[:, old_cols[i : i + COPY_BLOCK]]
+    new.flush()
+
+
+def ingest_signatures(
+    data_path=DATA_PATH,
+    path=STORE_PATH,
+    registry=None,
+    dsaids=None,
+    data_info_path=DATA_INFO_PATH,
+    n_jobs=4,
+    remove_duplicates=True,
+):
+    """Ingest Signatures
+    Arguments:
+        - data_path (str): directory with the processed diff files
+        - path (str): directory of the store
+        - registry (GeneRegistry): gene universe, defaults to `load_registry()`
+        - dsaids (list): restrict to these dsaids, None ingests every file
+        - data_info_path (str): dataset metadata merged into the manifest,
+          skipped if missing
+        - n_jobs (int): nº of worker processes, 1 runs in process
+        - remove_duplicates (bool): drop duplicated gene ids
+    Returns:
+        - store (SignatureMatrix): store opened read-only, see
+          `load_manifest` for the per-signature metadata
+    """
+    registry = load_registry() if registry is None else registry
+    files = list_diff_files(data_path)
+    if dsaids is not None:
+        files = files[files["dsaid"].isin(set(dsaids))].reset_index(drop=True)
+
+    reuse = _reusable_columns(path, files, registry.entrez_ids)
+    manifest = load_manifest(path)
+    if (
+        manifest is not None
+        and len(reuse) == len(files) == len(manifest)
+        and all(new == old for new, old in reuse.items())
+    ):
+        logging.info(f"Signature store up to date ({len(files)} signatures)")
+        return load_signature_matrix(path)
+
+    tmp_path = path.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    store = create_signature_matrix(
+        tmp_path, registry.entrez_ids, files["dsaid"], VALUE_NAMES
+    )
+
+    # unchanged signatures
+    counters = np.full((len(files), 3), -1, dtype=np.int64)
+    if reuse:
+        _copy_columns(load_signature_matrix(path), store, reuse)
+        old_counters = manifest.set_index("dsaid")[["n_genes", "n_registered", "n_duplicates"]]
+        reused_dsaids = files["dsaid"].to_numpy()[list(reuse)]
+        counters[list(reuse)] = old_counters.loc[reused_dsaids].to_numpy()
+    logging.info(f"Reused {len(reuse)} signatures from {path}")
+
+    # new or modified signatures
+    tasks = [
+        (j, os.path.join(data_path, file), remove_duplicates)
+        for j, file in enumerate(files["file"])
+        if j not in reuse
+    ]
+    logging.info(f"Parsing {len(tasks)} diff files")
+    if n_jobs == 1:
+        _init_worker(tmp_path, registry)
+        results = list(map(_ingest_task, tasks))
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=_init_worker, initargs=(tmp_path, registry)
+        ) as executor:
+            results = list(executor.map(_ingest_task, tasks, chunksize=16))
+    for j, n_genes, n_registered, n_duplicates in results:
+        counters[j] = (n_genes, n_registered, n_duplicates)
+    store.flush()
+    del store
+
+    # manifest
+    manifest = files.copy()
+    manifest[["n_genes", "n_registered", "n_duplicates"]] = counters
+    if data_info_path and os.path.exists(data_info_path):
+        df_info = pd.read_csv(data_info_path, dtype={"dsaid": str})
+        manifest = manifest.merge(df_info.drop_duplicates("dsaid"), on="dsaid", how="left")
+    manifest.to_csv(os.path.join(tmp_path, MANIFEST_FILE), index=False)
+
+    # swap in the new store
+    old_path = path.rstrip(os.sep) + ".old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    logging.info(f"Signature store with {len(files)} signatures saved to {path}")
+
+    return load_signature_matrix(path)
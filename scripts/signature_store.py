@@ -0,0 +1,231 @@
+"""Signature Store
+Stores many signature vectors as a single gene x signature matrix on disk.
+
+Each value (e.g. Log2FC, p-value) is saved as one `.npy` file in Fortran
+order, so every signature is a contiguous column that can be memory-mapped
+and sliced without parsing. A companion `index.json` holds the gene and
+signature labels.
+
+Layout:
+    <path>/index.json
+    <path>/<value_name>.npy
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Signature Matrix
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# variables
+INDEX_FILE = "index.json"
+ILINCS_GENE_COLUMN = "ID_geneid"
+ILINCS_VALUE_COLUMNS = {
+    "Log2FC": "Value_LogDiffExp",
+    "PValue": "Significance_pvalue",
+}
+
+
+# functions
+def _value_path(path, name):
+    return os.path.join(path, f"{name}.npy")
+
+
+def create_signature_matrix(
+    path, genes, signature_ids, value_names, dtype="float32", fill_value=np.nan
+):
+    """Create Signature Matrix
+    Preallocates an empty, writable store on disk.
+
+    Arguments:
+        - path (str): directory of the store
+        - genes (list): gene ids, one per row
+        - signature_ids (list): signature ids, one per column
+        - value_names (list): names of the values stored (one matrix each)
+        - dtype (str): dtype of the matrices
+        - fill_value (float): initial value of every cell
+    Returns:
+        - store (SignatureMatrix): store opened in `r+` mode
+    """
+    os.makedirs(path, exist_ok=True)
+    genes = [g.item() if isinstance(g, np.generic) else g for g in genes]
+    signature_ids = [str(s) for s in signature_ids]
+
+    for name in value_names:
+        matrix = np.lib.format.open_memmap(
+            _value_path(path, name),
+            mode="w+",
+            dtype=dtype,
+            shape=(len(genes), len(signature_ids)),
+            fortran_order=True,
+        )
+        matrix[:] = fill_value
+        matrix.flush()
+        del matrix
+
+    index = {
+        "genes": genes,
+        "signature_ids": signature_ids,
+        "values": list(value_names),
+        "dtype": str(np.dtype(dtype)),
+    }
+    with open(os.path.join(path, INDEX_FILE + ".tmp"), "w") as f:
+        json.dump(index, f)
+    os.replace(os.path.join(path, INDEX_FILE + ".tmp"), os.path.join(path, INDEX_FILE))
+
+    return SignatureMatrix(path, mmap_mode="r+")
+
+
+def write_signature_matrix(
+    path,
+    signature_vectors,
+    gene_column=ILINCS_GENE_COLUMN,
+    value_columns=ILINCS_VALUE_COLUMNS,
+    dtype="float32",
+):
+    """Write Signature Matrix
+    Writes downloaded signature vectors (SignatureID -> [{}], as returned by
+    the iLINCS downloader) into a single store. Genes are the union over all
+    signatures; genes missing from a signature are left as NaN.
+
+    Arguments:
+        - path (str): directory of the store
+        - signature_vectors (dict): SignatureID -> list of records
+        - gene_column (str): record key holding the gene id
+        - value_columns (dict): value name -> record key holding the value
+        - dtype (str): dtype of the matrices
+    Returns:
+        - store (SignatureMatrix): store opened read-only
+    """
+    signature_ids = list(signature_vectors.keys())
+    genes = pd.Index(
+        sorted({r[gene_column] for records in signature_vectors.values() for r in records})
+    )
+
+    store = create_signature_matrix(
+        path, genes.tolist(), signature_ids, list(value_columns.keys()), dtype=dtype
+    )
+    for j, signature_id in enumerate(signature_ids):
+        df = pd.DataFrame(signature_vectors[signature_id])
+        df = df.drop_duplicates(subset=[gene_column], keep="first")
+        rows = genes.get_indexer(df[gene_column])
+        for name, column in value_columns.items():
+            store.values(name)[rows, j] = df[column].to_numpy(dtype=dtype)
+    store.flush()
+
+    return load_signature_matrix(path)
+
+
+def load_signature_matrix(path, mmap_mode="r"):
+    """Load Signature Matrix
+    Arguments:
+        - path (str): directory of the store
+        - mmap_mode (str): numpy memmap mode, None loads into memory
+    Returns:
+        - store (SignatureMatrix)
+    """
+    return SignatureMatrix(path, mmap_mode=mmap_mode)
+
+
+# 2. Signature Matrix
+class SignatureMatrix:
+    """Gene x signature matrices sharing one gene and signature index."""
+
+    def __init__(self, path, mmap_mode="r"):
+        self.path = path
+        self.mmap_mode = mmap_mode
+
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.genes = pd.Index(index["genes"])
+        self.signature_ids = pd.Index(index["signature_ids"])
+        self.value_names = index["values"]
+        self.dtype = np.dtype(index["dtype"])
+        self._values = dict()
+
+    @property
+    def shape(self):
+        return (len(self.genes), len(self.signature_ids))
+
+    def __len__(self):
+        return len(self.signature_ids)
+
+    def __contains__(self, signature_id):
+        return signature_id in self.signature_ids
+
+    def values(self, name):
+        """Values
+        Arguments:
+            - name (str): value name, e.g. "Log2FC"
+        Returns:
+            - matrix (np.memmap): genes x signatures matrix
+        """
+        if name not in self._values:
+            if name not in self.value_names:
+                raise KeyError(f"'{name}' not stored, available: {self.value_names}")
+            self._values[name] = np.load(
+                _value_path(self.path, name), mmap_mode=self.mmap_mode
+            )
+        return self._values[name]
+
+    def positions(self, signature_ids):
+        """Positions
+        Arguments:
+            - signature_ids (list): signature ids
+        Returns:
+            - positions (np.array): column of each signature
+        """
+        positions = self.signature_ids.get_indexer(list(signature_ids))
+        if (positions < 0).any():
+            missing = [s for s, p in zip(signature_ids, positions) if p < 0]
+            raise KeyError(f"Signatures not in store: {missing[:10]}")
+        return positions
+
+    def get(self, signature_ids=None, name=None, as_frame=True):
+        """Get
+        Fetches a subset of signatures. Columns are contiguous on disk, so
+        only the requested signatures are read.
+
+        Arguments:
+            - signature_ids (list): signature ids, None for all
+            - name (str): value name, defaults to the first stored value
+            - as_frame (bool): return a labelled DataFrame instead of an array
+        Returns:
+            - data (pd.DataFrame | np.array): genes x requested signatures
+        """
+        name = self.value_names[0] if name is None else name
+        matrix = self.values(name)
+
+        if signature_ids is None:
+            signature_ids = self.signature_ids
+            data = np.asarray(matrix)
+        else:
+            signature_ids = list(signature_ids)
+            data = matrix[:, self.positions(signature_ids)]
+
+        if not as_frame:
+            return data
+        return pd.DataFrame(data, index=self.genes, columns=pd.Index(signature_ids))
+
+    def set(self, signature_id, name, values):
+        """Set
+        Writes one signature column; the store must be opened writable.
+
+        Arguments:
+            - signature_id (str): signature id
+            - name (str): value name
+            - values (np.array): values aligned to `genes`
+        """
+        j = self.positions([signature_id])[0]
+        self.values(name)[:, j] = values
+
+    def flush(self):
+        for matrix in self._values.values():
+            if isinstance(matrix, np.memmap):
+                matrix.flush()
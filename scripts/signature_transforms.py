@@ -0,0 +1,365 @@
+"""Signature Transforms
+Matrix-wide versions of the per-signature transforms of the benchmark
+notebooks (`compute_signed_significance`, `compute_extreme_signed_significance`,
+`compute_ranking_log2fc`, `compute_ranking_adj_pvalue`,
+`get_significant_log2fc`, `get_filtered_log2fc`, `get_z_scores`,
+`adjust_p_values`).
+
+Every function takes genes x signatures matrices (the `signature_store`
+layout) and transforms all signatures (columns) at once. NaN marks a gene
+missing from a signature: it is ignored by the transform and stays NaN in
+the output, to be filled with `DEFAULT_VALUES` afterwards. Top/bottom-k
+selections use `np.argpartition` and only sort the k selected genes.
+
+Representations (the `metric_evaluated` names used in `results/figures`)
+are registered by name with `register_transform` and built with
+`apply_transform(name, values)`, where `values` maps "Log2FC", "PValue" and
+"AdjPValue" to matrices, e.g. a `SignatureMatrix` store.
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Transforms
+    3. Transform Registry
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import numpy as np
+from scipy.special import ndtri
+
+# variables
+TRANSFORMS = dict()
+DEFAULT_VALUES = {
+    "PValue": 0.0,
+    "AdjPValue": 1.0,
+    "Log2FC": 0.0,
+    "ReAdjPValue": 0.0,
+    "iLINCS.100": 0.0,
+    "iLINCS.200": 0.0,
+    "iLINCS.all": 0.0,
+    "iLINCS.ReAdj": 0.0,
+    "Ranking.AdjPValue": 0.0,
+    "Ranking.Log2FC": 0.0,
+    "Significant.Log2FC": 0.0,
+    "Significant.Log2FC.ReAdj": 0.0,
+    "Filtered.Log2FC": 0.0,
+}
+
+
+# functions
+def _as_float(X):
+    X = np.asarray(X)
+    return X if X.dtype.kind == "f" else X.astype(np.float64)
+
+
+def _top_k_positions(X, k, largest=True):
+    """Row positions of the k largest (smallest) non-NaN values per column,
+    ordered from the most extreme; `valid` flags positions that are real
+    values (columns with fewer than k values are padded)."""
+    n_rows = X.shape[0]
+    k = min(k, n_rows)
+    if k == 0:
+        empty = np.empty((0, X.shape[1]), dtype=np.int64)
+        return empty, empty.astype(bool)
+    nan = np.isnan(X)
+    key = np.where(nan, np.inf, -X if largest else X)
+
+    part = np.argpartition(key, k - 1, axis=0)[:k] if k < n_rows else np.argsort(key, axis=0)
+    order = np.argsort(np.take_along_axis(key, part, axis=0), axis=0, kind="stable")
+    positions = np.take_along_axis(part, order, axis=0)
+    valid = ~np.take_along_axis(nan, positions, axis=0)
+    return positions, valid
+
+
+# 2. Transforms
+def signed_significance(p_values, log2fc):
+    """Signed Significance
+    sign(Log2FC) * -log10(p); p-values of 0 take the smallest non-zero
+    p-value of their signature, as in `compute_signed_significance`.
+
+    Arguments:
+        - p_values (np.array): genes x signatures p-values
+        - log2fc (np.array): genes x signatures Log2FC
+    Returns:
+        - ss (np.array): genes x signatures signed significance
+    """
+    p_values = _as_float(p_values)
+    min_nonzero = np.nanmin(np.where(p_values > 0, p_values, np.inf), axis=0)
+    p_values = np.where(p_values == 0, min_nonzero[None, :], p_values)
+    with np.errstate(divide="ignore"):
+        return np.sign(log2fc) * -np.log10(p_values)
+
+
+def extreme_signed_significance(ss, k=100):
+    """Extreme Signed Significance
+    Keeps the k highest and k lowest values of each signature, the others
+    are set to 0 (`compute_extreme_signed_significance`).
+
+    Arguments:
+        - ss (np.array): genes x signatures signed significance
+        - k (int): top/bottom k genes, None or 0 keeps every gene
+    Returns:
+        - ess (np.array): genes x signatures extreme signed significance
+    """
+    ss = _as_float(ss)
+    if not k:
+        return ss.copy()
+
+    keep = np.zeros(ss.shape, dtype=bool)
+    cols = np.arange(ss.shape[1])[None, :]
+    for largest in (True, False):
+        positions, valid = _top_k_positions(ss, k, largest=largest)
+        keep[positions[valid], np.broadcast_to(cols, positions.shape)[valid]] = True
+
+    ess = np.where(keep, ss, 0).astype(ss.dtype)
+    ess[np.isnan(ss)] = np.nan
+    return ess
+
+
+def ranking_log2fc(log2fc, n=100, threshold=0.5):
+    """Ranking Log2FC
+    The n highest Log2FC above `threshold` get 1..n (highest = n) and the n
+    lowest below `-threshold` get -n..-1 (lowest = -n), others 0
+    (`compute_ranking_log2fc`).
+
+    Arguments:
+        - log2fc (np.array): genes x signatures Log2FC
+        - n (int): nº of top/bottom genes ranked
+        - threshold (float): minimum absolute Log2FC
+    Returns:
+        - ranking (np.array): genes x signatures ranking
+    """
+    log2fc = _as_float(log2fc)
+    ranking = np.where(np.isnan(log2fc), np.nan, 0.0)
+    cols = np.arange(log2fc.shape[1])[None, :]
+    n_valid = (~np.isnan(log2fc)).sum(axis=0)
+
+    # top: counter over the ascending top-n slice, as in the notebook
+    positions, valid = _top_k_positions(log2fc, n, largest=True)
+    values = np.minimum(n, n_valid)[None, :] - np.arange(positions.shape[0])[:, None]
+    mask = valid & (np.take_along_axis(log2fc, positions, axis=0) > threshold)
+    ranking[positions[mask], np.broadcast_to(cols, positions.shape)[mask]] = values[mask]
+
+    # bottom
+    positions, valid = _top_k_positions(log2fc, n, largest=False)
+    values = np.broadcast_to(-n + np.arange(positions.shape[0])[:, None], positions.shape)
+    mask = valid & (np.take_along_axis(log2fc, positions, axis=0) < -threshold)
+    ranking[positions[mask], np.broadcast_to(cols, positions.shape)[mask]] = values[mask]
+
+    return ranking
+
+
+def ranking_adj_pvalue(adj_p_values, n=200, threshold=0.05):
+    """Ranking Adjusted P-Value
+    The n lowest adjusted p-values below `threshold` get n..1 (lowest = n),
+    others 0 (`compute_ranking_adj_pvalue`).
+
+    Arguments:
+        - adj_p_values (np.array): genes x signatures adjusted p-values
+        - n (int): nº of genes ranked
+        - threshold (float): maximum adjusted p-value
+    Returns:
+        - ranking (np.array): genes x signatures ranking
+    """
+    adj_p_values = _as_float(adj_p_values)
+    ranking = np.where(np.isnan(adj_p_values), np.nan, 0.0)
+    cols = np.arange(adj_p_values.shape[1])[None, :]
+
+    positions, valid = _top_k_positions(adj_p_values, n, largest=False)
+    values = np.broadcast_to(n - np.arange(positions.shape[0])[:, None], positions.shape)
+    mask = valid & (np.take_along_axis(adj_p_values, positions, axis=0) < threshold)
+    ranking[positions[mask], np.broadcast_to(cols, positions.shape)[mask]] = values[mask]
+    return ranking
+
+
+def significant_log2fc(log2fc, adj_p_values, thr_log2fc=0, thr_adj_p_values=0.05):
+    """Significant Log2FC
+    Log2FC where |Log2FC| >= thr_log2fc and adjusted p-value <=
+    thr_adj_p_values, NaN elsewhere (`get_significant_log2fc`).
+
+    Arguments:
+        - log2fc (np.array): genes x signatures Log2FC
+        - adj_p_values (np.array): genes x signatures adjusted p-values
+        - thr_log2fc (float): threshold for Log2FC
+        - thr_adj_p_values (float): threshold for adjusted p-values
+    Returns:
+        - significant_log2fc (np.array): genes x signatures Log2FC
+    """
+    log2fc = _as_float(log2fc)
+    with np.errstate(invalid="ignore"):
+        mask = (np.abs(log2fc) >= thr_log2fc) & (adj_p_values <= thr_adj_p_values)
+    return np.where(mask, log2fc, np.nan)
+
+
+def filtered_log2fc(log2fc, winsorize_limit=0.001):
+    """Filtered Log2FC
+    Winsorizes each signature (`scipy.stats.mstats.winsorize` limits) and
+    min-max scales it to [-1, 1] (`get_filtered_log2fc`).
+
+    Arguments:
+        - log2fc (np.array): genes x signatures Log2FC
+        - winsorize_limit (float): fraction clipped on each tail
+    Returns:
+        - filtered_log2fc (np.array): genes x signatures values in [-1, 1]
+    """
+    log2fc = _as_float(log2fc)
+    n_valid = (~np.isnan(log2fc)).sum(axis=0)
+    sorted_values = np.sort(log2fc, axis=0)  # NaNs last
+
+    low = (winsorize_limit * n_valid).astype(np.int64)
+    high = np.maximum(n_valid - (winsorize_limit * n_valid).astype(np.int64) - 1, 0)
+    cols = np.arange(log2fc.shape[1])
+    lower = sorted_values[np.minimum(low, len(log2fc) - 1), cols]
+    upper = sorted_values[high, cols]
+
+    clipped = np.clip(log2fc, lower[None, :], upper[None, :])
+    span = upper - lower
+    span[span == 0] = 1
+    return 2 * (clipped - lower[None, :]) / span[None, :] - 1
+
+
+def z_scores(p_values):
+    """Z-Scores
+    Two-tailed z-score of each p-value, `norm.ppf(p / 2)` (`get_z_scores`).
+
+    Arguments:
+        - p_values (np.array): p-values
+    Returns:
+        - z_scores (np.array): z-scores
+    """
+    return ndtri(_as_float(p_values) / 2)
+
+
+def adjust_p_values(p_values):
+    """Adjust P-Values
+    Benjamini-Hochberg adjustment within each signature over its non-NaN
+    genes, as `scipy.stats.false_discovery_control` (`adjust_p_values`).
+    Subset the rows first to adjust over a gene universe of interest.
+
+    Arguments:
+        - p_values (np.array): genes x signatures p-values
+    Returns:
+        - adj_p_values (np.array): genes x signatures adjusted p-values
+    """
+    p_values = _as_float(p_values)
+    n_valid = (~np.isnan(p_values)).sum(axis=0)
+
+    order = np.argsort(p_values, axis=0)  # NaNs last
+    sorted_p = np.take_along_axis(p_values, order, axis=0)
+    ranks = np.arange(1, len(p_values) + 1)[:, None]
+    adjusted = sorted_p * n_valid[None, :] / ranks
+
+    # cumulative minimum from the largest p-value down, NaNs excluded
+    adjusted = np.where(np.isnan(adjusted), np.inf, adjusted)
+    adjusted = np.minimum.accumulate(adjusted[::-1], axis=0)[::-1]
+    adjusted = np.minimum(adjusted, 1)
+    adjusted[np.isnan(sorted_p)] = np.nan
+
+    out = np.empty_like(adjusted)
+    np.put_along_axis(out, order, adjusted, axis=0)
+    return out
+
+
+# 3. Transform Registry
+def register_transform(name):
+    """Register Transform
+    Decorator adding a representation to `TRANSFORMS`. The function takes
+    a mapping with "Log2FC", "PValue" and "AdjPValue" matrices.
+
+    Arguments:
+        - name (str): representation name, e.g. "iLINCS.100"
+    """
+
+    def decorator(func):
+        TRANSFORMS[name] = func
+        return func
+
+    return decorator
+
+
+def apply_transform(name, values, fill=False):
+    """Apply Transform
+    Arguments:
+        - name (str): representation name, see `TRANSFORMS`
+        - values (dict | SignatureMatrix): "Log2FC", "PValue", "AdjPValue"
+          genes x signatures matrices
+        - fill (bool): replace NaNs by the representation's default value
+    Returns:
+        - matrix (np.array): genes x signatures representation
+    """
+    if name not in TRANSFORMS:
+        raise KeyError(f"Err unknown transform '{name}', available: {list(TRANSFORMS)}")
+    getter = values.__getitem__ if isinstance(values, dict) else values.values
+    matrix = TRANSFORMS[name](lambda key: np.asarray(getter(key)))
+    if fill:
+        matrix = np.where(np.isnan(matrix), DEFAULT_VALUES.get(name, 0.0), matrix)
+    return matrix
+
+
+@register_transform("Log2FC")
+def _log2fc(get):
+    return get("Log2FC").copy()
+
+
+@register_transform("PValue")
+def _p_value(get):
+    return get("PValue").copy()
+
+
+@register_transform("AdjPValue")
+def _adj_p_value(get):
+    return get("AdjPValue").copy()
+
+
+@register_transform("ReAdjPValue")
+def _re_adj_p_value(get):
+    return adjust_p_values(get("PValue"))
+
+
+@register_transform("iLINCS.100")
+def _ilincs_100(get):
+    return extreme_signed_significance(
+        signed_significance(get("AdjPValue"), get("Log2FC")), k=100
+    )
+
+
+@register_transform("iLINCS.200")
+def _ilincs_200(get):
+    return extreme_signed_significance(
+        signed_significance(get("AdjPValue"), get("Log2FC")), k=200
+    )
+
+
+@register_transform("iLINCS.all")
+def _ilincs_all(get):
+    return signed_significance(get("AdjPValue"), get("Log2FC"))
+
+
+@register_transform("iLINCS.ReAdj")
+def _ilincs_re_adj(get):
+    return signed_significance(adjust_p_values(get("PValue")), get("Log2FC"))
+
+
+@register_transform("Ranking.Log2FC")
+def _ranking_log2fc(get):
+    return ranking_log2fc(get("Log2FC"), n=100, threshold=0.5)
+
+
+@register_transform("Ranking.AdjPValue")
+def _ranking_adj_p_value(get):
+    return ranking_adj_pvalue(get("AdjPValue"), n=200, threshold=0.05)
+
+
+@register_transform("Significant.Log2FC")
+def _significant_log2fc(get):
+    return significant_log2fc(get("Log2FC"), get("AdjPValue"))
+
+
+@register_transform("Significant.Log2FC.ReAdj")
+def _significant_log2fc_re_adj(get):
+    return significant_log2fc(get("Log2FC"), adjust_p_values(get("PValue")))
+
+
+@register_transform("Filtered.Log2FC")
+def _filtered_log2fc(get):
+    return filtered_log2fc(get("Log2FC"), winsorize_limit=0.001)
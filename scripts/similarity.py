@@ -0,0 +1,431 @@
+"""Similarity
+Blocked all-vs-all similarity between signatures (rows) on float32.
+
+Pearson correlation, cosine distance and Euclidean distance are computed as
+matrix products over cache-sized row blocks, so the full N x N matrix never
+has to exist. Per-row top-k neighbours and summary statistics of the unique
+pairs are accumulated while the blocks stream past.
+
+Scores follow the benchmark notebooks: `pearson` is a correlation (higher is
+closer), `cosine` and `euclidean` are distances (lower is closer), matching
+`compute_pearson_correlation`, `compute_cosine_distance` and
+`compute_euclidean_distance`. Inputs must not contain NaNs; rows with zero
+norm (or zero variance for Pearson) score as if orthogonal.
+
+`weighted_pearson` is the p-value weighted correlation of
+`Metric_Benchmarking.ipynb` (`compute_weighted_correlation`), with gene
+weights log(p_x * p_y) = log(p_x) + log(p_y). Because the weights split per
+signature, every weighted moment is a row term plus a matrix product, so
+the kernel is six matrix products per block.
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Blocked Computation
+    3. Streaming Top-K & Summary Statistics
+    4. Weighted Correlation
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# variables
+METRICS = ("pearson", "cosine", "euclidean")
+WEIGHTED_METRIC = "weighted_pearson"
+HIGHER_IS_CLOSER = {
+    "pearson": True,
+    "cosine": False,
+    "euclidean": False,
+    WEIGHTED_METRIC: True,
+}
+BLOCK_SIZE = 1024
+
+
+# functions
+def _check_metric(metric):
+    if metric not in METRICS:
+        raise ValueError(f"Err unknown metric '{metric}', choose from {METRICS}")
+
+
+def prepare(X, metric):
+    """Prepare
+    Converts rows to float32 and applies the per-row part of the metric:
+    centring + unit norm for Pearson, unit norm for cosine, squared norms for
+    Euclidean.
+
+    Arguments:
+        - X (np.array): signatures x genes matrix
+        - metric (str): "pearson", "cosine" or "euclidean"
+    Returns:
+        - X (np.array): prepared float32 matrix
+        - sq_norms (np.array): squared row norms (Euclidean only, else None)
+    """
+    _check_metric(metric)
+    X = np.asarray(X, dtype=np.float32)
+
+    if metric == "euclidean":
+        return X, np.einsum("ij,ij->i", X, X, dtype=np.float64).astype(np.float32)
+
+    if metric == "pearson":
+        X = X - X.mean(axis=1, keepdims=True, dtype=np.float64).astype(np.float32)
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return X / norms, None
+
+
+def block_scores(Xa, Xb, metric, sq_a=None, sq_b=None):
+    """Block Scores
+    Arguments:
+        - Xa (np.array): prepared rows (see `prepare`)
+        - Xb (np.array): prepared rows (see `prepare`)
+        - metric (str): "pearson", "cosine" or "euclidean"
+        - sq_a, sq_b (np.array): squared norms, Euclidean only
+    Returns:
+        - scores (np.array): len(Xa) x len(Xb) float32 scores
+    """
+    dot = Xa @ Xb.T
+    if metric == "pearson":
+        return np.clip(dot, -1, 1, out=dot)
+    if metric == "cosine":
+        return np.clip(1 - dot, 0, 2, out=dot)
+    dist = sq_a[:, None] + sq_b[None, :] - 2 * dot
+    return np.sqrt(np.maximum(dist, 0, out=dist), out=dist)
+
+
+# 2. Blocked Computation
+def iter_blocks(X, Y=None, metric="pearson", block_size=BLOCK_SIZE):
+    """Iterate Blocks
+    Yields the score matrix block by block; with `Y=None`, X is compared
+    against itself.
+
+    Arguments:
+        - X (np.array): signatures x genes matrix
+        - Y (np.array): signatures x genes matrix, optional
+        - metric (str): "pearson", "cosine" or "euclidean"
+        - block_size (int): rows of X (and Y) per block
+    Yields:
+        - (row_start, col_start, scores): block position and float32 scores
+    """
+    Xp, sq_x = prepare(X, metric)
+    Yp, sq_y = (Xp, sq_x) if Y is None else prepare(Y, metric)
+
+    for i in range(0, len(Xp), block_size):
+        Xa = Xp[i : i + block_size]
+        sq_a = None if sq_x is None else sq_x[i : i + block_size]
+        for j in range(0, len(Yp), block_size):
+            sq_b = None if sq_y is None else sq_y[j : j + block_size]
+            yield i, j, block_scores(Xa, Yp[j : j + block_size], metric, sq_a, sq_b)
+
+
+def pairwise(X, Y=None, metric="pearson", block_size=BLOCK_SIZE):
+    """Pairwise
+    Full score matrix, for inputs small enough to hold it in memory.
+
+    Arguments:
+        - X (np.array): signatures x genes matrix
+        - Y (np.array): signatures x genes matrix, optional
+        - metric (str): "pearson", "cosine" or "euclidean"
+        - block_size (int): rows per block
+    Returns:
+        - scores (np.array): len(X) x len(Y) float32 matrix
+    """
+    n_cols = len(X) if Y is None else len(Y)
+    scores = np.empty((len(X), n_cols), dtype=np.float32)
+    for i, j, block in iter_blocks(X, Y, metric, block_size):
+        scores[i : i + block.shape[0], j : j + block.shape[1]] = block
+    if Y is None and metric != "pearson":
+        np.fill_diagonal(scores, 0)
+    elif Y is None:
+        np.fill_diagonal(scores, 1)
+    return scores
+
+
+def upper_triangle(scores):
+    """Upper Triangle
+    Arguments:
+        - scores (np.array): square score matrix
+    Returns:
+        - values (np.array): values above the diagonal, as the notebooks'
+          `compute_*` functions return them
+    """
+    return scores[np.triu_indices_from(scores, k=1)]
+
+
+# 3. Streaming Top-K & Summary Statistics
+class SummaryStats:
+    """Streaming count, mean, std, min, max and histogram of scores."""
+
+    def __init__(self, bins):
+        self.bins = np.asarray(bins, dtype=np.float64)
+        self.histogram = np.zeros(len(self.bins) - 1, dtype=np.int64)
+        self.count = 0
+        self._sum = 0.0
+        self._sum_sq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        if values.size == 0:
+            return
+        values = values.astype(np.float64, copy=False)
+        self.count += values.size
+        self._sum += values.sum()
+        self._sum_sq += np.dot(values, values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.histogram += np.histogram(values, bins=self.bins)[0]
+
+    @property
+    def mean(self):
+        return self._sum / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        if not self.count:
+            return np.nan
+        return np.sqrt(max(self._sum_sq / self.count - self.mean**2, 0))
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "std": self.std,
+            "min": self.min,
+            "max": self.max,
+            "bins": self.bins,
+            "histogram": self.histogram,
+        }
+
+
+def _default_bins(X, Y, metric, n_bins):
+    if metric == "pearson":
+        return np.linspace(-1, 1, n_bins + 1)
+    if metric == "cosine":
+        return np.linspace(0, 2, n_bins + 1)
+    # triangle inequality: |x - y| <= max|x| + max|y|
+    max_x = np.linalg.norm(np.asarray(X, dtype=np.float32), axis=1).max(initial=0)
+    max_y = max_x if Y is None else np.linalg.norm(
+        np.asarray(Y, dtype=np.float32), axis=1
+    ).max(initial=0)
+    return np.linspace(0, max(max_x + max_y, 1e-6) * 1.001, n_bins + 1)
+
+
+def _merge_top_k(best_idx, best_score, idx, score, k, higher):
+    idx = np.concatenate([best_idx, idx], axis=1)
+    score = np.concatenate([best_score, score], axis=1)
+    key = -score if higher else score
+    kk = min(k, score.shape[1])
+    keep = np.argpartition(key, kk - 1, axis=1)[:, :kk]
+    return np.take_along_axis(idx, keep, axis=1), np.take_along_axis(score, keep, axis=1)
+
+
+def top_k_neighbors(
+    X, Y=None, metric="pearson", k=10, block_size=BLOCK_SIZE, n_bins=200, bins=None
+):
+    """Top-K Neighbors
+    Streams over blocks keeping, for each row of X, its k closest rows of Y
+    (X itself when `Y=None`, excluding self-pairs), and summary statistics of
+    every unique pair.
+
+    Arguments:
+        - X (np.array): signatures x genes matrix
+        - Y (np.array): signatures x genes matrix, optional
+        - metric (str): "pearson", "cosine" or "euclidean"
+        - k (int): nº of neighbours per row
+        - block_size (int): rows per block
+        - n_bins (int): nº of histogram bins
+        - bins (np.array): histogram edges, defaults to the metric's range
+    Returns:
+        - indices (np.array): len(X) x k neighbour indexes, closest first
+        - scores (np.array): len(X) x k neighbour scores, closest first
+        - stats (dict): count, mean, std, min, max, bins, histogram of the
+          scores over unique pairs (i < j when Y is None)
+    """
+    _check_metric(metric)
+    higher = HIGHER_IS_CLOSER[metric]
+    n_rows = len(X)
+    n_cols = len(X) if Y is None else len(Y)
+    k = min(k, n_cols - 1 if Y is None else n_cols)
+    fill = -np.inf if higher else np.inf
+
+    indices = np.full((n_rows, 0), -1, dtype=np.int64)
+    scores = np.full((n_rows, 0), fill, dtype=np.float32)
+    stats = SummaryStats(_default_bins(X, Y, metric, n_bins) if bins is None else bins)
+
+    row_best = dict()
+    for i, j, block in iter_blocks(X, Y, metric, block_size):
+        rows = np.arange(i, i + block.shape[0])
+        cols = np.arange(j, j + block.shape[1])
+
+        # summary statistics over unique pairs
+        if Y is None:
+            pair_mask = rows[:, None] < cols[None, :]
+            values = block[pair_mask]
+        else:
+            values = block.ravel()
+        stats.update(values)
+
+        # candidate neighbours
+        if Y is None:
+            block = block.copy()
+            block[rows[:, None] == cols[None, :]] = fill
+        kk = min(k, block.shape[1])
+        key = -block if higher else block
+        part = np.argpartition(key, kk - 1, axis=1)[:, :kk]
+        cand_score = np.take_along_axis(block, part, axis=1)
+        cand_idx = part + j
+
+        best_idx, best_score = row_best.get(i, (indices[rows], scores[rows]))
+        row_best[i] = _merge_top_k(best_idx, best_score, cand_idx, cand_score, k, higher)
+
+    indices = np.empty((n_rows, k), dtype=np.int64)
+    scores = np.empty((n_rows, k), dtype=np.float32)
+    for i, (best_idx, best_score) in row_best.items():
+        key = -best_score if higher else best_score
+        order = np.argsort(key, axis=1, kind="stable")
+        indices[i : i + len(best_idx)] = np.take_along_axis(best_idx, order, axis=1)
+        scores[i : i + len(best_idx)] = np.take_along_axis(best_score, order, axis=1)
+
+    return indices, scores, stats.to_dict()
+
+
+# 4. Weighted Correlation
+def weighted_correlation_reference(x, y, p_values_x, p_values_y):
+    """Weighted Correlation Reference
+    One pair at a time, as `compute_weighted_correlation` in the notebook.
+
+    Arguments:
+        - x, y (np.array): values of two signatures
+        - p_values_x, p_values_y (np.array): p-values of each gene
+    Returns:
+        - r (float): weighted correlation
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    weights = np.log(np.asarray(p_values_x) * np.asarray(p_values_y))
+    mean_x = np.average(x, weights=weights)
+    mean_y = np.average(y, weights=weights)
+    covariance = np.average((x - mean_x) * (y - mean_y), weights=weights)
+    std_x = np.sqrt(np.average((x - mean_x) ** 2, weights=weights))
+    std_y = np.sqrt(np.average((y - mean_y) ** 2, weights=weights))
+    return covariance / (std_x * std_y)
+
+
+def prepare_weighted(X, P, dtype=np.float64):
+    """Prepare Weighted
+    Per-row terms of the weighted correlation. Rows are shifted by their
+    plain mean first (the correlation is shift invariant) to limit
+    cancellation in the moment differences.
+
+    Arguments:
+        - X (np.array): signatures x genes values (e.g. z-scores)
+        - P (np.array): signatures x genes p-values in (0, 1], 1 gives a
+          zero weight (the notebook's fill value for missing genes)
+        - dtype (type): computation dtype
+    Returns:
+        - terms (dict): X, X², log-weights L, L*X and their row sums
+    """
+    X = np.asarray(X, dtype=dtype)
+    X = X - X.mean(axis=1, keepdims=True)
+    L = np.log(np.asarray(P, dtype=dtype))
+    X2 = X * X
+    LX = L * X
+    return {
+        "X": X,
+        "X2": X2,
+        "L": L,
+        "LX": LX,
+        "s": L.sum(axis=1),
+        "u": LX.sum(axis=1),
+        "q": (LX * X).sum(axis=1),
+    }
+
+
+def _slice_terms(terms, start, stop):
+    return {k: v[start:stop] for k, v in terms.items()}
+
+
+def weighted_block_scores(a, b):
+    """Weighted Block Scores
+    Arguments:
+        - a, b (dict): prepared row blocks (see `prepare_weighted`)
+    Returns:
+        - scores (np.array): len(a) x len(b) weighted correlations
+    """
+    W = a["s"][:, None] + b["s"][None, :]
+    Sx = a["u"][:, None] + a["X"] @ b["L"].T
+    Sy = a["L"] @ b["X"].T + b["u"][None, :]
+    Sxx = a["q"][:, None] + a["X2"] @ b["L"].T
+    Syy = a["L"] @ b["X2"].T + b["q"][None, :]
+    Sxy = a["LX"] @ b["X"].T + a["X"] @ b["LX"].T
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_x, mean_y = Sx / W, Sy / W
+        cov = Sxy / W - mean_x * mean_y
+        var_x = np.maximum(Sxx / W - mean_x**2, 0)
+        var_y = np.maximum(Syy / W - mean_y**2, 0)
+        scores = cov / np.sqrt(var_x * var_y)
+    return np.clip(scores, -1, 1, out=scores)
+
+
+def weighted_pairwise(X, P, Y=None, Q=None, block_size=BLOCK_SIZE, n_jobs=1):
+    """Weighted Pairwise
+    Full weighted correlation matrix, computed over row blocks in threads.
+
+    Arguments:
+        - X (np.array): signatures x genes values
+        - P (np.array): signatures x genes p-values of X
+        - Y (np.array): signatures x genes values, optional
+        - Q (np.array): signatures x genes p-values of Y
+        - block_size (int): rows per block
+        - n_jobs (int): nº of threads
+    Returns:
+        - scores (np.array): len(X) x len(Y) float32 matrix
+    """
+    a = prepare_weighted(X, P)
+    b = a if Y is None else prepare_weighted(Y, Q)
+    n_rows, n_cols = len(a["X"]), len(b["X"])
+    scores = np.empty((n_rows, n_cols), dtype=np.float32)
+
+    def _row_block(i):
+        a_block = _slice_terms(a, i, i + block_size)
+        for j in range(0, n_cols, block_size):
+            block = weighted_block_scores(a_block, _slice_terms(b, j, j + block_size))
+            scores[i : i + block.shape[0], j : j + block.shape[1]] = block
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        list(executor.map(_row_block, range(0, n_rows, block_size)))
+    if Y is None:
+        np.fill_diagonal(scores, 1)
+    return scores
+
+
+def check_weighted_correlation(n_signatures=20, n_genes=500, seed=0, atol=1e-5):
+    """Check Weighted Correlation
+    Compares `weighted_pairwise` against the pair-by-pair reference on
+    random z-scores and p-values.
+
+    Arguments:
+        - n_signatures (int): nº of random signatures
+        - n_genes (int): nº of genes
+        - seed (int): random seed
+        - atol (float): absolute tolerance
+    Returns:
+        - max_error (float): largest absolute difference
+    """
+    rng = np.random.default_rng(seed)
+    P = rng.uniform(1e-6, 1, size=(n_signatures, n_genes))
+    X = rng.normal(size=(n_signatures, n_genes)) * 3 + 1
+
+    scores = weighted_pairwise(X, P, block_size=7, n_jobs=2)
+    expected = np.ones((n_signatures, n_signatures))
+    for i in range(n_signatures):
+        for j in range(n_signatures):
+            if i != j:
+                expected[i, j] = weighted_correlation_reference(X[i], X[j], P[i], P[j])
+
+    max_error = float(np.abs(scores - expected).max())
+    if max_error > atol:
+        raise AssertionError(f"Err weighted correlation differs by {max_error}")
+    return max_error
@@ -3,6 +3,11 @@ Store Variables
 
 This script is used to store variables in the current namespace.
 
+Variables are written to a `checkpoint_store.CheckpointStore` (ndarrays as
+.npy, DataFrames as Parquet, pickle otherwise) instead of IPython `%store`.
+The generated file restores every variable as the original object, with
+ndarrays memory-mapped so large arrays are only read where they are used.
+
 Structure:
     1. Imports, Variables, Functions
     2. Get Variables Currently in Namespace
@@ -14,11 +19,12 @@ Structure:
 
 # imports
 from IPython import get_ipython
-import sys
+import checkpoint_store as _checkpoint_store
 
 # variables
 _variable_types_interest = ["int", "float", "float64", "str", "list", "dict", "tuple", "set", "DataFrame", "Series", "ndarray"]
 _store_variables_output_file = "variables.txt"
+_store_variables_checkpoint_path = _checkpoint_store.CHECKPOINT_PATH
 
 # functions
 
@@ -31,25 +37,29 @@ except Exception as e:
 
 # 3. Store Variables
 try:
-    ipython.run_line_magic("store", " ".join(_store_variables_variables))
-    print(f"Stored {len(_store_variables_variables)} variables!")
+    _store_variables_checkpoint = _checkpoint_store.CheckpointStore(_store_variables_checkpoint_path)
+    _store_variables_variables = _store_variables_checkpoint.save_many(
+        {_name: ipython.user_ns[_name] for _name in _store_variables_variables}
+    )
+    print(f"Stored {len(_store_variables_variables)} variables in {_store_variables_checkpoint_path}!")
+    print(_store_variables_checkpoint.report().to_string(index=False))
 except Exception as e:
     print(f"Error storing variables: {e}")
 
 # 4. Generate File Defining Variables
 try:
     with open(_store_variables_output_file, "w") as f:
-        f.write("%store -r\nimport sys\n")
+        f.write("from checkpoint_store import CheckpointStore\n")
+        f.write(f"_checkpoint = CheckpointStore('{_store_variables_checkpoint_path}')\n")
         for _store_variables_variables_element in _store_variables_variables:
-            f.write(f"{_store_variables_variables_element} = globals()['{_store_variables_variables_element}']\n")
-        f.write(f"for var in {_store_variables_variables}:\n")
-        f.write("\tprint(f'{var}: {sys.getsizeof(globals()[var]) / (1024 * 1024):.2f} MB')\n")
+            f.write(f"{_store_variables_variables_element} = _checkpoint.load('{_store_variables_variables_element}')\n")
+        f.write("print(_checkpoint.report().to_string(index=False))\n")
     print(f"Generated file {_store_variables_output_file}!\nrun '%load {_store_variables_output_file}' in the next notebook to avoid Pylance warnings!")
 except Exception as e:
     print(f"Error generating {_store_variables_output_file} file: {e}")
 
 # Cleanup
 try:
-    del f, _variable_types_interest, _store_variables_variables_element, _store_variables_variables, ipython, _store_variables_output_file, get_ipython, sys
+    del _variable_types_interest, _store_variables_variables, ipython, _store_variables_output_file, _store_variables_checkpoint, _store_variables_checkpoint_path, get_ipython, _checkpoint_store, f, _store_variables_variables_element
 except NameError:
     pass
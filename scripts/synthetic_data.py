@@ -0,0 +1,341 @@
+"""Synthetic Data
+Deterministic synthetic inputs for the pipeline benchmarks, so every stage
+can be exercised at any scale without downloads.
+
+Everything is drawn from a seeded `np.random.default_rng`, so the same
+(scale, seed) always produces the same files:
+    - genes: Entrez IDs and symbols (a `GeneRegistry`)
+    - DE signatures: DiSignAtlas `{dsaid}_alldiff.txt` files (with the
+      duplicated genes and missing values the cleaning has to handle) and
+      iLINCS downloader records
+    - MeSH: a tree of descriptors written as a desc.xml, plus disease
+      names perturbed from its C-branch terms
+    - Harmonizome: a gene x attribute `gene_attribute_matrix.txt`
+
+Structure:
+    1. Imports, Variables, Functions
+    2. Genes & Signatures
+    3. MeSH Tree
+    4. Harmonizome Matrix
+"""
+
+# 1. Imports, Variables, Functions
+# imports
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr
+
+from gene_registry import GeneRegistry
+from signature_store import ILINCS_GENE_COLUMN, ILINCS_VALUE_COLUMNS
+
+# variables
+SCALES = {
+    "small": dict(
+        n_genes=2000, n_signatures=200, n_mesh_terms=2000, n_diseases=200,
+        n_harmonizome_genes=2000, n_harmonizome_attributes=300,
+    ),
+    "medium": dict(
+        n_genes=10000, n_signatures=1000, n_mesh_terms=10000, n_diseases=1000,
+        n_harmonizome_genes=10000, n_harmonizome_attributes=1000,
+    ),
+    "large": dict(
+        n_genes=19000, n_signatures=5000, n_mesh_terms=30000, n_diseases=3000,
+        n_harmonizome_genes=19000, n_harmonizome_attributes=3000,
+    ),
+}
+SEED = 0
+MESH_CATEGORIES = ("A", "B", "C", "D", "E", "F", "G")
+SYLLABLES = (
+    "car", "dio", "neu", "ro", "path", "y", "hep", "at", "itis", "onc", "o",
+    "ma", "derm", "gast", "ric", "pulm", "nary", "lymph", "oma", "sis",
+)
+
+
+# functions
+def get_scale(scale):
+    """Get Scale
+    Arguments:
+        - scale (str | dict): name in `SCALES` or explicit sizes
+    Returns:
+        - sizes (dict): sizes, missing keys taken from "small"
+    """
+    if isinstance(scale, str):
+        if scale not in SCALES:
+            raise KeyError(f"Err unknown scale '{scale}', available: {list(SCALES)}")
+        return dict(SCALES[scale])
+    return {**SCALES["small"], **scale}
+
+
+# 2. Genes & Signatures
+def make_registry(n_genes, seed=SEED):
+    """Make Registry
+    Arguments:
+        - n_genes (int): nº of genes
+        - seed (int): random seed
+    Returns:
+        - registry (GeneRegistry): sorted unique Entrez IDs, symbols "G<id>"
+    """
+    rng = np.random.default_rng([seed, 1])
+    ids = np.sort(rng.choice(10 * n_genes, size=n_genes, replace=False) + 1)
+    return GeneRegistry(ids, [f"G{i}" for i in ids])
+
+
+def make_de_signatures(registry, n_signatures, coverage=0.9, seed=SEED):
+    """Make DE Signatures
+    Each signature covers a random subset of the genes plus a few unknown
+    genes, duplicated rows and missing values, like the DiSignAtlas files.
+
+    Arguments:
+        - registry (GeneRegistry): gene universe
+        - n_signatures (int): nº of signatures
+        - coverage (float): mean fraction of genes measured per signature
+        - seed (int): random seed
+    Yields:
+        - dsaid (str): "DSA%05d"
+        - df (pd.DataFrame): GeneID, Log2FC, PValue, AdjPValue
+    """
+    rng = np.random.default_rng([seed, 2])
+    genes = registry.entrez_ids
+    for j in range(n_signatures):
+        n = int(len(genes) * np.clip(rng.normal(coverage, 0.05), 0.1, 1.0))
+        ids = rng.choice(genes, size=n, replace=False)
+        # unknown genes and duplicated rows
+        ids = np.concatenate([ids, genes.max() + 1 + rng.integers(0, 1000, n // 100)])
+        ids = np.concatenate([ids, rng.choice(ids, size=n // 200)])
+
+        log2fc = rng.normal(0, 1, len(ids)) * rng.gamma(1.0, 1.0)
+        p_values = np.clip(
+            2 * (1 - ndtr(np.abs(log2fc) * rng.uniform(0.5, 4))), 1e-300, 1
+        )
+        order = np.argsort(p_values)
+        adj = np.empty_like(p_values)
+        adj[order] = np.minimum.accumulate(
+            (p_values[order] * len(p_values) / np.arange(1, len(p_values) + 1))[::-1]
+        )[::-1]
+        df = pd.DataFrame(
+            {"GeneID": ids, "Log2FC": log2fc, "PValue": p_values,
+             "AdjPValue": np.minimum(adj, 1)}
+        )
+        df.loc[rng.random(len(df)) < 0.001, "PValue"] = np.nan
+        yield f"DSA{j:05d}", df
+
+
+def write_diff_files(path, signatures):
+    """Write Diff Files
+    Arguments:
+        - path (str): directory, created if missing
+        - signatures (iterable): (dsaid, df) pairs from `make_de_signatures`
+    Returns:
+        - dsaids (list): written signatures
+    """
+    os.makedirs(path, exist_ok=True)
+    dsaids = list()
+    for dsaid, df in signatures:
+        df.to_csv(os.path.join(path, f"{dsaid}_alldiff.txt"), index=False)
+        dsaids.append(dsaid)
+    return dsaids
+
+
+def make_ilincs_vectors(signatures):
+    """Make iLINCS Vectors
+    Arguments:
+        - signatures (iterable): (id, df) pairs from `make_de_signatures`
+    Returns:
+        - signature_vectors (dict): SignatureID -> list of records, as
+          returned by `download_batch_signature_data_concurrent`
+    """
+    columns = {"GeneID": ILINCS_GENE_COLUMN}
+    columns.update(ILINCS_VALUE_COLUMNS)
+    signature_vectors = dict()
+    for dsaid, df in signatures:
+        signature_id = dsaid.replace("DSA", "LINCSDS_")
+        records = df.dropna().rename(columns=columns)[list(columns.values())]
+        records.insert(0, "signatureID", signature_id)
+        signature_vectors[signature_id] = records.to_dict("records")
+    return signature_vectors
+
+
+def make_matrix(registry, n_signatures, seed=SEED):
+    """Make Matrix
+    Arguments:
+        - registry (GeneRegistry): gene universe
+        - n_signatures (int): nº of signatures
+        - seed (int): random seed
+    Returns:
+        - values (dict): "Log2FC", "PValue", "AdjPValue" genes x signatures
+          float32 matrices with NaN for unmeasured genes
+    """
+    values = {
+        name: np.full((len(registry), n_signatures), np.nan, dtype=np.float32)
+        for name in ("Log2FC", "PValue", "AdjPValue")
+    }
+    for j, (_, df) in enumerate(make_de_signatures(registry, n_signatures, seed=seed)):
+        df = df.drop_duplicates("GeneID", keep=False).dropna()
+        rows = registry.positions(df["GeneID"])
+        keep = rows >= 0
+        for name in values:
+            values[name][rows[keep], j] = df[name].to_numpy()[keep]
+    return values
+
+
+# 3. MeSH Tree
+def _make_word(rng, n_syllables):
+    return "".join(rng.choice(SYLLABLES, size=n_syllables))
+
+
+def make_mesh_descriptors(n_terms, max_children=8, seed=SEED):
+    """Make MeSH Descriptors
+    A random tree per category; some descriptors get a second tree number
+    in another branch, as polyhierarchical MeSH terms do.
+
+    Arguments:
+        - n_terms (int): nº of descriptors
+        - max_children (int): maximum nº of children per node
+        - seed (int): random seed
+    Returns:
+        - descriptors (list): dicts with ui, term, tree_numbers, synonyms,
+          scope, as `mesh_parser.iter_mesh_descriptors`
+    """
+    rng = np.random.default_rng([seed, 3])
+    tree_numbers = [f"{c}{i:02d}" for c in MESH_CATEGORIES for i in range(1, 4)]
+    n_children = {t: 0 for t in tree_numbers}
+    while len(tree_numbers) < n_terms:
+        parent = tree_numbers[int(rng.integers(len(tree_numbers)))]
+        if n_children[parent] >= max_children:
+            continue
+        n_children[parent] += 1
+        child = f"{parent}.{n_children[parent] * 37 + int(rng.integers(37)):03d}"
+        tree_numbers.append(child)
+        n_children[child] = 0
+
+    descriptors = list()
+    seen = set()
+    for i, tree_number in enumerate(tree_numbers):
+        term = " ".join(
+            _make_word(rng, int(rng.integers(2, 5))) for _ in range(int(rng.integers(1, 4)))
+        ).capitalize()
+        while term in seen:
+            term = f"{term} {_make_word(rng, 2)}"
+        seen.add(term)
+        numbers = [tree_number]
+        if rng.random() < 0.2:
+            numbers.append(tree_numbers[int(rng.integers(len(tree_numbers)))])
+        descriptors.append(
+            {
+                "ui": f"D{i:06d}",
+                "term": term,
+                "tree_numbers": numbers,
+                "synonyms": [f"{term}, {_make_word(rng, 2)}" for _ in range(int(rng.integers(0, 3)))],
+                "scope": f"Synthetic descriptor {i}.",
+            }
+        )
+    return descriptors
+
+
+def write_mesh_xml(path, descriptors):
+    """Write MeSH XML
+    Arguments:
+        - path (str): output desc.xml
+        - descriptors (list): see `make_mesh_descriptors`
+    """
+    root = ET.Element("DescriptorRecordSet", LanguageCode="eng")
+    for d in descriptors:
+        record = ET.SubElement(root, "DescriptorRecord", DescriptorClass="1")
+        ET.SubElement(record, "DescriptorUI").text = d["ui"]
+        ET.SubElement(ET.SubElement(record, "DescriptorName"), "String").text = d["term"]
+        tree_list = ET.SubElement(record, "TreeNumberList")
+        for tree_number in d["tree_numbers"]:
+            ET.SubElement(tree_list, "TreeNumber").text = tree_number
+        concept = ET.SubElement(
+            ET.SubElement(record, "ConceptList"), "Concept", PreferredConceptYN="Y"
+        )
+        ET.SubElement(concept, "ScopeNote").text = d["scope"]
+        term_list = ET.SubElement(concept, "TermList")
+        for name in [d["term"], *d["synonyms"]]:
+            ET.SubElement(ET.SubElement(term_list, "Term"), "String").text = name
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    ET.ElementTree(root).write(path, encoding="utf-8", xml_declaration=True)
+
+
+def make_disease_names(descriptors, n_diseases, seed=SEED):
+    """Make Disease Names
+    Disease names as DiSignAtlas reports them: C-branch MeSH terms with
+    typos, reordered words and case changes.
+
+    Arguments:
+        - descriptors (list): see `make_mesh_descriptors`
+        - n_diseases (int): nº of names
+        - seed (int): random seed
+    Returns:
+        - diseases (list): disease names
+    """
+    rng = np.random.default_rng([seed, 4])
+    terms = [d["term"] for d in descriptors if d["tree_numbers"][0].startswith("C")]
+    diseases = list()
+    for term in rng.choice(terms, size=n_diseases):
+        chars = list(term)
+        for _ in range(int(rng.integers(0, 3))):
+            chars[int(rng.integers(len(chars)))] = str(rng.choice(list("aeiou")))
+        words = "".join(chars).split()
+        if len(words) > 1 and rng.random() < 0.3:
+            words = words[::-1]
+        name = " ".join(words)
+        diseases.append(name.lower() if rng.random() < 0.5 else name)
+    return diseases
+
+
+def make_signature_tree_numbers(descriptors, n_signatures, seed=SEED):
+    """Make Signature Tree Numbers
+    Arguments:
+        - descriptors (list): see `make_mesh_descriptors`
+        - n_signatures (int): nº of signatures
+        - seed (int): random seed
+    Returns:
+        - signature_tree_numbers (list): tree numbers of 0-2 C-branch
+          descriptors per signature
+    """
+    rng = np.random.default_rng([seed, 5])
+    disease = [d for d in descriptors if d["tree_numbers"][0].startswith("C")]
+    return [
+        [t for k in rng.choice(len(disease), size=rng.integers(0, 3)) for t in disease[k]["tree_numbers"]]
+        for _ in range(n_signatures)
+    ]
+
+
+# 4. Harmonizome Matrix
+def write_harmonizome_matrix(path, registry, n_genes, n_attributes, density=0.02, seed=SEED):
+    """Write Harmonizome Matrix
+    Same layout as Harmonizome's gene_attribute_matrix.txt: 3 header rows
+    (attribute, attribute group, index names) and 3 index columns
+    (symbol, NA, gene id), values in {-1, 0, 1}.
+
+    Arguments:
+        - path (str): output file
+        - registry (GeneRegistry): genes are its first `n_genes`
+        - n_genes (int): nº of rows
+        - n_attributes (int): nº of columns
+        - density (float): fraction of non-zero values
+        - seed (int): random seed
+    """
+    rng = np.random.default_rng([seed, 6])
+    n_genes = min(n_genes, len(registry))
+    data = np.zeros((n_genes, n_attributes), dtype=np.int8)
+    mask = rng.random(data.shape) < density
+    data[mask] = rng.choice(np.array([-1, 1], dtype=np.int8), size=mask.sum())
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        attributes = [f"attribute_{i}" for i in range(n_attributes)]
+        groups = [f"group_{i % 10}" for i in range(n_attributes)]
+        f.write("\t".join(["#", "#", "GeneSym", *attributes]) + "\n")
+        f.write("\t".join(["#", "#", "Group", *groups]) + "\n")
+        f.write("\t".join(["GeneSym", "NA", "GeneID", *["NA"] * n_attributes]) + "\n")
+        for i in range(n_genes):
+            gene_id = registry.entrez_ids[i]
+            f.write(
+                "\t".join([registry.symbols[i], "NA", str(gene_id)])
+                + "\t" + "\t".join(map(str, data[i])) + "\n"
+            )